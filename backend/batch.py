@@ -0,0 +1,165 @@
+import asyncio
+import json
+import posixpath
+import zipfile
+
+import config
+import executor
+import tasks
+from encoding import EncodeOptions
+from uploads import buffer_upload
+
+
+class BatchError(ValueError):
+    """Raised for a batch request that can't be started."""
+
+
+class _ZipSink:
+    """
+    Write-only file object for zipfile.ZipFile. Without seek() zipfile writes
+    each member followed by a data descriptor, so finished members can be
+    sent to the client while later ones are still being computed.
+    """
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def flush(self):
+        pass
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def _is_image_member(info: zipfile.ZipInfo) -> bool:
+    name = info.filename
+    base = posixpath.basename(name)
+    return not info.is_dir() and not name.startswith("__MACOSX/") and not base.startswith(".")
+
+
+def items_from_files(files) -> list[tuple[str, callable]]:
+    """(name, async loader) pairs for a list of multipart UploadFiles."""
+    return [
+        (f.filename or f"image_{i}", lambda f=f: asyncio.to_thread(buffer_upload, f))
+        for i, f in enumerate(files)
+    ]
+
+
+def _read_member(zf: zipfile.ZipFile, info: zipfile.ZipInfo, limit: int) -> bytes:
+    """Inflates a member, stopping past limit bytes whatever its header claims."""
+    with zf.open(info) as member:
+        data = member.read(limit + 1)
+    if len(data) > limit:
+        raise BatchError(f"{info.filename} is larger than {limit} bytes uncompressed")
+    return data
+
+
+async def _refuse(error: str):
+    raise BatchError(error)
+
+
+async def items_from_archive(archive) -> list[tuple[str, callable]]:
+    """
+    (name, async loader) pairs for the images inside an uploaded ZIP.
+
+    A small archive can inflate to far more than the upload limits allow,
+    so members over MAX_UPLOAD_BYTES, or past MAX_BATCH_UPLOAD_BYTES in
+    total, are never inflated and fail in the manifest instead.
+    """
+    try:
+        zf = await asyncio.to_thread(zipfile.ZipFile, archive.file)
+    except zipfile.BadZipFile:
+        raise BatchError("archive is not a valid ZIP file")
+    items = []
+    total = 0
+    for info in zf.infolist():
+        if not _is_image_member(info):
+            continue
+        total += info.file_size
+        if info.file_size > config.MAX_UPLOAD_BYTES:
+            error = f"{info.filename} is larger than {config.MAX_UPLOAD_BYTES} bytes uncompressed"
+            items.append((info.filename, lambda error=error: _refuse(error)))
+        elif total > config.MAX_BATCH_UPLOAD_BYTES:
+            error = f"archive contents exceed {config.MAX_BATCH_UPLOAD_BYTES} bytes uncompressed"
+            items.append((info.filename, lambda error=error: _refuse(error)))
+        else:
+            items.append((info.filename, lambda info=info: asyncio.to_thread(_read_member, zf, info,
+                                                                            config.MAX_UPLOAD_BYTES)))
+    return items
+
+
+def _output_name(name: str, extension: str, taken: set) -> str:
+    stem = posixpath.splitext(posixpath.basename(name))[0] or "image"
+    candidate = f"{stem}{extension}"
+    n = 1
+    while candidate in taken:
+        candidate = f"{stem}_{n}{extension}"
+        n += 1
+    taken.add(candidate)
+    return candidate
+
+
+async def _process(name: str, load, op: str, params: dict, encoding: EncodeOptions, limit: asyncio.Semaphore):
+    async with limit:
+        contents = await load()
+        # other requests may briefly fill the shared pool; wait for room
+        # rather than failing the item
+        for attempt in range(50):
+            try:
+                output = await executor.run(tasks.run_operation, contents, op, params, encoding=encoding)
+                return output.getvalue()
+            except executor.PoolSaturated:
+                await asyncio.sleep(min(0.05 * (attempt + 1), 1.0))
+        raise executor.PoolSaturated("worker pool stayed full")
+
+
+async def stream_zip(items, op: str, params: dict, encoding: EncodeOptions, on_close=None):
+    """
+    Applies op to every item and yields a ZIP archive of the results.
+
+    Each result is written to the archive as soon as it is ready, in
+    completion order. Items that fail are listed with their error in a
+    trailing manifest.json instead of aborting the batch.
+    """
+    sink = _ZipSink()
+    archive = zipfile.ZipFile(sink, "w", compression=zipfile.ZIP_STORED)
+    limit = asyncio.Semaphore(config.BATCH_CONCURRENCY)
+    pending = {
+        asyncio.ensure_future(_process(name, load, op, params, encoding, limit)): name
+        for name, load in items
+    }
+    manifest = []
+    taken = set()
+    try:
+        while pending:
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                name = pending.pop(future)
+                try:
+                    data = future.result()
+                except Exception as e:
+                    manifest.append({"input": name, "status": "error", "error": str(e)})
+                    continue
+                output = _output_name(name, encoding.extension, taken)
+                archive.writestr(output, data)
+                manifest.append({"input": name, "status": "ok", "output": output})
+            yield sink.drain()
+        archive.writestr("manifest.json", json.dumps(manifest, indent=2))
+        archive.close()
+        yield sink.drain()
+    finally:
+        for future in pending:
+            future.cancel()
+        if on_close is not None:
+            await on_close()
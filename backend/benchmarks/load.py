@@ -0,0 +1,233 @@
+"""
+HTTP load test for the API: throughput, latency percentiles and errors per
+endpoint at one or more concurrency levels.
+
+Run from backend/, against a server that is already up:
+
+    python -m benchmarks.load --url http://localhost:8000 --mix gaussian:3,negative:1,canny:1 --concurrency 1,8,32
+
+or let it start one (uvicorn main:app) for the duration of the test:
+
+    python -m benchmarks.load --spawn --workers 2 --sizes 256,1080p --duration 20 --json load.json
+
+--mix names /api/task/<name> endpoints (or full paths starting with /) with
+relative weights. Every request uploads a synthetic PNG of a size picked at
+random from --sizes, with a few random bytes after the PNG's end so that it
+misses the server's result cache (--cached sends identical images).
+
+While a level runs, a probe requests GET / every --probe-interval seconds;
+since that endpoint does no work, its latency rising with load means the
+event loop is being blocked. 503s mean the worker pool's queue
+(PIXELS_POOL_QUEUE_DEPTH) is full at that concurrency.
+"""
+import argparse
+import json
+import random
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import requests
+
+from benchmarks.tasks import SIZES, synthetic
+
+
+def _percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))]
+
+
+def _summary(latencies: list[float]) -> dict:
+    return {
+        "p50_ms": round(_percentile(latencies, 50) * 1000, 1),
+        "p95_ms": round(_percentile(latencies, 95) * 1000, 1),
+        "p99_ms": round(_percentile(latencies, 99) * 1000, 1),
+        "max_ms": round(max(latencies, default=0) * 1000, 1),
+        "mean_ms": round(statistics.fmean(latencies) * 1000, 1) if latencies else 0.0,
+    }
+
+
+def _parse_mix(value: str) -> list[tuple[str, float]]:
+    mix = []
+    for item in value.split(","):
+        name, _, weight = item.strip().partition(":")
+        if name:
+            mix.append((name if name.startswith("/") else f"/api/task/{name}", float(weight or 1)))
+    return mix
+
+
+class _Probe(threading.Thread):
+    def __init__(self, url: str, interval: float):
+        super().__init__(daemon=True)
+        self.url = url
+        self.interval = interval
+        self.latencies = []
+        self.stopped = threading.Event()
+
+    def run(self):
+        with requests.Session() as session:
+            while not self.stopped.wait(self.interval):
+                started = time.perf_counter()
+                try:
+                    session.get(self.url, timeout=30)
+                except requests.RequestException:
+                    continue
+                self.latencies.append(time.perf_counter() - started)
+
+
+def run_level(url: str, mix, images: dict, concurrency: int, duration: float | None, total: int | None,
+              probe_interval: float, timeout: float, cached: bool = False) -> dict:
+    paths = [path for path, _ in mix]
+    weights = [weight for _, weight in mix]
+    results = {path: {"latencies": [], "statuses": {}, "bytes_in": 0, "bytes_out": 0} for path in paths}
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration if duration else None
+    remaining = [total]
+    local = threading.local()
+
+    def take() -> bool:
+        with lock:
+            if remaining[0] is not None:
+                if remaining[0] <= 0:
+                    return False
+                remaining[0] -= 1
+        return deadline is None or time.monotonic() < deadline
+
+    def worker(seed: int):
+        rng = random.Random(seed)
+        local.session = requests.Session()
+        while take():
+            path = rng.choices(paths, weights)[0]
+            size = rng.choice(list(images))
+            # decoders stop at IEND, so the suffix only changes the digest
+            body = images[size] if cached else images[size] + rng.randbytes(8)
+            started = time.perf_counter()
+            try:
+                response = local.session.post(url + path, files={"file": (f"{size}.png", body, "image/png")},
+                                              timeout=timeout)
+                status, received = str(response.status_code), len(response.content)
+            except requests.RequestException as e:
+                status, received = type(e).__name__, 0
+            elapsed = time.perf_counter() - started
+            with lock:
+                entry = results[path]
+                entry["latencies"].append(elapsed)
+                entry["statuses"][status] = entry["statuses"].get(status, 0) + 1
+                entry["bytes_out"] += len(body)
+                entry["bytes_in"] += received
+
+    probe = _Probe(url + "/", probe_interval)
+    probe.start()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(worker, range(concurrency)))
+    wall = time.perf_counter() - started
+    probe.stopped.set()
+    probe.join()
+
+    report = {"concurrency": concurrency, "seconds": round(wall, 2), "endpoints": {}}
+    all_latencies = []
+    errors = 0
+    for path, entry in results.items():
+        latencies = entry["latencies"]
+        failed = sum(count for status, count in entry["statuses"].items() if not status.startswith("2"))
+        errors += failed
+        all_latencies += latencies
+        report["endpoints"][path] = {
+            "requests": len(latencies),
+            "rps": round(len(latencies) / wall, 2),
+            "error_rate": round(failed / len(latencies), 4) if latencies else 0.0,
+            "statuses": entry["statuses"],
+            "mb_out": round(entry["bytes_out"] / 2**20, 1),
+            "mb_in": round(entry["bytes_in"] / 2**20, 1),
+            **_summary(latencies),
+        }
+    report["total"] = {
+        "requests": len(all_latencies),
+        "rps": round(len(all_latencies) / wall, 2),
+        "error_rate": round(errors / len(all_latencies), 4) if all_latencies else 0.0,
+        **_summary(all_latencies),
+    }
+    report["event_loop_probe"] = {"samples": len(probe.latencies), **_summary(probe.latencies)}
+    return report
+
+
+def _print(report: dict):
+    print(f"\nconcurrency {report['concurrency']} ({report['seconds']}s)")
+    print(f"{'endpoint':36}{'reqs':>7}{'rps':>8}{'err%':>7}{'p50':>9}{'p95':>9}{'p99':>9}")
+    rows = list(report["endpoints"].items()) + [("total", report["total"]), ("GET / probe", report["event_loop_probe"])]
+    for name, row in rows:
+        count = row.get("requests", row.get("samples"))
+        rps = f"{row['rps']:>8.1f}" if "rps" in row else " " * 8
+        err = f"{row['error_rate'] * 100:>7.1f}" if "error_rate" in row else " " * 7
+        print(f"{name:36}{count:>7}{rps}{err}{row['p50_ms']:>9.1f}{row['p95_ms']:>9.1f}{row['p99_ms']:>9.1f}")
+
+
+def _spawn(port: int, workers: int) -> subprocess.Popen:
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--workers", str(workers), "--log-level", "warning"],
+    )
+    url = f"http://127.0.0.1:{port}/"
+    for _ in range(100):
+        try:
+            requests.get(url, timeout=1)
+            return server
+        except requests.RequestException:
+            if server.poll() is not None:
+                sys.exit("uvicorn exited during startup")
+            time.sleep(0.2)
+    server.terminate()
+    sys.exit("uvicorn didn't start within 20s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://127.0.0.1:8000", help="server to test")
+    parser.add_argument("--spawn", action="store_true", help="start uvicorn main:app on --port for the test")
+    parser.add_argument("--port", type=int, default=8765, help="port for --spawn")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn worker processes for --spawn")
+    parser.add_argument("--mix", default="gaussian:3,negative:1,canny:1,sobel:1", help="endpoint:weight,...")
+    parser.add_argument("--sizes", default="256,1080p", help=f"image sizes to upload, from {', '.join(SIZES)}")
+    parser.add_argument("--concurrency", default="1,4,16", help="comma-separated concurrency levels")
+    parser.add_argument("--duration", type=float, default=15.0, help="seconds per level")
+    parser.add_argument("--requests", type=int, help="requests per level instead of --duration")
+    parser.add_argument("--probe-interval", type=float, default=0.1, help="seconds between event loop probes")
+    parser.add_argument("--timeout", type=float, default=120.0, help="per-request timeout in seconds")
+    parser.add_argument("--cached", action="store_true", help="send identical images so results can be cached")
+    parser.add_argument("--json", help="write the report to this file")
+    args = parser.parse_args()
+
+    mix = _parse_mix(args.mix)
+    sizes = [size.strip() for size in args.sizes.split(",") if size.strip()]
+    unknown = set(sizes) - set(SIZES)
+    if unknown:
+        sys.exit(f"unknown size(s): {', '.join(sorted(unknown))}")
+    images = {size: cv2.imencode(".png", synthetic(*SIZES[size], "color"))[1].tobytes() for size in sizes}
+
+    server = _spawn(args.port, args.workers) if args.spawn else None
+    url = f"http://127.0.0.1:{args.port}" if server else args.url.rstrip("/")
+    levels = []
+    try:
+        for concurrency in [int(level) for level in args.concurrency.split(",")]:
+            report = run_level(url, mix, images, concurrency, None if args.requests else args.duration,
+                               args.requests, args.probe_interval, args.timeout, args.cached)
+            _print(report)
+            levels.append(report)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"url": url, "mix": dict(mix), "sizes": sizes, "levels": levels}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""
+Latency and accuracy of the segmentation tiers (segment.TIERS).
+
+Run from backend/:
+
+    python -m benchmarks.segment path/to/photos/*.jpg
+    python -m benchmarks.segment --threads 4 --torchscript --json results.json
+
+Every tier segments every image (random noise images if none are given, which
+only makes sense for latency). Accuracy is reported as agreement with the
+"quality" tier: pixel accuracy and mean IoU over the classes either of them
+found, so it measures what a faster tier gives up relative to the default.
+"""
+import argparse
+import json
+import statistics
+import sys
+import time
+
+import cv2
+import numpy as np
+
+import config
+import segment
+
+
+def _images(paths: list[str], size: int) -> list[tuple[str, np.ndarray]]:
+    if not paths:
+        rng = np.random.default_rng(0)
+        return [(f"noise_{i}", rng.integers(0, 256, (size, size * 4 // 3, 3), np.uint8)) for i in range(4)]
+    images = []
+    for path in paths:
+        bgr = cv2.imread(path, cv2.IMREAD_COLOR)
+        if bgr is None:
+            sys.exit(f"can't read {path}")
+        images.append((path, cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB)))
+    return images
+
+
+def _agreement(labels: np.ndarray, reference: np.ndarray) -> tuple[float, float]:
+    accuracy = float((labels == reference).mean())
+    ious = []
+    for label in np.union1d(np.unique(labels), np.unique(reference)):
+        a, b = labels == label, reference == label
+        ious.append((a & b).sum() / (a | b).sum())
+    return accuracy, float(np.mean(ious))
+
+
+def _segment(model, rgb: np.ndarray, max_side: int) -> np.ndarray:
+    label_map = segment.infer(model, [segment.model_input(rgb, max_side)])[0]
+    height, width = rgb.shape[:2]
+    return cv2.resize(label_map, (width, height), interpolation=cv2.INTER_NEAREST)
+
+
+def run(images, tiers: list[str], repeat: int, batch: int) -> dict:
+    segment._set_threads()
+    results = {}
+    references = {}
+    for tier in ["quality"] + [t for t in tiers if t != "quality"]:
+        started = time.perf_counter()
+        model = segment.build_model(tier)
+        load = time.perf_counter() - started
+        max_side = segment.TIERS[tier].max_side
+        _segment(model, images[0][1], max_side)  # warm-up
+
+        latencies = []
+        agreement = []
+        for name, rgb in images:
+            for _ in range(repeat):
+                started = time.perf_counter()
+                labels = _segment(model, rgb, max_side)
+                latencies.append(time.perf_counter() - started)
+            if tier == "quality":
+                references[name] = labels
+            else:
+                agreement.append(_agreement(labels, references[name]))
+
+        # throughput of one forward pass over `batch` copies of the first image
+        small = segment.model_input(images[0][1], max_side)
+        started = time.perf_counter()
+        segment.infer(model, [small] * batch)
+        per_image = (time.perf_counter() - started) / batch
+
+        if tier in tiers:
+            results[tier] = {
+                "model": segment.TIERS[tier].model,
+                "max_side": max_side,
+                "load_s": round(load, 2),
+                "latency_ms_median": round(statistics.median(latencies) * 1000, 1),
+                "latency_ms_max": round(max(latencies) * 1000, 1),
+                f"batch_{batch}_ms_per_image": round(per_image * 1000, 1),
+                "pixel_accuracy_vs_quality": round(statistics.mean(a for a, _ in agreement), 4) if agreement else 1.0,
+                "miou_vs_quality": round(statistics.mean(m for _, m in agreement), 4) if agreement else 1.0,
+            }
+        del model
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("images", nargs="*", help="images to segment (default: random noise)")
+    parser.add_argument("--tiers", default=",".join(segment.TIERS), help="comma-separated tiers to measure")
+    parser.add_argument("--size", type=int, default=512, help="height of the noise images")
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per image")
+    parser.add_argument("--batch", type=int, default=4, help="batch size for the throughput figure")
+    parser.add_argument("--threads", type=int, default=config.SEGMENT_THREADS, help="torch intra-op threads")
+    parser.add_argument("--torchscript", action="store_true", help="script and freeze the models")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    config.SEGMENT_THREADS = args.threads
+    config.SEGMENT_TORCHSCRIPT = int(args.torchscript or config.SEGMENT_TORCHSCRIPT)
+    tiers = [tier.strip() for tier in args.tiers.split(",") if tier.strip()]
+    unknown = set(tiers) - set(segment.TIERS)
+    if unknown:
+        sys.exit(f"unknown tier(s): {', '.join(sorted(unknown))}")
+
+    results = run(_images(args.images, args.size), tiers, args.repeat, args.batch)
+    columns = list(next(iter(results.values())))
+    print("tier".ljust(10) + "".join(column.rjust(max(len(column), 10) + 2) for column in columns))
+    for tier, row in results.items():
+        print(tier.ljust(10) + "".join(str(row[column]).rjust(max(len(column), 10) + 2) for column in columns))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
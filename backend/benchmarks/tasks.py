@@ -0,0 +1,201 @@
+"""
+Decode, op and encode timings for every registered operation.
+
+Run from backend/:
+
+    python -m benchmarks.tasks --json before.json
+    python -m benchmarks.tasks --sizes 256,1080p --ops gaussian,canny --compare before.json --threshold 0.15
+
+Each operation in ops.OPERATIONS (which every /api/task endpoint and get_*
+function in tasks.py runs through) is applied to synthetic colour and
+grayscale PNGs at each size, exactly as tasks.run_operation does: decode in
+the colour space the op expects, apply (tiled where it would be), encode to
+PNG. Stages are timed separately and the median of --repeat runs is reported,
+with throughput in megapixels per second and the peak memory allocated
+through numpy/tracemalloc during one untimed run.
+
+Slow ops are skipped at sizes above LARGEST unless --all is given.
+
+With --compare the run is checked against an earlier --json file and the
+process exits with status 1 if any stage got slower by more than --threshold
+(a fraction) and by more than --min-ms.
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+import cv2
+import numpy as np
+
+import ops
+import tasks
+
+SIZES = {
+    "256": (256, 256),
+    "1080p": (1920, 1080),
+    "4k": (3840, 2160),
+    "8k": (7680, 4320),
+}
+MODES = ("color", "gray")
+# ops whose cost grows much faster than the pixel count; skipped above this
+# size unless --all is given (hough-circles takes ~1 min at 1080p)
+LARGEST = {"hough-circles": "1080p"}
+STAGES = ("decode_ms", "op_ms", "encode_ms", "total_ms")
+
+
+def synthetic(width: int, height: int, mode: str, seed: int = 0) -> np.ndarray:
+    """Gradients, shapes and noise: something for edge, line and circle detectors to find."""
+    x = np.linspace(0, 255, width, dtype=np.float32)[None, :]
+    y = np.linspace(0, 255, height, dtype=np.float32)[:, None]
+    img = cv2.merge([
+        (0.7 * x + 0.3 * y).astype(np.uint8),
+        (0.3 * x + 0.7 * y).astype(np.uint8),
+        (255 - 0.5 * (x + y)).astype(np.uint8),
+    ])
+    rng = np.random.default_rng(seed)
+    scale = max(width, height) / 256
+    for _ in range(12):
+        center = (int(rng.integers(width)), int(rng.integers(height)))
+        color = tuple(int(c) for c in rng.integers(0, 256, 3))
+        cv2.circle(img, center, int(rng.integers(8, 40) * scale), color, max(1, int(2 * scale)))
+        end = (int(rng.integers(width)), int(rng.integers(height)))
+        cv2.line(img, center, end, color, max(1, int(scale)))
+    noise = np.empty_like(img)
+    cv2.randu(noise, 0, 24)
+    cv2.add(img, noise, dst=img)
+    return cv2.cvtColor(img, cv2.COLOR_BGR2GRAY) if mode == "gray" else img
+
+
+def _timed(fn, *args):
+    started = time.perf_counter()
+    result = fn(*args)
+    return result, (time.perf_counter() - started) * 1000
+
+
+def _run_once(image_bytes: bytes, name: str) -> tuple[float, float, float, int]:
+    img, decode_ms = _timed(tasks.decode_for, image_bytes, name)
+    result, op_ms = _timed(tasks.apply_operation, img, name, {})
+    output, encode_ms = _timed(tasks.encode_image, result)
+    return decode_ms, op_ms, encode_ms, len(output.getvalue())
+
+
+def _peak_mb(image_bytes: bytes, name: str) -> float:
+    tracemalloc.start()
+    try:
+        _run_once(image_bytes, name)
+        return tracemalloc.get_traced_memory()[1] / 2**20
+    finally:
+        tracemalloc.stop()
+
+
+def bench(name: str, size: str, mode: str, image_bytes: bytes, repeat: int) -> dict:
+    width, height = SIZES[size]
+    row = {"op": name, "size": size, "mode": mode, "width": width, "height": height}
+    try:
+        # doubles as the warm-up run
+        row["peak_mb"] = round(_peak_mb(image_bytes, name), 1)
+        runs = [_run_once(image_bytes, name) for _ in range(repeat)]
+    except Exception as e:
+        row["error"] = f"{type(e).__name__}: {e}"
+        return row
+    for index, stage in enumerate(STAGES[:3]):
+        row[stage] = round(statistics.median(run[index] for run in runs), 3)
+    row["total_ms"] = round(statistics.median(sum(run[:3]) for run in runs), 3)
+    row["megapixels_per_s"] = round(width * height / 1e6 / (row["total_ms"] / 1000), 2)
+    row["output_bytes"] = runs[-1][3]
+    return row
+
+
+def compare(results: list[dict], baseline: list[dict], threshold: float, min_ms: float) -> list[str]:
+    previous = {(row["op"], row["size"], row["mode"]): row for row in baseline}
+    regressions = []
+    for row in results:
+        before = previous.get((row["op"], row["size"], row["mode"]))
+        if before is None or "error" in row or "error" in before:
+            continue
+        for stage in STAGES:
+            old, new = before[stage], row[stage]
+            if new > old * (1 + threshold) and new - old > min_ms:
+                regressions.append(
+                    f"{row['op']} {row['size']} {row['mode']} {stage}: {old:.2f} -> {new:.2f} ms (+{(new / old - 1) * 100:.0f}%)"
+                )
+    return regressions
+
+
+def _metadata(repeat: int) -> dict:
+    return {
+        "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "opencv": cv2.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "cv2_threads": cv2.getNumThreads(),
+        "repeat": repeat,
+    }
+
+
+def _split(value: str, choices) -> list[str]:
+    chosen = [item.strip() for item in value.split(",") if item.strip()]
+    unknown = set(chosen) - set(choices)
+    if unknown:
+        sys.exit(f"unknown: {', '.join(sorted(unknown))}. Choose from: {', '.join(choices)}")
+    return chosen
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default=",".join(SIZES), help=f"comma-separated, from {', '.join(SIZES)}")
+    parser.add_argument("--modes", default=",".join(MODES), help="color, gray or both")
+    parser.add_argument("--ops", default="", help="comma-separated operation names (default: all)")
+    parser.add_argument("--all", action="store_true", help="don't skip slow ops at large sizes")
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per case")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--compare", help="results file of an earlier run to check against")
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed slowdown as a fraction")
+    parser.add_argument("--min-ms", type=float, default=1.0, help="ignore slowdowns smaller than this")
+    args = parser.parse_args()
+
+    sizes = _split(args.sizes, SIZES)
+    modes = _split(args.modes, MODES)
+    names = _split(args.ops, ops.OPERATIONS) if args.ops else list(ops.OPERATIONS)
+
+    results = []
+    print(f"{'op':28}{'size':>7}{'mode':>7}{'decode':>10}{'op':>10}{'encode':>10}{'MP/s':>9}{'peak MB':>9}")
+    for size in sizes:
+        for mode in modes:
+            image_bytes = cv2.imencode(".png", synthetic(*SIZES[size], mode))[1].tobytes()
+            for name in names:
+                if not args.all and name in LARGEST and list(SIZES).index(size) > list(SIZES).index(LARGEST[name]):
+                    continue
+                row = bench(name, size, mode, image_bytes, args.repeat)
+                results.append(row)
+                if "error" in row:
+                    print(f"{name:28}{size:>7}{mode:>7}  {row['error']}")
+                else:
+                    print(f"{name:28}{size:>7}{mode:>7}{row['decode_ms']:>10.1f}{row['op_ms']:>10.1f}"
+                          f"{row['encode_ms']:>10.1f}{row['megapixels_per_s']:>9.1f}{row['peak_mb']:>9.1f}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"metadata": _metadata(args.repeat), "results": results}, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, args.threshold, args.min_ms)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        if regressions:
+            sys.exit(1)
+        print(f"no stage slower than {args.threshold:.0%} (+{args.min_ms:g} ms) against {args.compare}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+import config
+
+
+def digest(data: bytes) -> str:
+    """Fast content hash used to identify uploads."""
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def make_key(image_digest: str, task: str, params) -> str:
+    """
+    Builds the cache key for one (image, task, parameters) request.
+
+    Parameters are normalised through JSON so that equivalent values such as
+    tuples and lists, or differently ordered dicts, produce the same key.
+    """
+    normalized = json.dumps(params, sort_keys=True, separators=(",", ":"), default=str)
+    return digest(f"{image_digest}\0{task}\0{normalized}".encode())
+
+
+class ResultCache:
+    """
+    Encoded task results keyed by make_key().
+
+    The in-memory tier is an LRU bounded by the total size of the stored
+    bytes. The optional disk tier keeps one file per key under disk_dir and
+    evicts the least recently written files once disk_max_bytes is exceeded.
+    Disk access is blocking, so async callers should run get_disk/put_disk
+    in a thread.
+    """
+
+    def __init__(self, max_bytes: int, disk_dir: str | None = None, disk_max_bytes: int = 0):
+        self.max_bytes = max_bytes
+        self.disk_dir = Path(disk_dir) if disk_dir else None
+        self.disk_max_bytes = disk_max_bytes
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[str, bytes] = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        if self.disk_dir is not None:
+            self.disk_dir.mkdir(parents=True, exist_ok=True)
+
+    def get(self, key: str) -> bytes | None:
+        with self._lock:
+            data = self._entries.get(key)
+            if data is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+            elif self.disk_dir is None:
+                self.misses += 1
+            return data
+
+    def put(self, key: str, data: bytes):
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= len(old)
+            self._entries[key] = data
+            self._size += len(data)
+            while self._size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+
+    def _disk_path(self, key: str) -> Path:
+        return self.disk_dir / key[:2] / key
+
+    def get_disk(self, key: str) -> bytes | None:
+        """Looks the key up on disk and promotes a hit to the memory tier."""
+        if self.disk_dir is None:
+            return None
+        try:
+            data = self._disk_path(key).read_bytes()
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.disk_hits += 1
+        self.put(key, data)
+        return data
+
+    def put_disk(self, key: str, data: bytes):
+        if self.disk_dir is None:
+            return
+        path = self._disk_path(key)
+        path.parent.mkdir(exist_ok=True)
+        tmp = path.with_suffix(f".{threading.get_ident()}.tmp")
+        tmp.write_bytes(data)
+        os.replace(tmp, path)
+        if self.disk_max_bytes:
+            self._prune_disk()
+
+    def _prune_disk(self):
+        files = [(p.stat(), p) for p in self.disk_dir.glob("*/*") if not p.name.endswith(".tmp")]
+        total = sum(st.st_size for st, _ in files)
+        for st, p in sorted(files, key=lambda item: item[0].st_mtime):
+            if total <= self.disk_max_bytes:
+                break
+            p.unlink(missing_ok=True)
+            total -= st.st_size
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._size,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_ratio": (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+            }
+
+
+results = ResultCache(config.CACHE_MAX_BYTES, config.CACHE_DIR or None, config.CACHE_DISK_MAX_BYTES)
@@ -0,0 +1,89 @@
+"""
+Pixelwise operations that combine several images into one.
+
+Inputs of different sizes are first brought to a common size by one of the
+ALIGNMENTS policies, then the operation is folded over them left to right:
+op(op(img1, img2), img3)... Every step after the first writes into the same
+output array.
+"""
+import cv2
+import numpy as np
+
+MAX_INPUTS = 16
+
+# how images of different sizes are brought to a common size
+ALIGNMENTS = ("resize-smaller", "resize-larger", "crop", "pad")
+
+
+class ComposeError(ValueError):
+    """Raised for an unknown operation or alignment, or a bad number of inputs."""
+
+
+def _add_weighted(a: np.ndarray, b: np.ndarray, alpha: float = 0.5, beta: float = 0.5, gamma: float = 0.0, dst=None):
+    return cv2.addWeighted(a, alpha, b, beta, gamma, dst=dst)
+
+
+def _plain(fn):
+    # the params-less OpenCV ops, with the same call shape as _add_weighted
+    return lambda a, b, dst=None: fn(a, b, dst=dst)
+
+
+# name -> fn(a, b, **params, dst=None); all saturate to the input dtype
+OPERATIONS = {
+    "and": _plain(cv2.bitwise_and),
+    "or": _plain(cv2.bitwise_or),
+    "xor": _plain(cv2.bitwise_xor),
+    "add": _plain(cv2.add),
+    "subtract": _plain(cv2.subtract),
+    "absdiff": _plain(cv2.absdiff),
+    "add-weighted": _add_weighted,
+}
+
+# form fields each operation takes
+PARAMS = {"add-weighted": ("alpha", "beta", "gamma")}
+
+
+def check(op: str, alignment: str, count: int | None = None):
+    if op not in OPERATIONS:
+        raise ComposeError(f"Unknown operation {op!r}. Use one of: {', '.join(OPERATIONS)}")
+    if alignment not in ALIGNMENTS:
+        raise ComposeError(f"Unknown alignment {alignment!r}. Use one of: {', '.join(ALIGNMENTS)}")
+    if count is not None and not 2 <= count <= MAX_INPUTS:
+        raise ComposeError(f"Send between 2 and {MAX_INPUTS} images, got {count}")
+
+
+def align(images: list[np.ndarray], alignment: str = "resize-smaller") -> list[np.ndarray]:
+    """
+    Brings images to one size: resized to the smallest or largest height and
+    width, cropped to the smallest, or zero-padded to the largest. Crop and
+    pad keep the top-left corner in place.
+    """
+    heights = [img.shape[0] for img in images]
+    widths = [img.shape[1] for img in images]
+    if len(set(heights)) == 1 and len(set(widths)) == 1:
+        return images
+
+    smaller = alignment in ("resize-smaller", "crop")
+    rows = min(heights) if smaller else max(heights)
+    cols = min(widths) if smaller else max(widths)
+    aligned = []
+    for img in images:
+        h, w = img.shape[:2]
+        if (h, w) == (rows, cols):
+            aligned.append(img)
+        elif alignment == "crop":
+            aligned.append(img[:rows, :cols])
+        elif alignment == "pad":
+            aligned.append(cv2.copyMakeBorder(img, 0, rows - h, 0, cols - w, cv2.BORDER_CONSTANT, value=0))
+        else:
+            aligned.append(cv2.resize(img, (cols, rows)))
+    return aligned
+
+
+def compose(images: list[np.ndarray], op: str, alignment: str = "resize-smaller", **params) -> np.ndarray:
+    fn = OPERATIONS[op]
+    first, *rest = align(images, alignment)
+    out = fn(first, rest[0], **params)
+    for img in rest[1:]:
+        fn(out, img, **params, dst=out)
+    return out
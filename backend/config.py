@@ -0,0 +1,97 @@
+import os
+
+
+def _int(name: str, default: int) -> int:
+    value = os.getenv(name)
+    return int(value) if value not in (None, "") else default
+
+
+def _float(name: str, default: float) -> float:
+    value = os.getenv(name)
+    return float(value) if value not in (None, "") else default
+
+
+# Worker pool used to run the CPU-bound OpenCV tasks off the event loop.
+# "thread" works well because OpenCV releases the GIL; "process" isolates
+# pure-numpy tasks that don't.
+POOL_KIND = os.getenv("PIXELS_POOL_KIND", "thread")
+POOL_SIZE = _int("PIXELS_POOL_SIZE", os.cpu_count() or 1)
+# Requests allowed to wait for a free worker before new ones are rejected.
+POOL_QUEUE_DEPTH = _int("PIXELS_POOL_QUEUE_DEPTH", 2 * POOL_SIZE)
+# Seconds a request waits for its task before giving up (0 disables).
+TASK_TIMEOUT = _float("PIXELS_TASK_TIMEOUT", 30.0)
+
+# Result cache for encoded task outputs. The disk tier is off unless a
+# directory is given.
+CACHE_MAX_BYTES = _int("PIXELS_CACHE_MAX_BYTES", 256 * 1024 * 1024)
+CACHE_DIR = os.getenv("PIXELS_CACHE_DIR", "")
+CACHE_DISK_MAX_BYTES = _int("PIXELS_CACHE_DISK_MAX_BYTES", 1024 * 1024 * 1024)
+
+# Decoded images uploaded through POST /api/images.
+IMAGE_STORE_MAX_BYTES = _int("PIXELS_IMAGE_STORE_MAX_BYTES", 512 * 1024 * 1024)
+IMAGE_TTL = _float("PIXELS_IMAGE_TTL", 600.0)
+
+# zlib level (0-9) for PNG responses that don't ask for one; -1 keeps the
+# OpenCV default.
+PNG_COMPRESSION = _int("PIXELS_PNG_COMPRESSION", -1)
+
+# /api/batch: images processed at once per batch request, and per request.
+BATCH_CONCURRENCY = _int("PIXELS_BATCH_CONCURRENCY", POOL_SIZE)
+BATCH_MAX_ITEMS = _int("PIXELS_BATCH_MAX_ITEMS", 1000)
+
+# Local-neighbourhood ops on images with at least this many pixels run in
+# horizontal bands whose temporaries fit in TILE_MEMORY_BYTES; TILE_WORKERS
+# bands are processed in parallel.
+TILE_MIN_PIXELS = _int("PIXELS_TILE_MIN_PIXELS", 4096 * 4096)
+TILE_MEMORY_BYTES = _int("PIXELS_TILE_MEMORY_BYTES", 256 * 1024 * 1024)
+TILE_WORKERS = _int("PIXELS_TILE_WORKERS", 1)
+
+# Request bodies larger than this are rejected with 413 while they stream in;
+# batch requests carry many images and get their own limit.
+MAX_UPLOAD_BYTES = _int("PIXELS_MAX_UPLOAD_BYTES", 100 * 1024 * 1024)
+MAX_BATCH_UPLOAD_BYTES = _int("PIXELS_MAX_BATCH_UPLOAD_BYTES", 2 * 1024 * 1024 * 1024)
+# Images whose header declares more pixels are rejected before decoding.
+MAX_IMAGE_PIXELS = _int("PIXELS_MAX_IMAGE_PIXELS", 200_000_000)
+
+# Threads used to decode the inputs of a multi-image task in parallel.
+DECODE_WORKERS = _int("PIXELS_DECODE_WORKERS", 4)
+
+# Segmentation model: loaded in the background at startup unless
+# SEGMENT_PRELOAD is 0 (then on the first request). Requests arriving within
+# SEGMENT_BATCH_WAIT seconds of each other share a forward pass of up to
+# SEGMENT_MAX_BATCH images; more than SEGMENT_QUEUE_DEPTH waiting are rejected.
+SEGMENT_PRELOAD = _int("PIXELS_SEGMENT_PRELOAD", 1)
+SEGMENT_MAX_BATCH = _int("PIXELS_SEGMENT_MAX_BATCH", 8)
+SEGMENT_BATCH_WAIT = _float("PIXELS_SEGMENT_BATCH_WAIT", 0.02)
+SEGMENT_QUEUE_DEPTH = _int("PIXELS_SEGMENT_QUEUE_DEPTH", 32)
+# Speed/quality tier used when a request doesn't pick one (see segment.TIERS),
+# torch intra-op threads for the model (0 keeps torch's default), and whether
+# models are TorchScript-compiled and frozen when loaded.
+SEGMENT_TIER = os.getenv("PIXELS_SEGMENT_TIER", "quality")
+SEGMENT_THREADS = _int("PIXELS_SEGMENT_THREADS", 0)
+SEGMENT_TORCHSCRIPT = _int("PIXELS_SEGMENT_TORCHSCRIPT", 0)
+
+# Preview mode (preview=true or max_side=N on a task): the longest side
+# previews are scaled down to when a request doesn't give max_side, and the
+# PNG compression level they are encoded with unless the request sets one.
+PREVIEW_MAX_SIDE = _int("PIXELS_PREVIEW_MAX_SIDE", 512)
+PREVIEW_PNG_COMPRESSION = _int("PIXELS_PREVIEW_PNG_COMPRESSION", 1)
+
+# Open /api/session WebSockets; each keeps its decoded image for as long as
+# it is connected.
+MAX_SESSIONS = _int("PIXELS_MAX_SESSIONS", 32)
+
+# Preview sizes (longest sides) that /api/progressive streams before the
+# full-size result when a request doesn't list its own levels.
+PROGRESSIVE_LEVELS = os.getenv("PIXELS_PROGRESSIVE_LEVELS", "256,1024")
+
+# /api/jobs: jobs allowed to wait before new ones are rejected, jobs run at
+# once, per-task caps on those ("task=n" pairs), the timeout of a job's task
+# (replacing TASK_TIMEOUT, 0 disables), and how long and how many bytes of
+# finished results are kept.
+JOB_QUEUE_DEPTH = _int("PIXELS_JOB_QUEUE_DEPTH", 256)
+JOB_CONCURRENCY = _int("PIXELS_JOB_CONCURRENCY", POOL_SIZE)
+JOB_LIMITS = os.getenv("PIXELS_JOB_LIMITS", "segment=1")
+JOB_TIMEOUT = _float("PIXELS_JOB_TIMEOUT", 600.0)
+JOB_TTL = _float("PIXELS_JOB_TTL", 3600.0)
+JOB_RESULTS_MAX_BYTES = _int("PIXELS_JOB_RESULTS_MAX_BYTES", 512 * 1024 * 1024)
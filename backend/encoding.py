@@ -0,0 +1,135 @@
+from io import BytesIO
+
+import cv2
+import numpy as np
+
+import config
+
+# format -> (imencode extension, media type)
+FORMATS = {
+    "png": (".png", "image/png"),
+    "jpeg": (".jpg", "image/jpeg"),
+    "webp": (".webp", "image/webp"),
+    # the result array itself, before any conversion to 8 bits
+    "npy": (".npy", "application/x-npy"),
+}
+ALIASES = {"jpg": "jpeg"}
+
+
+class EncodingError(ValueError):
+    """Raised for an unsupported format or out-of-range encoder option."""
+
+
+class EncodeOptions:
+    """
+    How a task result is encoded.
+
+    npy returns the raw result array (see NpyBuffer) instead of an image.
+    quality applies to jpeg and webp (1-100, webp 101 is lossless);
+    png_compression is the zlib level 0-9 where 0-1 are fastest. Options left
+    as None use the encoder defaults.
+    """
+
+    __slots__ = ("format", "quality", "png_compression")
+
+    def __init__(self, format: str = "png", quality: int | None = None, png_compression: int | None = None):
+        format = ALIASES.get(format, format)
+        if format not in FORMATS:
+            raise EncodingError(f"Unsupported format {format!r}. Use one of: {', '.join(FORMATS)}")
+        top = 101 if format == "webp" else 100
+        if quality is not None and not 1 <= quality <= top:
+            raise EncodingError(f"quality must be between 1 and {top}" + (" for webp" if format == "webp" else ""))
+        if png_compression is not None and not 0 <= png_compression <= 9:
+            raise EncodingError("png_compression must be between 0 and 9")
+        self.format = format
+        self.quality = quality
+        self.png_compression = png_compression
+
+    @property
+    def extension(self) -> str:
+        return FORMATS[self.format][0]
+
+    @property
+    def media_type(self) -> str:
+        return FORMATS[self.format][1]
+
+    @property
+    def raw(self) -> bool:
+        return self.format == "npy"
+
+    def imencode_params(self) -> list[int]:
+        if self.format == "png" and self.png_compression is not None:
+            return [cv2.IMWRITE_PNG_COMPRESSION, self.png_compression]
+        if self.format == "jpeg" and self.quality is not None:
+            return [cv2.IMWRITE_JPEG_QUALITY, self.quality]
+        if self.format == "webp" and self.quality is not None:
+            return [cv2.IMWRITE_WEBP_QUALITY, self.quality]
+        return []
+
+    def key(self) -> tuple:
+        """Identifies the encoded output for cache keys."""
+        return (self.format, self.quality, self.png_compression)
+
+
+DEFAULT = EncodeOptions()
+
+# bytes of the array handed to the server per chunk when streaming a NpyBuffer
+CHUNK_SIZE = 1024 * 1024
+
+
+class NpyBuffer:
+    """
+    A result array in .npy format that is streamed straight out of the
+    array's memory, so the only copy made is the one into the socket.
+    getvalue() mirrors BytesIO for callers that need the whole file at once.
+    """
+
+    def __init__(self, array: np.ndarray):
+        self.array = np.ascontiguousarray(array)
+        header = BytesIO()
+        np.lib.format.write_array_header_1_0(header, np.lib.format.header_data_from_array_1_0(self.array))
+        self.header = header.getvalue()
+
+    def __len__(self) -> int:
+        return len(self.header) + self.array.nbytes
+
+    def chunks(self):
+        yield self.header
+        view = memoryview(self.array).cast("B")
+        for start in range(0, len(view), CHUNK_SIZE):
+            yield view[start:start + CHUNK_SIZE]
+
+    def getvalue(self) -> bytes:
+        return b"".join(self.chunks())
+
+
+def _accepted_formats(accept: str) -> list[str]:
+    """Formats named in an Accept header, best first. Wildcards are ignored."""
+    ranked = []
+    for position, item in enumerate(accept.split(",")):
+        media_type, *params = [part.strip() for part in item.split(";")]
+        q = 1.0
+        for param in params:
+            if param.startswith("q="):
+                try:
+                    q = float(param[2:])
+                except ValueError:
+                    q = 0.0
+        for name, (_, media) in FORMATS.items():
+            if media == media_type.lower() and q > 0:
+                ranked.append((-q, position, name))
+    return [name for _, _, name in sorted(ranked)]
+
+
+def negotiate(format: str | None = None, quality: int | None = None, png_compression: int | None = None,
+              accept: str | None = None) -> EncodeOptions:
+    """
+    Picks the output encoding for a request: an explicit format wins,
+    otherwise the best image type the Accept header names, otherwise PNG.
+    """
+    if not format:
+        accepted = _accepted_formats(accept) if accept else []
+        format = accepted[0] if accepted else "png"
+    if png_compression is None and config.PNG_COMPRESSION >= 0:
+        png_compression = config.PNG_COMPRESSION
+    return EncodeOptions(format, quality, png_compression)
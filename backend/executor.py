@@ -0,0 +1,105 @@
+import asyncio
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from contextvars import ContextVar
+from functools import partial
+
+import config
+import metrics
+
+
+class PoolSaturated(Exception):
+    """Raised when the pool and its wait queue are both full."""
+
+
+class TaskTimeout(Exception):
+    """Raised when a task does not finish within the configured timeout."""
+
+
+_pool: Executor | None = None
+_in_flight = 0
+# set by work that may take longer than a request, such as jobs.py
+_timeout: ContextVar[float | None] = ContextVar("pixels_task_timeout", default=None)
+
+
+def get_pool() -> Executor:
+    global _pool
+    if _pool is None:
+        if config.POOL_KIND == "process":
+            _pool = ProcessPoolExecutor(max_workers=config.POOL_SIZE)
+        elif config.POOL_KIND == "thread":
+            _pool = ThreadPoolExecutor(max_workers=config.POOL_SIZE, thread_name_prefix="pixels-task")
+        else:
+            raise ValueError(f"Unknown pool kind: {config.POOL_KIND!r}. Use 'thread' or 'process'.")
+    return _pool
+
+
+def shutdown():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+def capacity() -> int:
+    return config.POOL_SIZE + config.POOL_QUEUE_DEPTH
+
+
+def in_flight() -> int:
+    return _in_flight
+
+
+def timeout() -> float | None:
+    """Seconds the current request (or job) waits for its task, None for no limit."""
+    seconds = _timeout.get()
+    return (config.TASK_TIMEOUT if seconds is None else seconds) or None
+
+
+def set_timeout(seconds: float):
+    """Overrides TASK_TIMEOUT for the rest of the current asyncio task (0 disables)."""
+    _timeout.set(seconds)
+
+
+def _release(_future):
+    global _in_flight
+    _in_flight -= 1
+
+
+def _picklable(arg):
+    # memory-mapped uploads can't be pickled across to the workers
+    if isinstance(arg, memoryview):
+        return bytes(arg)
+    if isinstance(arg, tuple):
+        return tuple(_picklable(item) for item in arg)
+    return arg
+
+
+async def run(fn, *args, **kwargs):
+    """
+    Runs fn(*args, **kwargs) on the worker pool and awaits its result.
+
+    A slot is held until the work actually finishes, even if the caller
+    timed out, so abandoned tasks still count against the queue depth.
+    """
+    global _in_flight
+    if _in_flight >= capacity():
+        raise PoolSaturated(f"{_in_flight} tasks already queued or running")
+
+    if config.POOL_KIND == "process":
+        args = tuple(_picklable(arg) for arg in args)
+
+    loop = asyncio.get_running_loop()
+    submitted = time.monotonic()
+    future = loop.run_in_executor(get_pool(), partial(metrics.collect, fn, *args, **kwargs))
+    _in_flight += 1
+    future.add_done_callback(_release)
+
+    seconds = timeout()
+    try:
+        # shield() keeps a timeout from cancelling the executor future, which
+        # would release the slot while the worker is still busy.
+        result, stages, started = await asyncio.wait_for(asyncio.shield(future), seconds)
+    except asyncio.TimeoutError:
+        raise TaskTimeout(f"task did not finish within {seconds:g}s")
+    metrics.record_stages(stages, queued=max(0.0, started - submitted))
+    return result
@@ -0,0 +1,74 @@
+import threading
+import time
+from collections import OrderedDict
+
+import config
+from tasks import DecodedImage
+
+
+class ImageStore:
+    """
+    Decoded uploads kept in memory so repeated requests on the same image
+    skip cv2.imdecode.
+
+    Entries are evicted least-recently-used once their total size exceeds
+    max_bytes, and dropped when they have not been used for ttl seconds.
+    """
+
+    def __init__(self, max_bytes: int, ttl: float):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries: OrderedDict[str, tuple[DecodedImage, float]] = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def _expire(self, now: float):
+        while self._entries:
+            key, (image, last_used) = next(iter(self._entries.items()))
+            if now - last_used <= self.ttl:
+                break
+            del self._entries[key]
+            self._size -= image.nbytes
+
+    def get(self, image_id: str) -> DecodedImage | None:
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            entry = self._entries.get(image_id)
+            if entry is None:
+                return None
+            self._entries[image_id] = (entry[0], now)
+            self._entries.move_to_end(image_id)
+            return entry[0]
+
+    def put(self, image_id: str, image: DecodedImage) -> bool:
+        """Stores the image; returns False if it is larger than the whole store."""
+        if image.nbytes > self.max_bytes:
+            return False
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            old = self._entries.pop(image_id, None)
+            if old is not None:
+                self._size -= old[0].nbytes
+            self._entries[image_id] = (image, now)
+            self._size += image.nbytes
+            while self._size > self.max_bytes:
+                _, (evicted, _) = self._entries.popitem(last=False)
+                self._size -= evicted.nbytes
+        return True
+
+    def delete(self, image_id: str) -> bool:
+        with self._lock:
+            entry = self._entries.pop(image_id, None)
+            if entry is None:
+                return False
+            self._size -= entry[0].nbytes
+            return True
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self._size, "max_bytes": self.max_bytes}
+
+
+images = ImageStore(config.IMAGE_STORE_MAX_BYTES, config.IMAGE_TTL)
@@ -0,0 +1,208 @@
+"""
+Background jobs, for tasks that may outlast the client's or a proxy's
+patience. POST /api/jobs queues one and answers at once with its id;
+GET /api/jobs/{id} answers 202 with its status until the result is ready,
+then returns the result.
+
+Queued jobs run highest priority first, oldest first within a priority. At
+most JOB_CONCURRENCY run at once, and JOB_LIMITS caps individual tasks
+(e.g. "segment=1") so slow ones can't take every slot: a job whose task is at
+its limit lets lower-priority jobs of other tasks go ahead. A job that finds
+the server busy (503) goes back in the queue and is tried again later.
+
+Finished jobs are kept for JOB_TTL seconds, oldest dropped first once their
+results exceed JOB_RESULTS_MAX_BYTES. Everything lives in this process, so
+jobs don't survive a restart and, with several uvicorn workers, are only
+known to the worker that accepted them.
+"""
+import asyncio
+import heapq
+import itertools
+import time
+import uuid
+from collections import OrderedDict
+
+import config
+import executor
+
+QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "failed"
+# tries for a job that keeps finding the server busy
+MAX_ATTEMPTS = 5
+
+
+class QueueFull(Exception):
+    """Raised when JOB_QUEUE_DEPTH jobs are already waiting."""
+
+
+def parse_limits(value: str) -> dict[str, int]:
+    """Per-task limits from "task=n" pairs, e.g. "segment=1,hough-circles=2"."""
+    limits = {}
+    for pair in value.split(","):
+        if pair.strip():
+            task, _, limit = pair.partition("=")
+            limits[task.strip()] = int(limit)
+    return limits
+
+
+class Job:
+    """
+    One queued task. run() computes it and returns (media_type, body), or
+    raises an exception with status_code and detail attributes such as
+    HTTPException.
+    """
+
+    def __init__(self, task: str, run, priority: int = 0):
+        self.id = uuid.uuid4().hex
+        self.task = task
+        self.run = run
+        self.priority = priority
+        self.status = QUEUED
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.attempts = 0
+        self.media_type = None
+        self.result = None
+        self.error = None
+
+    def info(self) -> dict:
+        info = {"job_id": self.id, "task": self.task, "status": self.status, "priority": self.priority,
+                "created": self.created, "started": self.started, "finished": self.finished}
+        if self.status == DONE:
+            info.update(media_type=self.media_type, bytes=len(self.result))
+        elif self.status == FAILED:
+            info["error"] = self.error
+        return info
+
+
+class JobQueue:
+    """The jobs of this process. Only used from the event loop, so it needs no locks."""
+
+    def __init__(self, concurrency: int, limits: dict[str, int], max_queued: int, ttl: float, max_bytes: int):
+        self.concurrency = max(concurrency, 1)
+        self.limits = limits
+        self.max_queued = max_queued
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._jobs: dict[str, Job] = {}
+        self._heap = []
+        self._order = itertools.count()
+        self._queued = 0
+        self._running: dict[str, int] = {}
+        self._tasks: set[asyncio.Task] = set()
+        self._finished: OrderedDict[str, float] = OrderedDict()
+        self._size = 0
+
+    def submit(self, task: str, run, priority: int = 0) -> Job:
+        if self._queued >= self.max_queued:
+            raise QueueFull(f"{self._queued} jobs already queued")
+        job = Job(task, run, priority)
+        self._jobs[job.id] = job
+        self._enqueue(job)
+        return job
+
+    def get(self, job_id: str) -> Job | None:
+        self._expire(time.monotonic())
+        return self._jobs.get(job_id)
+
+    def delete(self, job_id: str) -> bool:
+        """Forgets a queued or finished job; running ones can't be interrupted."""
+        job = self.get(job_id)
+        if job is None or job.status == RUNNING:
+            return False
+        del self._jobs[job_id]
+        if job.status == QUEUED:
+            # its heap entry is skipped when it comes up; drop the image now
+            self._queued -= 1
+            job.run = None
+        else:
+            self._forget(job)
+        return True
+
+    def stats(self) -> dict:
+        self._expire(time.monotonic())
+        return {"queued": self._queued, "running": sum(self._running.values()), "running_by_task": dict(self._running),
+                "finished": len(self._finished), "result_bytes": self._size, "concurrency": self.concurrency,
+                "limits": self.limits}
+
+    def shutdown(self):
+        for task in self._tasks:
+            task.cancel()
+
+    def _enqueue(self, job: Job):
+        self._queued += 1
+        self._push(job)
+
+    def _push(self, job: Job):
+        heapq.heappush(self._heap, (-job.priority, next(self._order), job))
+        self._dispatch()
+
+    def _dispatch(self):
+        deferred = []
+        while self._heap and sum(self._running.values()) < self.concurrency:
+            entry = heapq.heappop(self._heap)
+            job = entry[2]
+            if self._jobs.get(job.id) is not job or job.status != QUEUED:
+                continue
+            if self._running.get(job.task, 0) >= self.limits.get(job.task, self.concurrency):
+                deferred.append(entry)
+                continue
+            self._queued -= 1
+            self._running[job.task] = self._running.get(job.task, 0) + 1
+            task = asyncio.create_task(self._run(job))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        for entry in deferred:
+            heapq.heappush(self._heap, entry)
+
+    async def _run(self, job: Job):
+        executor.set_timeout(config.JOB_TIMEOUT)
+        job.status = RUNNING
+        job.started = job.started or time.time()
+        job.attempts += 1
+        retry = None
+        try:
+            job.media_type, job.result = await job.run()
+            job.status = DONE
+        except Exception as e:
+            status = getattr(e, "status_code", 500)
+            if status == 503 and job.attempts < MAX_ATTEMPTS:
+                retry = float((getattr(e, "headers", None) or {}).get("Retry-After", 1))
+            else:
+                job.status = FAILED
+                job.error = {"status": status, "detail": getattr(e, "detail", str(e))}
+        finally:
+            self._running[job.task] -= 1
+            if not self._running[job.task]:
+                del self._running[job.task]
+        if retry is not None:
+            # counts as queued while it waits, so it can be deleted
+            job.status = QUEUED
+            self._queued += 1
+            self._dispatch()
+            await asyncio.sleep(retry)
+            if self._jobs.get(job.id) is job:
+                self._push(job)
+            return
+        job.finished = time.time()
+        job.run = None
+        if self._jobs.get(job.id) is job:
+            self._finished[job.id] = time.monotonic()
+            self._size += len(job.result or b"")
+            self._expire(time.monotonic())
+        self._dispatch()
+
+    def _forget(self, job: Job):
+        if self._finished.pop(job.id, None) is not None:
+            self._size -= len(job.result or b"")
+
+    def _expire(self, now: float):
+        while self._finished:
+            job_id, finished = next(iter(self._finished.items()))
+            if now - finished <= self.ttl and self._size <= self.max_bytes:
+                break
+            self._forget(self._jobs.pop(job_id))
+
+
+queue = JobQueue(config.JOB_CONCURRENCY, parse_limits(config.JOB_LIMITS), config.JOB_QUEUE_DEPTH, config.JOB_TTL,
+                 config.JOB_RESULTS_MAX_BYTES)
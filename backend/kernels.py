@@ -0,0 +1,81 @@
+"""
+Convolution kernels and structuring elements, built once and shared.
+
+element() memoizes morphology elements by shape and size, or parses a custom
+one from text like "0,1,0;1,1,1;0,1,0" (rows separated by ";"). The arrays
+are read-only since every request gets the same object.
+
+A full rectangle needs no decomposing here: OpenCV recognizes it and runs it
+as a row pass and a column pass (a 31x31 dilate of a 4K image takes ~8 ms,
+two explicit 1-D dilates ~11 ms).
+"""
+from functools import lru_cache
+
+import cv2
+import numpy as np
+
+SHAPES = {"rect": cv2.MORPH_RECT, "ellipse": cv2.MORPH_ELLIPSE, "cross": cv2.MORPH_CROSS}
+MAX_CUSTOM_SIDE = 63
+
+
+class KernelError(ValueError):
+    """Raised for an unknown element shape or a malformed custom kernel."""
+
+
+def _frozen(kernel: np.ndarray) -> np.ndarray:
+    kernel = np.ascontiguousarray(kernel)
+    kernel.flags.writeable = False
+    return kernel
+
+
+PREWITT_X = _frozen(np.array([[1, 0, -1], [1, 0, -1], [1, 0, -1]], dtype=np.float32))
+PREWITT_Y = _frozen(np.array([[1, 1, 1], [0, 0, 0], [-1, -1, -1]], dtype=np.float32))
+# 1 must be foreground, -1 background, 0 either
+HIT_MISS = _frozen(np.array([[0, 1, 0], [1, -1, 1], [0, 1, 0]], dtype=np.int8))
+
+
+@lru_cache(maxsize=256)
+def parse(spec: str, values: tuple = (0, 1)) -> np.ndarray:
+    """A kernel from comma-separated values in ";"-separated rows."""
+    try:
+        rows = [[int(value) for value in row.split(",")] for row in spec.strip().strip(";").split(";")]
+    except ValueError:
+        raise KernelError(f"Kernel values must be integers, e.g. '0,1,0;1,1,1;0,1,0', got {spec!r}")
+    if len({len(row) for row in rows}) != 1:
+        raise KernelError("Every kernel row must have the same number of values")
+    if len(rows) > MAX_CUSTOM_SIDE or len(rows[0]) > MAX_CUSTOM_SIDE:
+        raise KernelError(f"Kernels may be at most {MAX_CUSTOM_SIDE}x{MAX_CUSTOM_SIDE}")
+    kernel = np.array(rows)
+    if not np.isin(kernel, values).all():
+        raise KernelError(f"Kernel values must be one of {', '.join(map(str, values))}")
+    if not kernel.any():
+        raise KernelError("Kernel must have at least one non-zero value")
+    return _frozen(kernel.astype(np.int8 if min(values) < 0 else np.uint8))
+
+
+@lru_cache(maxsize=256)
+def element(shape: str = "rect", size: int = 3, spec: str = "") -> np.ndarray:
+    """A size x size structuring element, or the parsed spec when shape is "custom"."""
+    if shape == "custom":
+        if not spec:
+            raise KernelError("A custom shape needs a kernel, e.g. '0,1,0;1,1,1;0,1,0'")
+        return parse(spec)
+    if shape not in SHAPES:
+        raise KernelError(f"Unknown shape {shape!r}. Use one of: {', '.join(SHAPES)}, custom")
+    if size < 1:
+        raise KernelError("Kernel size must be at least 1")
+    return _frozen(cv2.getStructuringElement(SHAPES[shape], (size, size)))
+
+
+def hit_miss(spec: str = "") -> np.ndarray:
+    return parse(spec, (-1, 0, 1)) if spec else HIT_MISS
+
+
+def check(shape: str, spec: str = "", size: int = 3):
+    """Raises KernelError for a bad shape or kernel, before any work is queued."""
+    element(shape, size, spec)
+
+
+def radius(shape: str = "rect", size: int = 3, spec: str = "") -> int:
+    """Rows of neighbourhood above and below the anchor."""
+    return element(shape, max(int(size), 1), spec).shape[0] // 2
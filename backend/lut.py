@@ -0,0 +1,57 @@
+"""
+Lookup tables for point transforms: 8-bit to 8-bit mappings where each
+output pixel depends only on the input pixel's value.
+
+Each table is computed once per set of parameters by running the transform's
+formula over all 256 input values, with the same dtypes the per-pixel version
+used, so applying the table gives identical output. Applying a table is a
+single cv2.LUT pass over the image (per channel for colour images), and
+consecutive transforms collapse into one table with chain().
+"""
+from functools import lru_cache
+
+import cv2
+import numpy as np
+
+_VALUES = np.arange(256, dtype=np.uint8)
+
+
+def _frozen(table: np.ndarray) -> np.ndarray:
+    # tables are memoized and shared, so nothing may write into them
+    table = np.ascontiguousarray(table, dtype=np.uint8)
+    table.flags.writeable = False
+    return table
+
+
+@lru_cache(maxsize=None)
+def negative() -> np.ndarray:
+    return _frozen(255 - _VALUES)
+
+
+@lru_cache(maxsize=None)
+def log() -> np.ndarray:
+    c = 255 / np.log(1 + 255)  # log(256)
+    return _frozen(np.uint8(c * np.log1p(_VALUES)))
+
+
+@lru_cache(maxsize=None)
+def inverse_log() -> np.ndarray:
+    c = 255 / (np.exp(1) - 1)
+    return _frozen(np.uint8(c * np.expm1(_VALUES / 255.0)))
+
+
+@lru_cache(maxsize=256)
+def power_law(gamma: float = 1.0) -> np.ndarray:
+    return _frozen(np.uint8(255 * np.power(_VALUES / 255.0, gamma)))
+
+
+def chain(*tables: np.ndarray) -> np.ndarray:
+    """One table equivalent to applying tables in order."""
+    combined = tables[0]
+    for table in tables[1:]:
+        combined = table[combined]
+    return combined
+
+
+def apply(img: np.ndarray, table: np.ndarray) -> np.ndarray:
+    return cv2.LUT(img, table)
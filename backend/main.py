@@ -1,11 +1,43 @@
-from fastapi import FastAPI, UploadFile, File, HTTPException, Form
-from fastapi.responses import StreamingResponse
+import asyncio
+import json
+from contextlib import asynccontextmanager
+
+from fastapi import FastAPI, UploadFile, File, HTTPException, Form, Depends, Request, WebSocket
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 # from img_upload_utils import upload_image_to_azure
+import batch
+import cache
+import compose
+import config
+import encoding
+import executor
+import image_store
+import jobs
+import kernels
+import metrics
+import ops
+import pipeline
+import progressive
+import segment
+import sessions
 import tasks
+from uploads import Upload, UploadGroup, UploadLimitMiddleware, buffer_upload, preview_side, read_upload, read_uploads
 import numpy as np
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    executor.get_pool()
+    if config.SEGMENT_PRELOAD:
+        segment.start()
+    yield
+    jobs.queue.shutdown()
+    segment.shutdown()
+    executor.shutdown()
+
+
+app = FastAPI(lifespan=lifespan)
 
 origins = ["*"]
 
@@ -16,6 +48,23 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(UploadLimitMiddleware)
+# added last so it is outermost and also times requests the upload limit rejects
+app.add_middleware(metrics.MetricsMiddleware)
+
+metrics.Gauge("pixels_pool_tasks_in_flight", "Tasks queued or running on the worker pool.", function=executor.in_flight)
+metrics.Gauge("pixels_pool_capacity", "Tasks the worker pool accepts before answering 503.", function=executor.capacity)
+metrics.Gauge("pixels_cache_bytes", "Bytes held by the in-memory result cache.",
+              function=lambda: cache.results.stats()["bytes"])
+metrics.Gauge("pixels_cache_hit_ratio", "Share of result cache lookups answered from memory or disk.",
+              function=lambda: cache.results.stats()["hit_ratio"])
+metrics.Gauge("pixels_image_store_bytes", "Bytes held by decoded images from POST /api/images.",
+              function=lambda: image_store.images.stats()["bytes"])
+metrics.Gauge("pixels_jobs_queued", "Jobs waiting to run.", function=lambda: jobs.queue.stats()["queued"])
+metrics.Gauge("pixels_jobs_running", "Jobs running.", function=lambda: jobs.queue.stats()["running"])
+metrics.Gauge("pixels_sessions_active", "Open /api/session WebSockets.", function=sessions.active)
+metrics.Gauge("pixels_segment_queued", "Images waiting for the segmentation model.",
+              function=lambda: segment.status()["queued"])
 
 
 
@@ -23,6 +72,130 @@ app.add_middleware(
 async def root():
     return {"message": "Backend is up and running"}
 
+
+def _etag_matches(request, etag: str) -> bool:
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    candidates = [tag.strip().removeprefix("W/") for tag in header.split(",")]
+    return "*" in candidates or etag in candidates
+
+
+async def run_in_pool(fn, *args, error: str = "process failed", **kwargs):
+    """Runs fn on the worker pool, translating failures into HTTP errors."""
+    try:
+        return await executor.run(fn, *args, **kwargs)
+    except executor.PoolSaturated:
+        raise HTTPException(status_code=503, detail="Server is busy, try again shortly", headers={"Retry-After": "1"})
+    except executor.TaskTimeout as e:
+        raise HTTPException(status_code=504, detail=f"{error}: {str(e)}")
+    except tasks.ImageTooLarge as e:
+        raise HTTPException(status_code=413, detail=f"{error}: {str(e)}")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"{error}: {str(e)}")
+
+
+async def run_task(upload: Upload, fn, *args, error: str = "process failed", media_type: str | None = None,
+                   headers: dict | None = None, cacheable: bool = True, runner=None):
+    """
+    Runs fn(upload.source, *args, encoding=upload.encoding) on the worker pool
+    so the event loop stays free, and returns its output.
+
+    runner replaces run_in_pool for tasks that schedule their own work.
+    Results of deterministic tasks are cached by (image hash, task, params,
+    encoding) and tagged with that key as their ETag, so a repeated request is
+    answered from the cache, or with 304 when the client already holds the result.
+    """
+    runner = runner or run_in_pool
+    media_type = media_type or upload.encoding.media_type
+    headers = {"Vary": "Accept", **(headers or {})}
+    if upload.encoding.raw and media_type == upload.encoding.media_type:
+        # raw arrays are streamed from the result's memory and never cached;
+        # they are much larger than encoded images
+        output = await runner(fn, upload.source, *args, encoding=upload.encoding, error=error)
+        headers["Content-Length"] = str(len(output))
+        return StreamingResponse(output.chunks(), media_type=media_type, headers=headers)
+
+    data = None
+    key = None
+    if cacheable:
+        parts = [args, upload.encoding.key()] + ([upload.max_side] if upload.max_side else [])
+        key = cache.make_key(upload.digest, f"{fn.__module__}.{fn.__qualname__}", parts)
+        headers["ETag"] = f'"{key}"'
+        if _etag_matches(upload.request, headers["ETag"]):
+            return Response(status_code=304, headers=headers)
+        data = cache.results.get(key)
+        if data is None and cache.results.disk_dir is not None:
+            data = await asyncio.to_thread(cache.results.get_disk, key)
+        headers["X-Cache"] = "HIT" if data is not None else "MISS"
+        metrics.CACHE_LOOKUPS.inc(result="hit" if data is not None else "miss")
+
+    if data is None:
+        output = await runner(fn, upload.source, *args, encoding=upload.encoding, error=error)
+        data = output.getvalue()
+        if key is not None:
+            cache.results.put(key, data)
+            if cache.results.disk_dir is not None:
+                await asyncio.to_thread(cache.results.put_disk, key, data)
+    return Response(data, media_type=media_type, headers=headers)
+
+
+async def run_op(upload: Upload, name: str, error: str = "process failed", **params):
+    """Runs the ops.OPERATIONS entry registered as name on the upload."""
+    return await run_task(upload, tasks.run_operation, name, params, error=error,
+                          cacheable=name not in ops.NONDETERMINISTIC)
+
+
+async def run_morph(upload: Upload, name: str, shape: str, kernel: str, error: str = "process failed", **params):
+    """run_op for the ops that take a structuring element, checked before the work is queued."""
+    try:
+        kernels.check(shape, kernel)
+    except kernels.KernelError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return await run_op(upload, name, error=error, shape=shape, kernel=kernel, **params)
+
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    return Response(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/api/cache/stats")
+async def cache_stats():
+    return cache.results.stats()
+
+
+@app.post("/api/images")
+async def upload_image(file: UploadFile = File(...)):
+    """
+    Decodes an image once and keeps it in memory. Pass the returned image_id
+    instead of a file to any task endpoint to skip the upload and decode.
+    """
+    image_id, image = await store_image(buffer_upload(file))
+    height, width = image.bgr.shape[:2]
+    return {"image_id": image_id, "width": width, "height": height, "ttl": image_store.images.ttl}
+
+
+async def store_image(contents: bytes | memoryview) -> tuple[str, tasks.DecodedImage]:
+    """Decodes an image into the image store, unless it is already there, and returns its id."""
+    image_id = cache.digest(contents)
+    image = image_store.images.get(image_id)
+    if image is None:
+        image = await run_in_pool(tasks.DecodedImage.from_bytes, contents, error="Upload failed")
+        if not image_store.images.put(image_id, image):
+            raise HTTPException(status_code=413, detail="Image is too large to keep in memory")
+    return image_id, image
+
+@app.delete("/api/images/{image_id}")
+async def delete_image(image_id: str):
+    if not image_store.images.delete(image_id):
+        raise HTTPException(status_code=404, detail="Unknown or expired image_id")
+    return {"deleted": image_id}
+
+@app.get("/api/images/stats")
+async def image_store_stats():
+    return image_store.images.stats()
+
 # @app.post("/api/upload")
 # async def upload_image(file: UploadFile = File(...)):
 #     try:
@@ -33,413 +206,522 @@ async def root():
 #         raise HTTPException(status_code=500, detail=f"Upload failed: {str(e)}")
 
 @app.post("/api/task/negative")
-async def negative(file: UploadFile = File(...)):
-    try:
-        contents = await file.read()
-        negative = tasks.get_negative(contents)
-        return StreamingResponse(negative, media_type="image/png")
-
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"process failed: {str(e)}")
+async def negative(upload: Upload = Depends(read_upload)):
+    return await run_op(upload, "negative")
     
 
 @app.post("/api/task/rgb-channels")
-async def rgb_channels(file: UploadFile = File(...)):
+async def rgb_channels(upload: Upload = Depends(read_upload)):
     """
     Accepts an image, separates RGB channels, and returns 3 color-isolated images in a ZIP file.
     """
-    image_bytes = await file.read()
-    result_zip = tasks.get_rgb_channels(image_bytes)
-    return StreamingResponse(result_zip, media_type="application/zip", headers={
+    return await run_task(upload, tasks.get_rgb_channels, media_type="application/zip", headers={
         "Content-Disposition": "attachment; filename=rgb_channels.zip"
     })
 
 @app.post("/api/task/resize")
-async def resize(file: UploadFile = File(...)):
-    try:
-        contents = await file.read()
-        resize = tasks.get_resized(contents)
-        return StreamingResponse(resize, media_type="image/png")
-
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"process failed: {str(e)}")
+async def resize(upload: Upload = Depends(read_upload)):
+    return await run_op(upload, "resize")
 
 
 @app.post("/api/task/grayscale")
-async def grayscale(file: UploadFile = File(...)):
-    try:
-        contents = await file.read()
-        grayscale = tasks.get_grayscale(contents)
-        return StreamingResponse(grayscale, media_type="image/png")
-
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"process failed: {str(e)}")
+async def grayscale(upload: Upload = Depends(read_upload)):
+    return await run_op(upload, "grayscale")
 
 
 @app.post("/api/task/binary")
-async def resize(file: UploadFile = File(...)):
+async def resize(upload: Upload = Depends(read_upload)):
+    return await run_op(upload, "binary")
+
+async def run_compose(uploads: UploadGroup, op: str, alignment: str, params: dict | None = None):
+    """Runs a compose.OPERATIONS entry over every image of the group."""
     try:
-        contents = await file.read()
-        resize = tasks.get_binary(contents)
-        return StreamingResponse(resize, media_type="image/png")
+        compose.check(op, alignment, len(uploads.uploads))
+    except compose.ComposeError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return await run_task(uploads, tasks.get_composite, op, alignment, params or {}, error=f"{op} failed")
 
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"process failed: {str(e)}")
 
-# fix this endpoint  
 @app.post("/api/task/bitwise-and")
-async def resize(file: UploadFile = File(...)):
-    try:
-        contents = await file.read()
-        resize = tasks.get_bitwise_and(contents)
-        return StreamingResponse(resize, media_type="image/png")
-
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"process failed: {str(e)}")
+async def bitwise_and(uploads: UploadGroup = Depends(read_uploads), alignment: str = Form("resize-smaller")):
+    return await run_compose(uploads, "and", alignment)
 
-# fix this endpoint
 @app.post("/api/task/bitwise-or")
-async def resize(file: UploadFile = File(...)):
-    try:
-        contents = await file.read()
-        resize = tasks.get_bitwise_or(contents)
-        return StreamingResponse(resize, media_type="image/png")
-
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"process failed: {str(e)}")
+async def bitwise_or(uploads: UploadGroup = Depends(read_uploads), alignment: str = Form("resize-smaller")):
+    return await run_compose(uploads, "or", alignment)
 
-#fix this endpoint 
 @app.post("/api/task/bitwise-xor")
-async def resize(file: UploadFile = File(...)):
-    try:
-        contents = await file.read()
-        resize = tasks.get_bitwise_xor(contents)
-        return StreamingResponse(resize, media_type="image/png")
+async def bitwise_xor(uploads: UploadGroup = Depends(read_uploads), alignment: str = Form("resize-smaller")):
+    return await run_compose(uploads, "xor", alignment)
 
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"process failed: {str(e)}")
-    
+@app.post("/api/compose/{op}")
+async def compose_images(op: str, uploads: UploadGroup = Depends(read_uploads),
+                         alignment: str = Form("resize-smaller"), alpha: float | None = Form(None),
+                         beta: float | None = Form(None), gamma: float | None = Form(None)):
+    """Combines two or more images with and, or, xor, add, subtract, absdiff or add-weighted."""
+    given = {"alpha": alpha, "beta": beta, "gamma": gamma}
+    params = {name: given[name] for name in compose.PARAMS.get(op, ()) if given[name] is not None}
+    return await run_compose(uploads, op, alignment, params)
 
-@app.post("/api/task/log-transformation")
-async def resize(file: UploadFile = File(...)):
-    try:
-        contents = await file.read()
-        resize = tasks.get_log_transformation(contents)
-        return StreamingResponse(resize, media_type="image/png")
 
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"process failed: {str(e)}")
+@app.post("/api/task/log-transformation")
+async def resize(upload: Upload = Depends(read_upload)):
+    return await run_op(upload, "log-transformation")
     
 
 @app.post("/api/task/inverse-log-transformation")
-async def resize(file: UploadFile = File(...)):
-    try:
-        contents = await file.read()
-        resize = tasks.get_inverse_log_transformation(contents)
-        return StreamingResponse(resize, media_type="image/png")
-
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"process failed: {str(e)}")
+async def resize(upload: Upload = Depends(read_upload)):
+    return await run_op(upload, "inverse-log-transformation")
     
 
 @app.post("/api/task/power-law-transformation")
-async def resize(file: UploadFile = File(...)):
-    try:
-        contents = await file.read()
-        resize = tasks.get_power_law_transformation(contents)
-        return StreamingResponse(resize, media_type="image/png")
-
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"process failed: {str(e)}")
+async def resize(upload: Upload = Depends(read_upload)):
+    return await run_op(upload, "power-law-transformation", gamma=0.5)
     
 @app.post("/api/task/shear-image-horizontal")
-async def horizontal_shear(file: UploadFile = File(...), shear_x: float = Form(1.0)):
-    try:
-        contents = await file.read()
-        output = tasks.get_horizontal_sheared_image(contents, shear_x)
-        return StreamingResponse(output, media_type="image/png")
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Horizontal shearing failed: {str(e)}")
+async def horizontal_shear(upload: Upload = Depends(read_upload), shear_x: float = Form(1.0)):
+    return await run_op(upload, "shear-image-horizontal", shear_x=shear_x, error="Horizontal shearing failed")
 
 @app.post("/api/task/shear-image-vertical")
-async def vertical_shear(file: UploadFile = File(...), shear_y: float = Form(1.0)):
-    try:
-        contents = await file.read()
-        output = tasks.get_vertical_sheared_image(contents, shear_y)
-        return StreamingResponse(output, media_type="image/png")
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Vertical shearing failed: {str(e)}")
+async def vertical_shear(upload: Upload = Depends(read_upload), shear_y: float = Form(1.0)):
+    return await run_op(upload, "shear-image-vertical", shear_y=shear_y, error="Vertical shearing failed")
 
 @app.post("/api/task/laplacian-filter")
-async def laplacian_filter(file: UploadFile = File(...)):
-    try:
-        contents = await file.read()
-        resize = tasks.get_laplacian(contents)
-        return StreamingResponse(resize, media_type="image/png")
-
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"process failed: {str(e)}")
+async def laplacian_filter(upload: Upload = Depends(read_upload)):
+    return await run_op(upload, "laplacian-filter")
     
 @app.post("/api/task/gaussian")
-async def gaussian_blur(file: UploadFile = File(...), ksize: int = Form(5), sigmaX: float = Form(0.0)):
-    try:
-        contents = await file.read()
-        output = tasks.get_gaussian(contents, ksize, sigmaX)
-        return StreamingResponse(output, media_type="image/png")
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Gaussian blur failed: {str(e)}")
+async def gaussian_blur(upload: Upload = Depends(read_upload), ksize: int = Form(5), sigmaX: float = Form(0.0)):
+    return await run_op(upload, "gaussian", ksize=ksize, sigmaX=sigmaX, error="Gaussian blur failed")
 
 @app.post("/api/task/sobel")
-async def sobel_filter(file: UploadFile = File(...), dx: int = Form(1), dy: int = Form(0), ksize: int = Form(3)):
-    try:
-        contents = await file.read()
-        output = tasks.get_sobel(contents, dx, dy, ksize)
-        return StreamingResponse(output, media_type="image/png")
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Sobel filter failed: {str(e)}")
+async def sobel_filter(upload: Upload = Depends(read_upload), dx: int = Form(1), dy: int = Form(0), ksize: int = Form(3)):
+    return await run_op(upload, "sobel", dx=dx, dy=dy, ksize=ksize, error="Sobel filter failed")
 
 @app.post("/api/task/prewitt")
-async def prewitt_filter(file: UploadFile = File(...), axis: str = Form("x")):
-    try:
-        contents = await file.read()
-        output = tasks.get_prewitt(contents, axis)
-        return StreamingResponse(output, media_type="image/png")
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Prewitt filter failed: {str(e)}")
+async def prewitt_filter(upload: Upload = Depends(read_upload), axis: str = Form("x")):
+    return await run_op(upload, "prewitt", axis=axis, error="Prewitt filter failed")
     
 
 @app.post("/api/task/midpoint-filter")
-async def midpoint_filter(file: UploadFile = File(...), ksize: int = Form(0)):
-    try:
-        contents = await file.read()
-        output = tasks.get_midpoint_filter(contents, ksize)
-        return StreamingResponse(output, media_type="image/png")
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Sobel filter failed: {str(e)}")
+async def midpoint_filter(upload: Upload = Depends(read_upload), ksize: int = Form(0), shape: str = Form("rect"),
+                          kernel: str = Form("")):
+    return await run_morph(upload, "midpoint-filter", shape, kernel, ksize=ksize, error="Midpoint filter failed")
     
 @app.post("/api/task/max-filter")
-async def max_filter(file: UploadFile = File(...), ksize: int = Form(0)):
-    try:
-        contents = await file.read()
-        output = tasks.get_max_filter(contents, ksize)
-        return StreamingResponse(output, media_type="image/png")
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Sobel filter failed: {str(e)}")
+async def max_filter(upload: Upload = Depends(read_upload), ksize: int = Form(0), shape: str = Form("rect"),
+                     kernel: str = Form("")):
+    return await run_morph(upload, "max-filter", shape, kernel, ksize=ksize, error="Max filter failed")
     
 @app.post("/api/task/min-filter")
-async def min_filter(file: UploadFile = File(...), ksize: int = Form(0)):
-    try:
-        contents = await file.read()
-        output = tasks.get_min_filter(contents, ksize)
-        return StreamingResponse(output, media_type="image/png")
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Sobel filter failed: {str(e)}")
+async def min_filter(upload: Upload = Depends(read_upload), ksize: int = Form(0), shape: str = Form("rect"),
+                     kernel: str = Form("")):
+    return await run_morph(upload, "min-filter", shape, kernel, ksize=ksize, error="Min filter failed")
     
 @app.post("/api/task/median-filter")
-async def median_filter(file: UploadFile = File(...), ksize: int = Form(0)):
-    try:
-        contents = await file.read()
-        output = tasks.get_median_filter(contents, ksize)
-        return StreamingResponse(output, media_type="image/png")
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Sobel filter failed: {str(e)}")
+async def median_filter(upload: Upload = Depends(read_upload), ksize: int = Form(0)):
+    return await run_op(upload, "median-filter", ksize=ksize, error="Median filter failed")
     
 @app.post("/api/task/power-law")
-async def power_law_transform(file: UploadFile = File(...), gamma: float = Form(1.0)):
-    try:
-        contents = await file.read()
-        output = tasks.get_power_law_transformation(contents, gamma)
-        return StreamingResponse(output, media_type="image/png")
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Power law transformation failed: {str(e)}")
+async def power_law_transform(upload: Upload = Depends(read_upload), gamma: float = Form(1.0)):
+    return await run_op(upload, "power-law", gamma=gamma, error="Power law transformation failed")
 
 @app.post("/api/task/scale")
-async def scale_image(file: UploadFile = File(...), fx: float = Form(1.0), fy: float = Form(1.0)):
-    try:
-        contents = await file.read()
-        output = tasks.get_scaled_image(contents, fx, fy)
-        return StreamingResponse(output, media_type="image/png")
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Scaling failed: {str(e)}")
+async def scale_image(upload: Upload = Depends(read_upload), fx: float = Form(1.0), fy: float = Form(1.0)):
+    return await run_op(upload, "scale", fx=fx, fy=fy, error="Scaling failed")
     
 @app.post("/api/task/rotate")
-async def rotate_image(file: UploadFile = File(...), angle: float = Form(0.0)):
-    try:
-        contents = await file.read()
-        output = tasks.get_rotated_image(contents, angle)
-        return StreamingResponse(output, media_type="image/png")
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Rotation failed: {str(e)}")
+async def rotate_image(upload: Upload = Depends(read_upload), angle: float = Form(0.0)):
+    return await run_op(upload, "rotate", angle=angle, error="Rotation failed")
     
 @app.post("/api/task/translate")
-async def translate_image(file: UploadFile = File(...), tx: int = Form(0), ty: int = Form(0)):
-    try:
-        contents = await file.read()
-        output = tasks.get_translated_image(contents, tx, ty)
-        return StreamingResponse(output, media_type="image/png")
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Translation failed: {str(e)}")
+async def translate_image(upload: Upload = Depends(read_upload), tx: int = Form(0), ty: int = Form(0)):
+    return await run_op(upload, "translate", tx=tx, ty=ty, error="Translation failed")
     
 @app.post("/api/task/noise/gaussian")
-async def gaussian_noise(file: UploadFile = File(...), mean: float = Form(0.0), std: float = Form(1.0)):
-    try:
-        contents = await file.read()
-        output = tasks.add_gaussian_noise(contents, mean, std)
-        return StreamingResponse(output, media_type="image/png")
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Gaussian noise addition failed: {str(e)}")
+async def gaussian_noise(upload: Upload = Depends(read_upload), mean: float = Form(0.0), std: float = Form(1.0)):
+    return await run_op(upload, "noise/gaussian", mean=mean, std=std, error="Gaussian noise addition failed")
 
 
 @app.post("/api/task/noise/rayleigh")
-async def rayleigh_noise(file: UploadFile = File(...), scale: float = Form(1.0)):
-    try:
-        contents = await file.read()
-        output = tasks.add_rayleigh_noise(contents, scale)
-        return StreamingResponse(output, media_type="image/png")
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Rayleigh noise addition failed: {str(e)}")
+async def rayleigh_noise(upload: Upload = Depends(read_upload), scale: float = Form(1.0)):
+    return await run_op(upload, "noise/rayleigh", scale=scale, error="Rayleigh noise addition failed")
         
 @app.post("/api/task/log")
-async def laplacian_of_gaussian_filter(file: UploadFile = File(...), kernel_size: int = Form(5), sigma: float = Form(1.0)):
-    try:
-        contents = await file.read()
-        output = tasks.laplacian_of_gaussian(contents, kernel_size, sigma)
-        return StreamingResponse(output, media_type="image/png")
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Laplacian of Gaussian filter failed: {str(e)}")
+async def laplacian_of_gaussian_filter(upload: Upload = Depends(read_upload), kernel_size: int = Form(5), sigma: float = Form(1.0)):
+    return await run_op(upload, "log", kernel_size=kernel_size, sigma=sigma, error="Laplacian of Gaussian filter failed")
 
 
 @app.post("/api/task/highpass")
-async def high_pass_filter(file: UploadFile = File(...), kernel_size: int = Form(5)):
-    try:
-        contents = await file.read()
-        output = tasks.high_pass_filter(contents, kernel_size)
-        return StreamingResponse(output, media_type="image/png")
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"High pass filter failed: {str(e)}")
+async def high_pass_filter(upload: Upload = Depends(read_upload), kernel_size: int = Form(5)):
+    return await run_op(upload, "highpass", kernel_size=kernel_size, error="High pass filter failed")
 
 
 @app.post("/api/task/lowpass")
-async def low_pass_filter(file: UploadFile = File(...), kernel_size: int = Form(5)):
-    try:
-        contents = await file.read()
-        output = tasks.low_pass_filter(contents, kernel_size)
-        return StreamingResponse(output, media_type="image/png")
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Low pass filter failed: {str(e)}")
+async def low_pass_filter(upload: Upload = Depends(read_upload), kernel_size: int = Form(5)):
+    return await run_op(upload, "lowpass", kernel_size=kernel_size, error="Low pass filter failed")
 
 @app.post("/api/task/highboost")
-async def high_boost_filter(file: UploadFile = File(...), boost_factor: float = Form(2.0), kernel_size: int = Form(5)):
-    try:
-        contents = await file.read()
-        output = tasks.high_boost_filter(contents, boost_factor, kernel_size)
-        return StreamingResponse(output, media_type="image/png")
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"High Boost filter failed: {str(e)}")
+async def high_boost_filter(upload: Upload = Depends(read_upload), boost_factor: float = Form(2.0), kernel_size: int = Form(5)):
+    return await run_op(upload, "highboost", boost_factor=boost_factor, kernel_size=kernel_size, error="High Boost filter failed")
 
 @app.post("/api/task/canny")
-async def canny_edge(file: UploadFile = File(...), threshold1: int = Form(100), threshold2: int = Form(200)):
-    try:
-        contents = await file.read()
-        output = tasks.canny_edge_detection(contents, threshold1, threshold2)
-        return StreamingResponse(output, media_type="image/png")
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Canny edge detection failed: {str(e)}")
+async def canny_edge(upload: Upload = Depends(read_upload), threshold1: int = Form(100), threshold2: int = Form(200)):
+    return await run_op(upload, "canny", threshold1=threshold1, threshold2=threshold2, error="Canny edge detection failed")
 
 @app.post("/api/task/harris")
-async def harris_corner(file: UploadFile = File(...), block_size: int = Form(2), ksize: int = Form(3), k: float = Form(0.04), threshold: float = Form(0.01)):
-    try:
-        contents = await file.read()
-        output = tasks.harris_corner_detection(contents, block_size, ksize, k, threshold)
-        return StreamingResponse(output, media_type="image/png")
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Harris corner detection failed: {str(e)}")
+async def harris_corner(upload: Upload = Depends(read_upload), block_size: int = Form(2), ksize: int = Form(3), k: float = Form(0.04), threshold: float = Form(0.01)):
+    return await run_op(upload, "harris", block_size=block_size, ksize=ksize, k=k, threshold=threshold, error="Harris corner detection failed")
+
+async def run_detection(upload: Upload, name: str, output: str, error: str = "process failed", **params):
+    """Draws what an ops.DETECTIONS entry found on the image, or returns it as JSON for output="json"."""
+    if output == "image":
+        return await run_op(upload, name, error=error, **params)
+    if output != "json":
+        raise HTTPException(status_code=400, detail="output must be 'image' or 'json'")
+    return await run_task(upload, tasks.run_detection, name, params, error=error, media_type="application/json")
 
 @app.post("/api/task/hough-circles")
 async def hough_circles(
-    file: UploadFile = File(...),
+    upload: Upload = Depends(read_upload),
     dp: float = Form(1.2),
     min_dist: int = Form(100),
     param1: int = Form(100),
     param2: int = Form(30),
     min_radius: int = Form(0),
-    max_radius: int = Form(0)
+    max_radius: int = Form(0),
+    output: str = Form("image")
 ):
-    try:
-        contents = await file.read()
-        output = tasks.hough_circle_transform(contents, dp, min_dist, param1, param2, min_radius, max_radius)
-        return StreamingResponse(output, media_type="image/png")
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Hough circle transform failed: {str(e)}")
+    return await run_detection(upload, "hough-circles", output, dp=dp, min_dist=min_dist, param1=param1, param2=param2, min_radius=min_radius, max_radius=max_radius, error="Hough circle transform failed")
 
 @app.post("/api/task/hough-lines")
 async def hough_lines(
-    file: UploadFile = File(...),
+    upload: Upload = Depends(read_upload),
     rho: float = Form(1),
     theta: float = Form(np.pi / 180),
-    threshold: int = Form(100)
+    threshold: int = Form(100),
+    mode: str = Form("standard"),
+    min_line_length: float = Form(0),
+    max_line_gap: float = Form(0),
+    max_lines: int = Form(0),
+    output: str = Form("image")
 ):
-    try:
-        contents = await file.read()
-        output = tasks.hough_line_transform(contents, rho, theta, threshold)
-        return StreamingResponse(output, media_type="image/png")
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Hough line transform failed: {str(e)}")
+    if mode not in ops.LINE_MODES:
+        raise HTTPException(status_code=400, detail=f"mode must be one of: {', '.join(ops.LINE_MODES)}")
+    return await run_detection(upload, "hough-lines", output, rho=rho, theta=theta, threshold=threshold, mode=mode,
+                               min_line_length=min_line_length, max_line_gap=max_line_gap, max_lines=max_lines,
+                               error="Hough line transform failed")
 
 @app.post("/api/task/dilation")
-async def dilation(file: UploadFile = File(...), kernel_size: int = Form(5), iterations: int = Form(1)):
-    try:
-        contents = await file.read()
-        output = tasks.dilation_operation(contents, kernel_size, iterations)
-        return StreamingResponse(output, media_type="image/png")
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Dilation failed: {str(e)}")
+async def dilation(upload: Upload = Depends(read_upload), kernel_size: int = Form(5), iterations: int = Form(1),
+                   shape: str = Form("rect"), kernel: str = Form("")):
+    return await run_morph(upload, "dilation", shape, kernel, kernel_size=kernel_size, iterations=iterations,
+                           error="Dilation failed")
 
 
 @app.post("/api/task/erosion")
-async def erosion(file: UploadFile = File(...), kernel_size: int = Form(5), iterations: int = Form(1)):
-    try:
-        contents = await file.read()
-        output = tasks.erosion_operation(contents, kernel_size, iterations)
-        return StreamingResponse(output, media_type="image/png")
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Erosion failed: {str(e)}")
+async def erosion(upload: Upload = Depends(read_upload), kernel_size: int = Form(5), iterations: int = Form(1),
+                  shape: str = Form("rect"), kernel: str = Form("")):
+    return await run_morph(upload, "erosion", shape, kernel, kernel_size=kernel_size, iterations=iterations,
+                           error="Erosion failed")
 
 
 @app.post("/api/task/opening")
-async def opening(file: UploadFile = File(...), kernel_size: int = Form(5)):
-    try:
-        contents = await file.read()
-        output = tasks.opening_operation(contents, kernel_size)
-        return StreamingResponse(output, media_type="image/png")
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Opening failed: {str(e)}")
+async def opening(upload: Upload = Depends(read_upload), kernel_size: int = Form(5), shape: str = Form("rect"),
+                  kernel: str = Form("")):
+    return await run_morph(upload, "opening", shape, kernel, kernel_size=kernel_size, error="Opening failed")
 
 
 @app.post("/api/task/closing")
-async def closing(file: UploadFile = File(...), kernel_size: int = Form(5)):
-    try:
-        contents = await file.read()
-        output = tasks.closing_operation(contents, kernel_size)
-        return StreamingResponse(output, media_type="image/png")
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Closing failed: {str(e)}")
+async def closing(upload: Upload = Depends(read_upload), kernel_size: int = Form(5), shape: str = Form("rect"),
+                  kernel: str = Form("")):
+    return await run_morph(upload, "closing", shape, kernel, kernel_size=kernel_size, error="Closing failed")
 
 
 @app.post("/api/task/hitmiss")
-async def hitmiss(file: UploadFile = File(...)):
+async def hitmiss(upload: Upload = Depends(read_upload), kernel: str = Form("")):
+    try:
+        kernels.hit_miss(kernel)
+    except kernels.KernelError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return await run_op(upload, "hitmiss", kernel=kernel, error="Hit-or-Miss failed")
+
+async def run_segmentation(fn, *args, error: str = "Segmentation failed", **kwargs):
+    """Like run_in_pool, for the coroutines in segment.py."""
     try:
-        contents = await file.read()
-        output = tasks.hit_miss_transform(contents)
-        return StreamingResponse(output, media_type="image/png")
+        return await fn(*args, **kwargs)
+    except segment.ModelUnavailable as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "5"})
+    except (segment.QueueFull, executor.PoolSaturated):
+        raise HTTPException(status_code=503, detail="Server is busy, try again shortly", headers={"Retry-After": "1"})
+    except executor.TaskTimeout as e:
+        raise HTTPException(status_code=504, detail=f"{error}: {str(e)}")
+    except tasks.ImageTooLarge as e:
+        raise HTTPException(status_code=413, detail=f"{error}: {str(e)}")
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Hit-or-Miss failed: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"{error}: {str(e)}")
+
+
+@app.get("/api/segment/status")
+async def segment_status():
+    """Whether the segmentation model is loading, ready or failed, and its batching counters."""
+    return segment.status()
 
 @app.post("/api/task/segment")
-async def segment(file: UploadFile = File(...)):
+async def segment_task(upload: Upload = Depends(read_upload), output: str = Form("color"), alpha: float = Form(0.5),
+                       tier: str = Form(config.SEGMENT_TIER)):
+    try:
+        segment.check_output(output, upload.encoding, tier)
+    except segment.SegmentationError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    media_type = {"counts": "application/json", "palette": "image/png"}.get(output)
+    if upload.encoding.raw and output != "counts":
+        media_type = None
+    return await run_task(upload, segment.segment_image, output, alpha, tier, error="Segmentation failed",
+                          media_type=media_type, runner=run_segmentation)
+
+
+@app.post("/api/progressive/{task:path}")
+async def progressive_task(task: str, upload: Upload = Depends(read_upload), params: str = Form("{}"),
+                           levels: str | None = Form(None)):
+    """
+    Streams the task's result on downscaled previews first (the comma-separated
+    longest sides in `levels`) and then at full size, as Server-Sent Events;
+    see progressive.py. Task parameters go in `params` as a JSON object, as
+    for /api/batch.
+    """
+    if upload.encoding.raw:
+        raise HTTPException(status_code=400, detail="format=npy is not available for progressive results")
+    try:
+        params = json.loads(params)
+        if task == "segment":
+            output, alpha = params.get("output", "color"), float(params.get("alpha", 0.5))
+            tier = params.get("tier", config.SEGMENT_TIER)
+            segment.check_output(output, upload.encoding, tier)
+        else:
+            [(op, params)] = pipeline.parse_steps([{"op": task, "params": params}])
+        sides = progressive.parse_levels(levels, upload.longest_side())
+    except (json.JSONDecodeError, AttributeError, TypeError, ValueError) as e:
+        if isinstance(e, tasks.ImageTooLarge):
+            raise HTTPException(status_code=413, detail=str(e))
+        raise HTTPException(status_code=400, detail=str(e))
+    if sides and upload.image is None and not progressive.reduces_on_decode(upload.contents):
+        # decoded once; every level is scaled down from that array with INTER_AREA
+        image = await run_in_pool(tasks.DecodedImage.decode_for, upload.contents, task if task == "segment" else op,
+                                  error=f"{task} failed")
+        upload = Upload(upload.request, image=image, digest=upload.digest, encoding=upload.encoding)
+
+    async def render(max_side: int | None):
+        frame = upload.at_size(max_side or 0)
+        if task == "segment":
+            # previews use the fastest model once it is loaded; it sees a small image anyway
+            frame_tier = segment.preview_tier(tier) if max_side else tier
+            response = await run_task(frame, segment.segment_image, output, alpha, frame_tier,
+                                      error="Segmentation failed", runner=run_segmentation,
+                                      media_type={"counts": "application/json", "palette": "image/png"}.get(output))
+        else:
+            response = await run_op(frame, op, error=f"{task} failed", **params)
+        return response.media_type, response.body
+
+    return StreamingResponse(progressive.stream(sides, render), media_type=progressive.MEDIA_TYPE,
+                             headers=progressive.HEADERS)
+
+
+@app.websocket("/api/session")
+async def live_session(websocket: WebSocket):
+    """
+    Upload an image once, then stream task requests and receive their
+    results; stale requests are dropped. See sessions.py for the messages.
+    """
+
+    async def load(data: bytes | dict):
+        if isinstance(data, dict):
+            image_id = str(data["image_id"])
+            image = image_store.images.get(image_id)
+            if image is None:
+                raise HTTPException(status_code=404, detail=f"Unknown or expired image_id {image_id}")
+        elif len(data) > config.MAX_UPLOAD_BYTES:
+            raise HTTPException(status_code=413, detail="Image is too large")
+        else:
+            image_id, image = await store_image(data)
+        height, width = image.bgr.shape[:2]
+        return Upload(websocket, image=image, digest=image_id), {"image_id": image_id, "width": width, "height": height}
+
+    async def render(image: Upload, request: dict):
+        try:
+            options = encoding.negotiate(request.get("format"), request.get("quality"), request.get("png_compression"),
+                                         websocket.headers.get("accept"))
+            [(op, params)] = pipeline.parse_steps([{"op": request.get("task"), "params": request.get("params", {})}])
+            max_side = request.get("max_side")
+            max_side = preview_side(bool(request.get("preview")), None if max_side is None else int(max_side))
+        except (TypeError, ValueError) as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        if options.raw:
+            raise HTTPException(status_code=400, detail="format=npy is not available in sessions")
+        upload = Upload(websocket, image=image.image, digest=image.digest, encoding=options, max_side=max_side)
+        response = await run_op(upload, op, error=f"{op} failed", **params)
+        return response.media_type, response.body
+
+    await sessions.Session(websocket, load, render).run()
+
+
+def job_runner(upload: Upload, task: str, params: dict):
+    """
+    Validates a job's task and parameters up front and returns the coroutine
+    function that computes it, through the same path as its task endpoint.
+    """
+    if task == "segment":
+        output, alpha = params.get("output", "color"), float(params.get("alpha", 0.5))
+        tier = params.get("tier", config.SEGMENT_TIER)
+        segment.check_output(output, upload.encoding, tier)
+        media_type = {"counts": "application/json", "palette": "image/png"}.get(output)
+        compute = lambda: run_task(upload, segment.segment_image, output, alpha, tier, error="Segmentation failed",
+                                   media_type=media_type, runner=run_segmentation)
+    else:
+        output = params.pop("output", "image") if task in ops.DETECTIONS else "image"
+        if output not in ("image", "json"):
+            raise ValueError(f"Unknown output {output!r}. Use image or json")
+        [(op, params)] = pipeline.parse_steps([{"op": task, "params": params}])
+        if output == "json":
+            compute = lambda: run_task(upload, tasks.run_detection, op, params, error=f"{task} failed",
+                                       media_type="application/json")
+        else:
+            compute = lambda: run_op(upload, op, error=f"{task} failed", **params)
+
+    async def run():
+        response = await compute()
+        return response.media_type, response.body
+
+    return run
+
+
+@app.post("/api/jobs", status_code=202)
+async def submit_job(upload: Upload = Depends(read_upload), task: str = Form(...), params: str = Form("{}"),
+                     priority: int = Form(0)):
+    """
+    Queues a task and answers at once with the job's id; poll
+    GET /api/jobs/{job_id} for the result. See jobs.py.
+    """
+    if upload.encoding.raw:
+        raise HTTPException(status_code=400, detail="format=npy is not available for jobs")
     try:
-        contents = await file.read()
-        output = segment_image(contents)
-        return StreamingResponse(output, media_type="image/png")
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Segmentation failed: {str(e)}")
+        run = job_runner(upload, task, json.loads(params))
+    except (json.JSONDecodeError, AttributeError, TypeError, ValueError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    try:
+        job = jobs.queue.submit(task, run, priority)
+    except jobs.QueueFull:
+        raise HTTPException(status_code=503, detail="Too many jobs queued, try again shortly", headers={"Retry-After": "5"})
+    return JSONResponse(job.info(), status_code=202, headers={"Location": f"/api/jobs/{job.id}"})
+
+
+@app.get("/api/jobs/stats")
+async def job_stats():
+    return jobs.queue.stats()
+
+
+@app.get("/api/jobs/{job_id}")
+async def get_job(job_id: str):
+    """
+    202 with the job's status while it is queued or running, then its result
+    as the task endpoint would have returned it, or that endpoint's error.
+    """
+    job = jobs.queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired job_id")
+    if job.status == jobs.DONE:
+        return Response(job.result, media_type=job.media_type)
+    if job.status == jobs.FAILED:
+        return JSONResponse({"detail": job.error["detail"], "job": job.info()}, status_code=job.error["status"])
+    return JSONResponse(job.info(), status_code=202, headers={"Retry-After": "1"})
+
+
+@app.get("/api/jobs/{job_id}/status")
+async def get_job_status(job_id: str):
+    job = jobs.queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired job_id")
+    return job.info()
+
+
+@app.delete("/api/jobs/{job_id}")
+async def delete_job(job_id: str):
+    """Cancels a queued job or discards a finished one's result."""
+    job = jobs.queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired job_id")
+    if not jobs.queue.delete(job_id):
+        raise HTTPException(status_code=409, detail="The job is running and can't be cancelled")
+    return {"deleted": job_id}
+
+
+@app.get("/api/pipeline/operations")
+async def pipeline_operations():
+    return pipeline.describe()
+
+@app.post("/api/pipeline")
+async def run_pipeline(upload: Upload = Depends(read_upload), steps: str = Form(...)):
+    """
+    Applies an ordered list of operations to one upload, e.g.
+    steps='[{"op": "grayscale"}, {"op": "gaussian", "params": {"ksize": 7}}, {"op": "canny"}]'.
+    The image is decoded and encoded once no matter how many steps there are.
+    """
+    try:
+        parsed = pipeline.parse_steps(steps)
+    except pipeline.PipelineError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return await run_task(upload, pipeline.run, parsed, error="Pipeline failed",
+                          cacheable=pipeline.is_deterministic(parsed))
+
+
+def _optional_int(form, name: str) -> int | None:
+    value = form.get(name)
+    if value in (None, ""):
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"{name} must be an integer")
+
+@app.post("/api/batch/{task:path}")
+async def batch_task(task: str, request: Request):
+    """
+    Applies one task to many images, sent either as repeated `files` fields or
+    as a ZIP in `archive`, with the task parameters as a JSON object in
+    `params`. Results stream back as a ZIP as they finish; manifest.json at the
+    end of the archive lists the status of every input.
+    """
+    form = await request.form(max_files=config.BATCH_MAX_ITEMS)
+    try:
+        try:
+            params = json.loads(form.get("params") or "{}")
+            [(op, params)] = pipeline.parse_steps([{"op": task, "params": params}])
+            options = encoding.negotiate(form.get("format"), _optional_int(form, "quality"),
+                                         _optional_int(form, "png_compression"), request.headers.get("accept"))
+        except json.JSONDecodeError as e:
+            raise HTTPException(status_code=400, detail=f"params is not valid JSON: {e}")
+        except (pipeline.PipelineError, encoding.EncodingError) as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+        archive = form.get("archive")
+        if archive is not None:
+            try:
+                items = await batch.items_from_archive(archive)
+            except batch.BatchError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+        else:
+            items = batch.items_from_files(form.getlist("files"))
+        if not items:
+            raise HTTPException(status_code=400, detail="Send images as `files` or a ZIP as `archive`")
+        if len(items) > config.BATCH_MAX_ITEMS:
+            raise HTTPException(status_code=413, detail=f"At most {config.BATCH_MAX_ITEMS} images per batch")
+    except BaseException:
+        await form.close()
+        raise
+
+    # the uploads are read while the response streams, so the form is closed
+    # by the stream rather than when this handler returns
+    name = task.replace("/", "-")
+    return StreamingResponse(batch.stream_zip(items, op, params, options, on_close=form.close),
+                             media_type="application/zip",
+                             headers={"Content-Disposition": f"attachment; filename={name}_batch.zip"})
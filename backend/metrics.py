@@ -0,0 +1,251 @@
+"""
+Request and task instrumentation, exposed in the Prometheus text format on
+GET /metrics and per request in a Server-Timing header.
+
+Task code marks its stages with `with metrics.stage("decode", task):`. Stages
+run on a pool worker are collected there by collect() and handed back with the
+result (this works for process pools too), then recorded by record_stages() in
+the request that submitted the work.
+"""
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_registry = []
+
+
+def _labels(names: tuple, values: tuple) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{str(value)}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(labels.get(name, "") for name in self.labels)
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, key, value) for key, value in self._values.items()]
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for name, key, value in self.samples():
+            lines.append(f"{name}{_labels(self.labels, key)} {value:g}")
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """A value that goes up and down, or is read from `function` when scraped."""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, labels: tuple = (), function=None):
+        super().__init__(name, help, labels)
+        self.function = function
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def samples(self):
+        if self.function is not None:
+            return [(self.name, (), self.function())]
+        return super().samples()
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][bisect_left(self.buckets, value)] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            values = [(key, [list(entry[0]), entry[1], entry[2]]) for key, entry in self._values.items()]
+        for key, (counts, total, count) in values:
+            cumulative = 0
+            for bound, bucket in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket
+                le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                lines.append(f"{self.name}_bucket{_labels(self.labels + ('le',), key + (le,))} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labels, key)} {total:g}")
+            lines.append(f"{self.name}_count{_labels(self.labels, key)} {count}")
+        return lines
+
+
+def render() -> str:
+    return "\n".join(line for metric in _registry for line in metric.render()) + "\n"
+
+
+REQUEST_SECONDS = Histogram("pixels_http_request_duration_seconds", "Time to handle a request, until its response started.",
+                            ("method", "route", "status"))
+REQUESTS_IN_FLIGHT = Gauge("pixels_http_requests_in_flight", "Requests being handled.")
+REQUEST_BYTES = Counter("pixels_http_request_bytes_total", "Request body bytes received.", ("route",))
+RESPONSE_BYTES = Counter("pixels_http_response_bytes_total", "Response body bytes sent.", ("route",))
+STAGE_SECONDS = Histogram("pixels_task_stage_seconds", "Time spent in each stage of a task.", ("task", "stage"))
+POOL_QUEUE_SECONDS = Histogram("pixels_pool_queue_seconds", "Time work waited for a free pool worker.")
+CACHE_LOOKUPS = Counter("pixels_cache_lookups_total", "Result cache lookups.", ("result",))
+
+
+class RequestTiming:
+    """Stage durations of one request, for its Server-Timing header."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages = {}
+
+    def add(self, stage: str, seconds: float):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def header(self) -> str:
+        entries = [f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in self.stages.items()]
+        entries.append(f"total;dur={(time.perf_counter() - self.started) * 1000:.1f}")
+        return ", ".join(entries)
+
+
+_request: ContextVar[RequestTiming | None] = ContextVar("pixels_request_timing", default=None)
+_local = threading.local()
+
+
+def record_stages(stages: list[tuple[str, str, float]], queued: float | None = None):
+    """
+    Records (stage, task, seconds) entries, and the time the work waited for
+    a pool worker, in the histograms and the current request.
+    """
+    timing = _request.get()
+    for name, task, seconds in stages:
+        STAGE_SECONDS.observe(seconds, task=task or "", stage=name)
+        if timing is not None:
+            timing.add(name, seconds)
+    if queued is not None:
+        POOL_QUEUE_SECONDS.observe(queued)
+        if timing is not None:
+            timing.add("queue", queued)
+
+
+def record_since_start(name: str):
+    """Records the time from the start of the current request to now as a stage."""
+    timing = _request.get()
+    if timing is not None:
+        timing.add(name, time.perf_counter() - timing.started)
+
+
+@contextmanager
+def stage(name: str, task: str | None = None):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        entry = (name, task, time.perf_counter() - started)
+        collected = getattr(_local, "stages", None)
+        if collected is not None:
+            collected.append(entry)
+        else:
+            record_stages([entry])
+
+
+def collect(fn, *args, **kwargs):
+    """
+    Runs fn on a pool worker and returns (result, stages, start time), so
+    the submitting request can record the stages and its wait for the worker.
+    """
+    started = time.monotonic()
+    _local.stages = stages = []
+    try:
+        return fn(*args, **kwargs), stages, started
+    finally:
+        _local.stages = None
+
+
+class MetricsMiddleware:
+    """Counts and times every HTTP request and adds its Server-Timing header."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        timing = RequestTiming()
+        token = _request.set(timing)
+        status = [500]
+        received = [0]
+        sent = [0]
+
+        async def counting_receive():
+            message = await receive()
+            if message["type"] == "http.request":
+                received[0] += len(message.get("body", b""))
+            return message
+
+        async def timing_send(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+                REQUEST_SECONDS.observe(time.perf_counter() - timing.started, method=scope["method"],
+                                        route=_route(scope), status=status[0])
+                headers = list(message.get("headers", [])) + [
+                    (b"server-timing", timing.header().encode()),
+                    # lets cross-origin frontends read the breakdown in devtools
+                    (b"timing-allow-origin", b"*"),
+                ]
+                message = {**message, "headers": headers}
+            elif message["type"] == "http.response.body":
+                sent[0] += len(message.get("body", b""))
+            await send(message)
+
+        REQUESTS_IN_FLIGHT.inc()
+        try:
+            await self.app(scope, counting_receive, timing_send)
+        finally:
+            REQUESTS_IN_FLIGHT.dec()
+            route = _route(scope)
+            REQUEST_BYTES.inc(received[0], route=route)
+            RESPONSE_BYTES.inc(sent[0], route=route)
+            _request.reset(token)
+
+
+def _route(scope) -> str:
+    # the route template keeps label values bounded, e.g. /api/images/{image_id}
+    route = scope.get("route")
+    return getattr(route, "path", None) or "unmatched"
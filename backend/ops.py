@@ -0,0 +1,485 @@
+"""
+Array-level image operations.
+
+Every function here takes a decoded image (BGR or single-channel uint8
+ndarray) and returns a new ndarray without modifying its input. tasks.py
+wraps them with decode/encode for the single-step endpoints, and the
+pipeline endpoint chains them on one decoded image.
+"""
+import inspect
+
+import cv2
+import numpy as np
+
+import kernels
+import lut
+
+
+def to_gray(img: np.ndarray) -> np.ndarray:
+    return img if img.ndim == 2 else cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+
+
+def to_bgr(img: np.ndarray) -> np.ndarray:
+    return img if img.ndim == 3 else cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+
+
+def _bgr_copy(img: np.ndarray) -> np.ndarray:
+    # for ops that draw on the image; never draw on the caller's array
+    return img.copy() if img.ndim == 3 else cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+
+
+def _check_odd_kernel(kernel_size: int):
+    if kernel_size < 1 or kernel_size % 2 == 0:
+        raise ValueError("kernel_size must be an odd integer >= 3")
+
+
+def negative(img: np.ndarray) -> np.ndarray:
+    return cv2.bitwise_not(img)
+
+
+def resize(img: np.ndarray, width: int = 256, height: int = 256) -> np.ndarray:
+    return cv2.resize(img, (width, height))
+
+
+def grayscale(img: np.ndarray) -> np.ndarray:
+    return to_gray(img)
+
+
+def binary(img: np.ndarray, threshold: int = 127) -> np.ndarray:
+    _, out = cv2.threshold(to_gray(img), threshold, 255, cv2.THRESH_BINARY)
+    return out
+
+
+def log_transformation(img: np.ndarray) -> np.ndarray:
+    return lut.apply(img, lut.log())
+
+
+def inverse_log_transformation(img: np.ndarray) -> np.ndarray:
+    return lut.apply(img, lut.inverse_log())
+
+
+def power_law(img: np.ndarray, gamma: float = 1.0) -> np.ndarray:
+    return lut.apply(img, lut.power_law(float(gamma)))
+
+
+def rotate(img: np.ndarray, angle: float = 0.0, scale: float = 1.0) -> np.ndarray:
+    (h, w) = img.shape[:2]
+    matrix = cv2.getRotationMatrix2D((w // 2, h // 2), angle, scale)
+    return cv2.warpAffine(img, matrix, (w, h))
+
+
+def scale(img: np.ndarray, fx: float = 1.0, fy: float = 1.0) -> np.ndarray:
+    return cv2.resize(img, None, fx=fx, fy=fy, interpolation=cv2.INTER_LINEAR)
+
+
+def translate(img: np.ndarray, tx: int = 0, ty: int = 0) -> np.ndarray:
+    rows, cols = img.shape[:2]
+    matrix = np.float32([[1, 0, tx], [0, 1, ty]])
+    return cv2.warpAffine(img, matrix, (cols, rows))
+
+
+def shear_horizontal(img: np.ndarray, shear_x: float = 1.0) -> np.ndarray:
+    (h, w) = img.shape[:2]
+    shear_matrix = np.float32([[1, 0, 0], [shear_x, 1, 0]])
+    return cv2.warpAffine(img, shear_matrix, (w, int(h + abs(shear_x) * w)))
+
+
+def shear_vertical(img: np.ndarray, shear_y: float = 1.0) -> np.ndarray:
+    (h, w) = img.shape[:2]
+    shear_matrix = np.float32([[1, shear_y, 0], [0, 1, 0]])
+    return cv2.warpAffine(img, shear_matrix, (int(w + abs(shear_y) * h), h))
+
+
+def gaussian(img: np.ndarray, ksize: int = 5, sigmaX: float = 0.0) -> np.ndarray:
+    return cv2.GaussianBlur(img, (ksize, ksize), sigmaX)
+
+
+def sobel_response(img: np.ndarray, dx: int = 1, dy: int = 0, ksize: int = 3) -> np.ndarray:
+    return cv2.Sobel(to_gray(img), cv2.CV_64F, dx, dy, ksize=ksize)
+
+
+def sobel(img: np.ndarray, dx: int = 1, dy: int = 0, ksize: int = 3) -> np.ndarray:
+    return cv2.convertScaleAbs(sobel_response(img, dx, dy, ksize))
+
+
+def prewitt_response(img: np.ndarray, axis: str = "x") -> np.ndarray:
+    """Signed float64 gradient for x/y, magnitude for both."""
+    gray = to_gray(img)
+    if axis == "x":
+        return cv2.filter2D(gray, cv2.CV_64F, kernels.PREWITT_X)
+    if axis == "y":
+        return cv2.filter2D(gray, cv2.CV_64F, kernels.PREWITT_Y)
+    if axis == "both":
+        gx = cv2.filter2D(gray, cv2.CV_64F, kernels.PREWITT_X)
+        gy = cv2.filter2D(gray, cv2.CV_64F, kernels.PREWITT_Y)
+        return np.sqrt(gx**2 + gy**2)
+    raise ValueError("Invalid axis. Use 'x', 'y' or 'both'.")
+
+
+def prewitt(img: np.ndarray, axis: str = "x") -> np.ndarray:
+    if axis in ("x", "y"):
+        # 8-bit filtering saturates negative responses to 0
+        return cv2.filter2D(to_gray(img), -1, kernels.PREWITT_X if axis == "x" else kernels.PREWITT_Y)
+    return np.uint8(np.clip(prewitt_response(img, axis), 0, 255))
+
+
+def laplacian_response(img: np.ndarray) -> np.ndarray:
+    return cv2.Laplacian(to_gray(img), ddepth=cv2.CV_64F)
+
+
+def laplacian(img: np.ndarray) -> np.ndarray:
+    return cv2.convertScaleAbs(laplacian_response(img))
+
+
+def _filter_element(ksize: int, shape: str, kernel: str) -> np.ndarray:
+    if shape != "custom":
+        _check_odd_kernel(ksize)
+    return kernels.element(shape, ksize, kernel)
+
+
+def max_filter(img: np.ndarray, ksize: int = 3, shape: str = "rect", kernel: str = "") -> np.ndarray:
+    return cv2.dilate(to_gray(img), _filter_element(ksize, shape, kernel))
+
+
+def min_filter(img: np.ndarray, ksize: int = 3, shape: str = "rect", kernel: str = "") -> np.ndarray:
+    return cv2.erode(to_gray(img), _filter_element(ksize, shape, kernel))
+
+
+def midpoint_filter(img: np.ndarray, ksize: int = 3, shape: str = "rect", kernel: str = "") -> np.ndarray:
+    gray = to_gray(img)
+    element = _filter_element(ksize, shape, kernel)
+    maxed = cv2.dilate(gray, element)
+    mined = cv2.erode(gray, element)
+    # floor((max + min) / 2) in uint8: (a >> 1) + (b >> 1) + (a & b & 1)
+    carry = cv2.bitwise_and(maxed, mined)
+    np.bitwise_and(carry, 1, out=carry)
+    np.right_shift(maxed, 1, out=maxed)
+    np.right_shift(mined, 1, out=mined)
+    cv2.add(maxed, mined, dst=maxed)
+    return cv2.add(maxed, carry, dst=maxed)
+
+
+def median_filter(img: np.ndarray, ksize: int = 3) -> np.ndarray:
+    _check_odd_kernel(ksize)
+    return cv2.medianBlur(to_gray(img), ksize)
+
+
+def gaussian_noise(img: np.ndarray, mean: float = 0.0, std: float = 1.0) -> np.ndarray:
+    noise = np.random.normal(mean, std, img.shape).astype(np.uint8)
+    return cv2.add(img, noise)
+
+
+def rayleigh_noise(img: np.ndarray, scale: float = 1.0) -> np.ndarray:
+    noise = np.random.rayleigh(scale, img.shape).astype(np.uint8)
+    return cv2.add(img, noise)
+
+
+def laplacian_of_gaussian_response(img: np.ndarray, kernel_size: int = 5, sigma: float = 1.0) -> np.ndarray:
+    blurred = cv2.GaussianBlur(img, (kernel_size, kernel_size), sigma)
+    return cv2.Laplacian(blurred, cv2.CV_64F)
+
+
+def laplacian_of_gaussian(img: np.ndarray, kernel_size: int = 5, sigma: float = 1.0) -> np.ndarray:
+    blurred = cv2.GaussianBlur(img, (kernel_size, kernel_size), sigma)
+    # the 3x3 Laplacian of 8-bit input is an integer in [-1020, 1020], so
+    # int16 holds it exactly; the float64 response is only kept for raw output
+    return cv2.convertScaleAbs(cv2.Laplacian(blurred, cv2.CV_16S))
+
+
+def high_pass(img: np.ndarray, kernel_size: int = 5) -> np.ndarray:
+    # original minus the blurred (low-pass) image
+    blurred = cv2.GaussianBlur(img, (kernel_size, kernel_size), 0)
+    return cv2.subtract(img, blurred, dst=blurred)
+
+
+def low_pass(img: np.ndarray, kernel_size: int = 5) -> np.ndarray:
+    return cv2.GaussianBlur(img, (kernel_size, kernel_size), 0)
+
+
+def high_boost(img: np.ndarray, boost_factor: float = 2.0, kernel_size: int = 5) -> np.ndarray:
+    # one buffer holds the blur, then the high-pass, then the result;
+    # addWeighted already saturates to uint8
+    out = cv2.GaussianBlur(img, (kernel_size, kernel_size), 0)
+    cv2.subtract(img, out, dst=out)
+    # add the boost factor multiplied high-pass component to the original image
+    return cv2.addWeighted(img, 1 + boost_factor, out, -boost_factor, 0, dst=out)
+
+
+def canny(img: np.ndarray, threshold1: int = 100, threshold2: int = 200) -> np.ndarray:
+    return cv2.Canny(to_gray(img), threshold1, threshold2)
+
+
+def harris(img: np.ndarray, block_size: int = 2, ksize: int = 3, k: float = 0.04, threshold: float = 0.01) -> np.ndarray:
+    out = _bgr_copy(img)
+    gray = np.float32(to_gray(img))
+
+    dst = cv2.cornerHarris(gray, block_size, ksize, k)
+    dst = cv2.dilate(dst, None)
+
+    out[dst > threshold * dst.max()] = [0, 0, 255]
+    return out
+
+
+def find_circles(img: np.ndarray, dp: float = 1.2, min_dist: int = 100, param1: int = 100, param2: int = 30,
+                 min_radius: int = 0, max_radius: int = 0) -> np.ndarray:
+    """Detected circles as an (N, 3) float32 array of x, y, radius."""
+    gray = cv2.medianBlur(to_gray(img), 5)
+    circles = cv2.HoughCircles(gray, cv2.HOUGH_GRADIENT, dp, minDist=min_dist,
+                               param1=param1, param2=param2,
+                               minRadius=min_radius, maxRadius=max_radius)
+    # reshaped because OpenCV versions differ in the extra axes they add
+    return np.empty((0, 3), np.float32) if circles is None else circles.reshape(-1, 3)
+
+
+def hough_circles(img: np.ndarray, dp: float = 1.2, min_dist: int = 100, param1: int = 100, param2: int = 30,
+                  min_radius: int = 0, max_radius: int = 0) -> np.ndarray:
+    out = _bgr_copy(img)
+    circles = find_circles(img, dp, min_dist, param1, param2, min_radius, max_radius)
+    for x, y, r in np.uint16(np.around(circles)):
+        cv2.circle(out, (x, y), r, (0, 255, 0), 2)
+        cv2.circle(out, (x, y), 2, (0, 0, 255), 3)
+    return out
+
+
+LINE_MODES = ("standard", "probabilistic")
+
+
+def clip_lines(polar: np.ndarray, width: int, height: int) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Endpoints where the lines x*cos(theta) + y*sin(theta) = rho enter and
+    leave the image, as an (N, 4) int32 array of x1, y1, x2, y2, and a mask of
+    the lines that cross the image at all.
+    """
+    rho, theta = polar[:, 0].astype(np.float64), polar[:, 1].astype(np.float64)
+    cos, sin = np.cos(theta), np.sin(theta)
+    # points are (x0, y0) + t * (-sin, cos); clip t to each axis' bounds
+    x0, y0 = cos * rho, sin * rho
+    low = np.full(len(polar), -np.inf)
+    high = np.full(len(polar), np.inf)
+    inside = np.ones(len(polar), bool)
+    for origin, step, size in ((x0, -sin, width), (y0, cos, height)):
+        moving = np.abs(step) > 1e-12
+        with np.errstate(divide="ignore", invalid="ignore"):
+            t1 = np.where(moving, (0 - origin) / step, -np.inf)
+            t2 = np.where(moving, (size - 1 - origin) / step, np.inf)
+        low = np.maximum(low, np.minimum(t1, t2))
+        high = np.minimum(high, np.maximum(t1, t2))
+        inside &= moving | ((origin >= 0) & (origin <= size - 1))
+    inside &= low <= high
+    low, high = np.where(inside, low, 0), np.where(inside, high, 0)
+    ends = np.stack([x0 - low * sin, y0 + low * cos, x0 - high * sin, y0 + high * cos], axis=1)
+    return np.rint(ends).astype(np.int32), inside
+
+
+def find_lines(img: np.ndarray, rho: float = 1, theta: float = np.pi / 180, threshold: int = 100,
+               mode: str = "standard", min_line_length: float = 0, max_line_gap: float = 0,
+               max_lines: int = 0) -> tuple[np.ndarray, np.ndarray | None]:
+    """
+    Detected lines as an (N, 4) int32 array of segment endpoints within the
+    image, strongest first in standard mode, and for standard mode the (N, 2)
+    rho, theta of each line. max_lines > 0 keeps only the first max_lines.
+    """
+    if mode not in LINE_MODES:
+        raise ValueError(f"Unknown mode {mode!r}. Use one of: {', '.join(LINE_MODES)}")
+    edges = cv2.Canny(to_gray(img), 50, 150)
+    limit = max_lines if max_lines > 0 else None
+    if mode == "probabilistic":
+        segments = cv2.HoughLinesP(edges, rho, theta, threshold, minLineLength=min_line_length, maxLineGap=max_line_gap)
+        segments = np.empty((0, 4), np.int32) if segments is None else segments.reshape(-1, 4)[:limit].astype(np.int32)
+        return segments, None
+    lines = cv2.HoughLines(edges, rho, theta, threshold)
+    polar = np.empty((0, 2), np.float32) if lines is None else lines.reshape(-1, 2)[:limit]
+    segments, inside = clip_lines(polar, img.shape[1], img.shape[0])
+    return segments[inside], polar[inside]
+
+
+def hough_lines(img: np.ndarray, rho: float = 1, theta: float = np.pi / 180, threshold: int = 100,
+                mode: str = "standard", min_line_length: float = 0, max_line_gap: float = 0,
+                max_lines: int = 0) -> np.ndarray:
+    out = _bgr_copy(img)
+    segments, _ = find_lines(img, rho, theta, threshold, mode, min_line_length, max_line_gap, max_lines)
+    if len(segments):
+        # one call draws every line
+        cv2.polylines(out, segments.reshape(-1, 2, 2), False, (0, 0, 255), 2)
+    return out
+
+
+def circles_json(img: np.ndarray, **params) -> dict:
+    circles = find_circles(img, **params)
+    return {"width": img.shape[1], "height": img.shape[0], "count": len(circles),
+            "circles": np.round(circles.astype(np.float64), 2).tolist()}
+
+
+def lines_json(img: np.ndarray, **params) -> dict:
+    segments, polar = find_lines(img, **params)
+    result = {"width": img.shape[1], "height": img.shape[0], "count": len(segments), "lines": segments.tolist()}
+    if polar is not None:
+        result["polar"] = np.round(polar.astype(np.float64), 6).tolist()
+    return result
+
+
+def dilation(img: np.ndarray, kernel_size: int = 5, iterations: int = 1, shape: str = "rect",
+             kernel: str = "") -> np.ndarray:
+    return cv2.dilate(img, kernels.element(shape, kernel_size, kernel), iterations=iterations)
+
+
+def erosion(img: np.ndarray, kernel_size: int = 5, iterations: int = 1, shape: str = "rect",
+            kernel: str = "") -> np.ndarray:
+    return cv2.erode(img, kernels.element(shape, kernel_size, kernel), iterations=iterations)
+
+
+def opening(img: np.ndarray, kernel_size: int = 5, shape: str = "rect", kernel: str = "") -> np.ndarray:
+    return cv2.morphologyEx(img, cv2.MORPH_OPEN, kernels.element(shape, kernel_size, kernel))
+
+
+def closing(img: np.ndarray, kernel_size: int = 5, shape: str = "rect", kernel: str = "") -> np.ndarray:
+    return cv2.morphologyEx(img, cv2.MORPH_CLOSE, kernels.element(shape, kernel_size, kernel))
+
+
+def hit_miss(img: np.ndarray, kernel: str = "") -> np.ndarray:
+    """kernel: 1 for foreground, -1 for background and 0 for either, e.g. "0,1,0;1,-1,1;0,1,0"."""
+    _, binary_img = cv2.threshold(to_gray(img), 127, 255, cv2.THRESH_BINARY)
+    return cv2.morphologyEx(binary_img, cv2.MORPH_HITMISS, kernels.hit_miss(kernel))
+
+
+# Operations addressable by name, keyed by their /api/task/<name> route so a
+# client can build a pipeline from the same identifiers it already uses.
+OPERATIONS = {
+    "negative": negative,
+    "resize": resize,
+    "grayscale": grayscale,
+    "binary": binary,
+    "log-transformation": log_transformation,
+    "inverse-log-transformation": inverse_log_transformation,
+    "power-law": power_law,
+    "power-law-transformation": power_law,
+    "shear-image-horizontal": shear_horizontal,
+    "shear-image-vertical": shear_vertical,
+    "laplacian-filter": laplacian,
+    "gaussian": gaussian,
+    "sobel": sobel,
+    "prewitt": prewitt,
+    "midpoint-filter": midpoint_filter,
+    "max-filter": max_filter,
+    "min-filter": min_filter,
+    "median-filter": median_filter,
+    "scale": scale,
+    "rotate": rotate,
+    "translate": translate,
+    "noise/gaussian": gaussian_noise,
+    "noise/rayleigh": rayleigh_noise,
+    "log": laplacian_of_gaussian,
+    "highpass": high_pass,
+    "lowpass": low_pass,
+    "highboost": high_boost,
+    "canny": canny,
+    "harris": harris,
+    "hough-circles": hough_circles,
+    "hough-lines": hough_lines,
+    "dilation": dilation,
+    "erosion": erosion,
+    "opening": opening,
+    "closing": closing,
+    "hitmiss": hit_miss,
+}
+
+# Detections by name -> fn(img, **params) returning them as a JSON-ready
+# dict, for clients that want the geometry rather than a drawing.
+DETECTIONS = {
+    "hough-circles": circles_json,
+    "hough-lines": lines_json,
+}
+
+# Variants returning the full-precision result that the OPERATIONS entry
+# converts to 8 bits, used when a client asks for the raw array.
+RAW_OUTPUTS = {
+    "sobel": sobel_response,
+    "prewitt": prewitt_response,
+    "laplacian-filter": laplacian_response,
+    "log": laplacian_of_gaussian_response,
+}
+
+# Point transforms by name -> fn(**params) returning their lookup table, so
+# that consecutive ones in a pipeline run as a single table lookup.
+POINT_TABLES = {
+    "negative": lut.negative,
+    "log-transformation": lut.log,
+    "inverse-log-transformation": lut.inverse_log,
+    "power-law": lambda gamma=1.0: lut.power_law(float(gamma)),
+    "power-law-transformation": lambda gamma=1.0: lut.power_law(float(gamma)),
+}
+
+# Operations that only read the intensity of their input (colour input is
+# converted to gray first), so a grayscale decode gives them what they need
+# without allocating and converting a BGR image.
+INTENSITY_ONLY = {
+    "grayscale", "binary", "sobel", "prewitt", "laplacian-filter",
+    "max-filter", "min-filter", "midpoint-filter", "median-filter", "canny", "hitmiss",
+}
+
+# A gray decode differs from gray converted from the decoded BGR: by 1 level
+# on about half the pixels of a lossless image (rounding), and for a JPEG,
+# whose gray decode is its luma plane, by up to ~20 levels at saturated
+# colour edges. Derivative filters amplify that to ~45 and a threshold flips
+# every pixel it pushes across, so these keep the BGR decode and their
+# (often numerically compared) output is unchanged.
+EXACT_GRAY = {"sobel", "prewitt", "laplacian-filter", "binary"}
+
+# Operations that work on the IMREAD_GRAYSCALE decode of an upload rather
+# than the BGR one; the others get the BGR decode.
+GRAY_INPUT = (INTENSITY_ONLY - EXACT_GRAY) | {
+    "log-transformation", "inverse-log-transformation", "power-law", "power-law-transformation",
+    "dilation", "erosion", "opening", "closing",
+}
+
+# Parameters measured in pixels, by operation: "odd" kernel sizes and
+# "length"s (distances, radii, offsets, sigmas, vote counts along a line).
+# scale_params adjusts them when an op runs on a downscaled preview so the
+# result looks like a scaled-down full-size result.
+SIZE_PARAMS = {
+    "resize": {"width": "length", "height": "length"},
+    "translate": {"tx": "length", "ty": "length"},
+    "gaussian": {"ksize": "odd", "sigmaX": "length"},
+    "max-filter": {"ksize": "odd"},
+    "min-filter": {"ksize": "odd"},
+    "midpoint-filter": {"ksize": "odd"},
+    "median-filter": {"ksize": "odd"},
+    "log": {"kernel_size": "odd", "sigma": "length"},
+    "highpass": {"kernel_size": "odd"},
+    "lowpass": {"kernel_size": "odd"},
+    "highboost": {"kernel_size": "odd"},
+    "hough-circles": {"min_dist": "length", "min_radius": "length", "max_radius": "length"},
+    "hough-lines": {"threshold": "length", "min_line_length": "length", "max_line_gap": "length"},
+    "dilation": {"kernel_size": "length"},
+    "erosion": {"kernel_size": "length"},
+    "opening": {"kernel_size": "length"},
+    "closing": {"kernel_size": "length"},
+}
+
+
+def _scaled(value, kind: str, factor: float):
+    if kind == "odd":
+        # 0 and 1 keep their meaning (derived from sigma, no-op)
+        return value if value <= 1 else max(1, round(value * factor)) | 1
+    scaled = value * factor
+    if isinstance(value, int):
+        # a non-zero length stays non-zero
+        scaled = round(scaled) or (1 if value > 0 else -1 if value < 0 else 0)
+    return scaled
+
+
+def scale_params(name: str, params: dict, factor: float) -> dict:
+    """params for running name on the image scaled by factor; defaults are scaled too."""
+    sizes = SIZE_PARAMS.get(name)
+    if not sizes or factor == 1:
+        return params
+    defaults = inspect.signature(OPERATIONS[name]).parameters
+    scaled = dict(params)
+    for key, kind in sizes.items():
+        scaled[key] = _scaled(params.get(key, defaults[key].default), kind, factor)
+    return scaled
+
+
+# Operations whose output differs between runs on the same input; their
+# results must not be cached.
+NONDETERMINISTIC = {"noise/gaussian", "noise/rayleigh"}
@@ -0,0 +1,101 @@
+import inspect
+import json
+
+import lut
+import ops
+import tasks
+from encoding import EncodeOptions
+
+MAX_STEPS = 32
+
+
+class PipelineError(ValueError):
+    """Raised for a malformed pipeline description."""
+
+
+def _coerce(name: str, param: inspect.Parameter, value):
+    kind = param.annotation if param.annotation is not inspect.Parameter.empty else type(param.default)
+    try:
+        if kind is int and isinstance(value, float) and not value.is_integer():
+            raise ValueError
+        return kind(value)
+    except (TypeError, ValueError):
+        raise PipelineError(f"{name}: parameter '{param.name}' must be {kind.__name__}, got {value!r}")
+
+
+def parse_steps(raw) -> list[tuple[str, dict]]:
+    """
+    Validates a pipeline description and returns it as (op, params) pairs.
+
+    Accepts a JSON string or the already-decoded list, e.g.
+    [{"op": "grayscale"}, {"op": "gaussian", "params": {"ksize": 7}}, {"op": "canny"}]
+    """
+    if isinstance(raw, (str, bytes)):
+        try:
+            raw = json.loads(raw)
+        except json.JSONDecodeError as e:
+            raise PipelineError(f"steps is not valid JSON: {e}")
+    if not isinstance(raw, list) or not raw:
+        raise PipelineError("steps must be a non-empty list")
+    if len(raw) > MAX_STEPS:
+        raise PipelineError(f"at most {MAX_STEPS} steps are allowed")
+
+    steps = []
+    for index, step in enumerate(raw):
+        if not isinstance(step, dict) or "op" not in step:
+            raise PipelineError(f"step {index} must be an object with an 'op' key")
+        name = step["op"]
+        fn = ops.OPERATIONS.get(name)
+        if fn is None:
+            raise PipelineError(f"step {index}: unknown operation {name!r}")
+        params = step.get("params") or {}
+        if not isinstance(params, dict):
+            raise PipelineError(f"step {index}: params must be an object")
+
+        signature = dict(list(inspect.signature(fn).parameters.items())[1:])
+        unknown = set(params) - set(signature)
+        if unknown:
+            raise PipelineError(f"{name}: unknown parameter(s) {', '.join(sorted(unknown))}")
+        steps.append((name, {key: _coerce(name, signature[key], value) for key, value in params.items()}))
+    return steps
+
+
+def apply(img, steps: list[tuple[str, dict]]):
+    tables = []
+    for name, params in steps:
+        if name in ops.POINT_TABLES:
+            # consecutive point transforms are folded into one table lookup
+            tables.append(ops.POINT_TABLES[name](**params))
+            continue
+        if tables:
+            img = lut.apply(img, lut.chain(*tables))
+            tables = []
+        img = ops.OPERATIONS[name](img, **params)
+    if tables:
+        img = lut.apply(img, lut.chain(*tables))
+    return img
+
+
+def is_deterministic(steps: list[tuple[str, dict]]) -> bool:
+    return not any(name in ops.NONDETERMINISTIC for name, _ in steps)
+
+
+def run(image_bytes: bytes | tasks.DecodedImage | tasks.Preview, steps: list[tuple[str, dict]],
+        encoding: EncodeOptions | None = None):
+    """Decodes once, applies every step to the in-memory array, encodes once."""
+    # decoded like the first step's task route, so a one-step pipeline matches it
+    img = tasks.decode_for(image_bytes, steps[0][0]) if steps else tasks.decode_image(image_bytes)
+    if isinstance(image_bytes, tasks.Preview):
+        steps = [(name, ops.scale_params(name, params, image_bytes.factor)) for name, params in steps]
+    return tasks.encode_image(apply(img, steps), encoding)
+
+
+def describe() -> dict:
+    """Lists the available operations with their parameters and defaults."""
+    return {
+        name: {
+            key: param.default
+            for key, param in list(inspect.signature(fn).parameters.items())[1:]
+        }
+        for name, fn in ops.OPERATIONS.items()
+    }
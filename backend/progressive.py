@@ -0,0 +1,89 @@
+"""
+Coarse-to-fine results of one task, streamed as Server-Sent Events.
+
+The task runs on previews of the image at each requested size, smallest
+first, and then at full size. Previews of JPEGs are decoded at 1/2 to 1/8
+scale straight from the file (see tasks.Preview); other images are decoded
+once and every level is scaled down from that array. Either way the first
+frame of an expensive task arrives long before the full result. Every frame is an
+`event: frame` whose data is a JSON object:
+
+    {"level": 0, "max_side": 256, "final": false, "media_type": "image/png", "data": "<base64>"}
+
+with max_side null on the final, full-size frame. A failure ends the stream
+with `event: error` ({"status": 504, "detail": "..."}); `event: done` follows
+the final frame.
+"""
+import base64
+import json
+
+import config
+
+MAX_LEVELS = 4
+MIN_SIDE = 16
+
+MEDIA_TYPE = "text/event-stream"
+# proxies must pass frames on as they come rather than buffer the response
+HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+
+class ProgressiveError(ValueError):
+    """Raised for malformed preview levels."""
+
+
+def parse_levels(value: str | None, longest: int | None = None) -> list[int]:
+    """
+    The preview sizes, as comma-separated longest sides, smallest first.
+    Sizes at or above the image's own longest side are dropped, since the
+    full-size frame follows anyway.
+    """
+    try:
+        levels = sorted({int(side) for side in (value or config.PROGRESSIVE_LEVELS).split(",") if side.strip()})
+    except ValueError:
+        raise ProgressiveError("levels must be comma-separated integers, e.g. 256,1024")
+    if levels and levels[0] < MIN_SIDE:
+        raise ProgressiveError(f"levels must be at least {MIN_SIDE}")
+    if len(levels) > MAX_LEVELS:
+        raise ProgressiveError(f"At most {MAX_LEVELS} levels")
+    return [side for side in levels if longest is None or side < longest]
+
+
+def reduces_on_decode(contents: bytes | memoryview) -> bool:
+    """
+    Whether the image is a JPEG, which tasks.Preview decodes at 1/2 to 1/8
+    scale in the DCT domain: a few such small decodes cost less than the full
+    decode the first frame would otherwise wait for. Other formats are
+    decoded once and every level is scaled down from that.
+    """
+    return bytes(contents[:3]) == b"\xff\xd8\xff"
+
+
+def event(name: str, data: dict) -> bytes:
+    return f"event: {name}\ndata: {json.dumps(data)}\n\n".encode()
+
+
+def frame(level: int, max_side: int | None, media_type: str, body: bytes) -> bytes:
+    return event("frame", {
+        "level": level,
+        "max_side": max_side,
+        "final": max_side is None,
+        "media_type": media_type,
+        "data": base64.b64encode(body).decode(),
+    })
+
+
+async def stream(levels: list[int], render):
+    """
+    Yields a frame for every level and then the full-size one. render(max_side)
+    computes one (max_side None for full size) and returns (media_type, body),
+    or raises an exception with status_code and detail attributes such as
+    HTTPException.
+    """
+    for level, max_side in enumerate([*levels, None]):
+        try:
+            media_type, body = await render(max_side)
+        except Exception as e:
+            yield event("error", {"status": getattr(e, "status_code", 500), "detail": getattr(e, "detail", str(e))})
+            return
+        yield frame(level, max_side, media_type, body)
+    yield event("done", {})
@@ -0,0 +1,385 @@
+"""
+Semantic segmentation with DeepLabV3 / LR-ASPP (PASCAL VOC labels).
+
+Models are loaded once, in the background (see start()), and run on a
+dedicated thread. Concurrent requests are grouped into micro-batches: the
+worker takes the first queued image, waits up to config.SEGMENT_BATCH_WAIT
+seconds for more, and runs every group of images with the same tier and size
+through the model in one forward pass.
+
+torch and torchvision are optional dependencies (`uv sync --extra segment`);
+without them the models report themselves unavailable.
+"""
+import asyncio
+import json
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from io import BytesIO
+from typing import NamedTuple
+
+import cv2
+import numpy as np
+from PIL import Image
+
+import config
+import executor
+import metrics
+import tasks
+from encoding import EncodeOptions
+
+MEAN = np.array([0.485, 0.456, 0.406], np.float32)
+STD = np.array([0.229, 0.224, 0.225], np.float32)
+
+
+class Tier(NamedTuple):
+    model: str       # torchvision.models.segmentation builder
+    weights: str     # its weights enum
+    max_side: int    # longest side the model sees, 0 for the full image
+
+
+# fastest last; benchmarks/segment.py measures the trade-off on given images
+TIERS = {
+    "quality": Tier("deeplabv3_resnet101", "DeepLabV3_ResNet101_Weights", 0),
+    "balanced": Tier("deeplabv3_mobilenet_v3_large", "DeepLabV3_MobileNet_V3_Large_Weights", 520),
+    "fast": Tier("lraspp_mobilenet_v3_large", "LRASPP_MobileNet_V3_Large_Weights", 320),
+}
+
+
+# images of different sizes are padded into one forward pass when that costs
+# at most this many times the work of running on their own pixels
+MAX_PADDING = 1.5
+
+
+class ModelUnavailable(Exception):
+    """Raised when a model isn't loaded (yet), or failed to load."""
+
+
+class QueueFull(Exception):
+    """Raised when too many images are already waiting for the model."""
+
+
+_lock = threading.Lock()
+_states = {tier: "idle" for tier in TIERS}  # idle -> loading -> ready | failed
+_errors: dict[str, str] = {}
+_models = {}
+_queue: queue.Queue = queue.Queue()
+_worker: threading.Thread | None = None
+_stats = {"batches": 0, "images": 0, "largest_batch": 0}
+
+
+def build_model(tier: str):
+    """Builds the tier's model in eval mode, scripted and frozen if config.SEGMENT_TORCHSCRIPT."""
+    import torch
+    from torchvision.models import segmentation
+
+    spec = TIERS[tier]
+    weights = getattr(segmentation, spec.weights).DEFAULT
+    model = getattr(segmentation, spec.model)(weights=weights).eval()
+    if config.SEGMENT_TORCHSCRIPT:
+        model = torch.jit.optimize_for_inference(torch.jit.script(model))
+    return model
+
+
+def _set_threads():
+    import torch
+
+    if config.SEGMENT_THREADS > 0:
+        torch.set_num_threads(config.SEGMENT_THREADS)
+
+
+def _load(tier: str):
+    global _worker
+    try:
+        import torch
+
+        _set_threads()
+        model = build_model(tier)
+        with torch.inference_mode():
+            # the first forward pass is much slower than the rest
+            model(torch.zeros(1, 3, 64, 64))
+    except Exception as e:
+        with _lock:
+            _states[tier], _errors[tier] = "failed", f"{type(e).__name__}: {e}"
+        return
+    with _lock:
+        _models[tier] = model
+        if _worker is None:
+            _worker = threading.Thread(target=_serve, name="pixels-segment", daemon=True)
+            _worker.start()
+        _states[tier] = "ready"
+
+
+def start(tier: str | None = None):
+    """Starts loading a tier's model (by default config.SEGMENT_TIER) in the background."""
+    tier = tier or config.SEGMENT_TIER
+    with _lock:
+        if _states[tier] != "idle":
+            return
+        _states[tier] = "loading"
+    threading.Thread(target=_load, args=(tier,), name=f"pixels-segment-load-{tier}", daemon=True).start()
+
+
+def shutdown():
+    if _worker is not None:
+        _queue.put(None)
+
+
+def status() -> dict:
+    return {
+        "state": _states[config.SEGMENT_TIER],
+        "error": _errors.get(config.SEGMENT_TIER),
+        "default_tier": config.SEGMENT_TIER,
+        "tiers": {tier: {"state": _states[tier], "error": _errors.get(tier)} for tier in TIERS},
+        "queued": _queue.qsize(),
+        "max_batch": config.SEGMENT_MAX_BATCH,
+        "batch_wait": config.SEGMENT_BATCH_WAIT,
+        **_stats,
+    }
+
+
+def _next_batch(first) -> list:
+    batch = [first]
+    deadline = time.monotonic() + config.SEGMENT_BATCH_WAIT
+    while len(batch) < config.SEGMENT_MAX_BATCH:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        try:
+            item = _queue.get(timeout=remaining)
+        except queue.Empty:
+            break
+        if item is None:
+            # let the outer loop see the shutdown once this batch is done
+            _queue.put(None)
+            break
+        batch.append(item)
+    return batch
+
+
+def infer(model, images: list[np.ndarray]) -> list[np.ndarray]:
+    """
+    Label maps for a list of RGB images. Smaller ones are padded at the
+    bottom and right to the largest size, with the mean colour, and their
+    label maps cropped back.
+    """
+    import torch
+
+    height = max(img.shape[0] for img in images)
+    width = max(img.shape[1] for img in images)
+    # zero is the mean colour once normalized
+    batch = np.zeros((len(images), height, width, 3), np.float32)
+    for slot, img in zip(batch, images):
+        slot[:img.shape[0], :img.shape[1]] = (img.astype(np.float32) / 255 - MEAN) / STD
+    with torch.inference_mode():
+        output = model(torch.from_numpy(batch).permute(0, 3, 1, 2).contiguous())["out"]
+    labels = output.argmax(1).byte().numpy()
+    return [label_map[:img.shape[0], :img.shape[1]] for label_map, img in zip(labels, images)]
+
+
+def _batches(items: list) -> list[list]:
+    """
+    Splits (image, future) pairs for one model into forward passes. Images
+    of different sizes share one as long as padding them to a common size
+    costs at most MAX_PADDING times the work of their own pixels.
+    """
+    items = sorted(items, key=lambda item: item[0].shape[0] * item[0].shape[1])
+    batches = []
+    current = []
+    for item in items:
+        candidate = current + [item]
+        padded = len(candidate) * max(img.shape[0] for img, _ in candidate) * max(img.shape[1] for img, _ in candidate)
+        if current and padded > MAX_PADDING * sum(img.shape[0] * img.shape[1] for img, _ in candidate):
+            batches.append(current)
+            candidate = [item]
+        current = candidate
+    if current:
+        batches.append(current)
+    return batches
+
+
+def _serve():
+    while True:
+        first = _queue.get()
+        if first is None:
+            return
+        batch = [item for item in _next_batch(first) if item[2].set_running_or_notify_cancel()]
+        tiers = {}
+        for tier, img, future in batch:
+            tiers.setdefault(tier, []).append((img, future))
+        for tier, items in tiers.items():
+            for group in _batches(items):
+                try:
+                    labels = infer(_models[tier], [img for img, _ in group])
+                except Exception as e:
+                    for _, future in group:
+                        future.set_exception(e)
+                    continue
+                for (_, future), label_map in zip(group, labels):
+                    future.set_result(label_map)
+        _stats["batches"] += 1
+        _stats["images"] += len(batch)
+        _stats["largest_batch"] = max(_stats["largest_batch"], len(batch))
+
+
+def preview_tier(tier: str) -> str:
+    """
+    The tier for a quick preview: "fast" once it is loaded, otherwise the
+    requested tier, so previews don't wait for a model that isn't preloaded
+    (its load starts here).
+    """
+    if _states["fast"] == "ready":
+        return "fast"
+    start("fast")
+    return tier
+
+
+def check_ready(tier: str):
+    """Raises ModelUnavailable unless the tier's model is ready, starting its load if needed."""
+    if _states[tier] == "ready":
+        return
+    start(tier)
+    if _states[tier] == "failed":
+        raise ModelUnavailable(f"segmentation model '{tier}' failed to load: {_errors[tier]}")
+    raise ModelUnavailable(f"segmentation model '{tier}' is still loading")
+
+
+def predict(rgb: np.ndarray, tier: str) -> Future:
+    """Queues an RGB image for the tier's model; the future resolves to its label map."""
+    check_ready(tier)
+    if _queue.qsize() >= config.SEGMENT_QUEUE_DEPTH:
+        raise QueueFull(f"{_queue.qsize()} images already waiting for the segmentation model")
+    future = Future()
+    _queue.put((tier, rgb, future))
+    return future
+
+
+def decode_rgb(image_bytes: bytes | tasks.DecodedImage) -> np.ndarray:
+    return cv2.cvtColor(tasks.decode_image(image_bytes), cv2.COLOR_BGR2RGB)
+
+
+def model_input(rgb: np.ndarray, max_side: int) -> np.ndarray:
+    """The image scaled down so its longest side is at most max_side (0 keeps it)."""
+    height, width = rgb.shape[:2]
+    if not max_side or max(height, width) <= max_side:
+        return rgb
+    scale = max_side / max(height, width)
+    return cv2.resize(rgb, (max(1, round(width * scale)), max(1, round(height * scale))), interpolation=cv2.INTER_AREA)
+
+
+def _prepare(image_bytes: bytes | tasks.DecodedImage, max_side: int) -> tuple[np.ndarray, np.ndarray]:
+    with metrics.stage("decode", "segment"):
+        rgb = decode_rgb(image_bytes)
+        return rgb, model_input(rgb, max_side)
+
+
+# PASCAL VOC classes and their colours (RGB), in label order
+LABELS = [
+    "background", "aeroplane", "bicycle", "bird", "boat", "bottle", "bus", "car", "cat", "chair", "cow",
+    "diningtable", "dog", "horse", "motorbike", "person", "pottedplant", "sheep", "sofa", "train", "tvmonitor",
+]
+PALETTE = np.zeros((256, 3), np.uint8)
+PALETTE[:len(LABELS)] = [
+    (0, 0, 0), (128, 0, 0), (0, 128, 0), (128, 128, 0), (0, 0, 128), (128, 0, 128), (0, 128, 128),
+    (128, 128, 128), (64, 0, 0), (192, 0, 0), (64, 128, 0), (192, 128, 0), (64, 0, 128), (192, 0, 128),
+    (64, 128, 128), (192, 128, 128), (0, 64, 0), (128, 64, 0), (0, 192, 0), (128, 192, 0), (0, 64, 128),
+]
+# rows as cv2 expects them, so encoded images show the VOC colours
+PALETTE_BGR = np.ascontiguousarray(PALETTE[:, ::-1])
+
+# output -> what the segmentation endpoint returns
+OUTPUTS = {
+    "color": "label colours as an RGB image",
+    "palette": "single-channel PNG with the label colours as its palette",
+    "labels": "single-channel image of the label indices",
+    "counts": "JSON pixel count per class",
+    "overlay": "label colours blended onto the input",
+}
+
+
+class SegmentationError(ValueError):
+    """Raised for an unknown output or an output the encoding can't represent."""
+
+
+def check_output(output: str, encoding: EncodeOptions, tier: str | None = None):
+    if tier is not None and tier not in TIERS:
+        raise SegmentationError(f"Unknown tier {tier!r}. Use one of: {', '.join(TIERS)}")
+    if output not in OUTPUTS:
+        raise SegmentationError(f"Unknown output {output!r}. Use one of: {', '.join(OUTPUTS)}")
+    if output == "palette" and encoding.format not in ("png", "npy"):
+        raise SegmentationError("output=palette is only available as png")
+
+
+def colorize(label_map: np.ndarray) -> np.ndarray:
+    """Label colours as a BGR image, in a single lookup pass."""
+    return np.take(PALETTE_BGR, label_map, axis=0)
+
+
+def class_counts(label_map: np.ndarray) -> dict:
+    counts = np.bincount(label_map.ravel(), minlength=len(LABELS))
+    height, width = label_map.shape
+    return {
+        "width": width,
+        "height": height,
+        "classes": [
+            {"label": int(label), "name": LABELS[label] if label < len(LABELS) else str(label),
+             "pixels": int(counts[label]), "fraction": float(counts[label]) / label_map.size}
+            for label in np.flatnonzero(counts)
+        ],
+    }
+
+
+def _palettized_png(label_map: np.ndarray, encoding: EncodeOptions | None) -> BytesIO:
+    # putpalette() turns the L image into a P image over the same indices
+    image = Image.fromarray(label_map)
+    image.putpalette(PALETTE.tobytes())
+    out = BytesIO()
+    level = encoding.png_compression if encoding is not None and encoding.png_compression is not None else 6
+    image.save(out, format="PNG", compress_level=level)
+    return out
+
+
+def render(label_map: np.ndarray, output: str = "color", alpha: float = 0.5, rgb: np.ndarray | None = None,
+           size: tuple[int, int] | None = None, encoding: EncodeOptions | None = None):
+    """
+    Turns a label map into the requested output, first scaling it back up to
+    size (height, width) if it was computed on a downscaled input. npy always
+    returns the label map itself.
+    """
+    if size is not None and label_map.shape != size:
+        label_map = cv2.resize(label_map, (size[1], size[0]), interpolation=cv2.INTER_NEAREST)
+    if output == "counts":
+        return BytesIO(json.dumps(class_counts(label_map)).encode())
+    if output == "labels" or (encoding is not None and encoding.raw):
+        return tasks.encode_image(label_map, encoding)
+    if output == "palette":
+        return _palettized_png(label_map, encoding)
+    colors = colorize(label_map)
+    if output == "overlay":
+        colors = cv2.addWeighted(cv2.cvtColor(rgb, cv2.COLOR_RGB2BGR), 1 - alpha, colors, alpha, 0)
+    return tasks.encode_image(colors, encoding)
+
+
+def _render_timed(*args, **kwargs):
+    with metrics.stage("encode", "segment"):
+        return render(*args, **kwargs)
+
+
+async def segment_image(image_bytes: bytes | tasks.DecodedImage, output: str = "color", alpha: float = 0.5,
+                        tier: str | None = None, encoding: EncodeOptions | None = None):
+    """
+    Decodes (and downscales for the tier) on the worker pool, waits for the
+    model's batch worker and renders the label map on the worker pool again.
+    """
+    tier = tier or config.SEGMENT_TIER
+    check_ready(tier)
+    rgb, small = await executor.run(_prepare, image_bytes, TIERS[tier].max_side)
+    timeout = executor.timeout()
+    try:
+        with metrics.stage("inference", "segment"):
+            label_map = await asyncio.wait_for(asyncio.wrap_future(predict(small, tier)), timeout)
+    except asyncio.TimeoutError:
+        raise executor.TaskTimeout(f"segmentation did not finish within {timeout:g}s")
+    return await executor.run(_render_timed, label_map, output, alpha, rgb if output == "overlay" else None,
+                              rgb.shape[:2], encoding=encoding)
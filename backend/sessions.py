@@ -0,0 +1,152 @@
+"""
+Live sessions over a WebSocket (/api/session): the client sends its image
+once and then a stream of task requests, e.g. one per slider movement, and
+gets the encoded results back on the same connection.
+
+Messages from the client are
+
+    <binary>                      the image; sending another one replaces it
+    {"image_id": "..."}           an image stored through POST /api/images
+    {"id": 7, "task": "gaussian", "params": {"ksize": 9},
+     "format": "jpeg", "quality": 80, "max_side": 512}
+
+and the server answers with
+
+    {"type": "image", "image_id": "...", "width": 3840, "height": 2160}
+    {"type": "result", "id": 7, "task": "gaussian", "media_type": "image/jpeg", "bytes": 81234}
+    <binary>                      the body of the result just announced
+    {"type": "skipped", "id": 6}  superseded before it started
+    {"type": "error", "id": 7, "status": 400, "detail": "..."}
+
+The image stays decoded for the whole session. Only one request runs at a
+time and only the newest one waits behind it: a request that arrives while
+another is waiting replaces it, so a fast slider never builds a backlog. A
+request that is already computing is finished and sent, since it is the
+freshest result the client can get until the next one is done.
+"""
+import asyncio
+import json
+
+from fastapi import WebSocket, WebSocketDisconnect
+
+import config
+
+TRY_AGAIN_LATER = 1013  # close code for a connection over the session limit
+
+_active = 0
+
+
+class SessionError(ValueError):
+    """Raised for a message the session can't understand."""
+
+
+def parse(text: str) -> dict:
+    try:
+        message = json.loads(text)
+    except json.JSONDecodeError as e:
+        raise SessionError(f"Message is not valid JSON: {e}")
+    if not isinstance(message, dict):
+        raise SessionError("Messages must be JSON objects")
+    return message
+
+
+class Session:
+    """
+    One connection. load(data) turns a binary message or an image_id message
+    into (image, info) and render(image, request) computes a request on it,
+    returning (media_type, body); both may raise an exception with
+    status_code and detail attributes such as HTTPException.
+    """
+
+    def __init__(self, websocket: WebSocket, load, render):
+        self.websocket = websocket
+        self.load = load
+        self.render = render
+        self.image = None
+        self._image_message = None
+        self._request = None
+        self._wake = asyncio.Event()
+        self._sending = asyncio.Lock()
+
+    async def run(self):
+        global _active
+        if _active >= config.MAX_SESSIONS:
+            await self.websocket.close(TRY_AGAIN_LATER, f"At most {config.MAX_SESSIONS} sessions at a time")
+            return
+        await self.websocket.accept()
+        _active += 1
+        worker = asyncio.create_task(self._work())
+        try:
+            while True:
+                message = await self.websocket.receive()
+                if message["type"] == "websocket.disconnect":
+                    break
+                await self._receive(message)
+        except WebSocketDisconnect:
+            pass
+        finally:
+            _active -= 1
+            # work already on the pool finishes there; its result is dropped
+            worker.cancel()
+
+    async def _receive(self, message: dict):
+        if message.get("bytes") is not None:
+            self._image_message = message["bytes"]
+            self._wake.set()
+            return
+        try:
+            request = parse(message.get("text") or "")
+        except SessionError as e:
+            await self._send({"type": "error", "id": None, "status": 400, "detail": str(e)})
+            return
+        if "image_id" in request and "task" not in request:
+            self._image_message = request
+        else:
+            superseded, self._request = self._request, request
+            if superseded is not None:
+                await self._send({"type": "skipped", "id": superseded.get("id")})
+        self._wake.set()
+
+    async def _work(self):
+        while True:
+            await self._wake.wait()
+            self._wake.clear()
+            if self._image_message is not None:
+                data, self._image_message = self._image_message, None
+                try:
+                    self.image, info = await self.load(data)
+                    await self._send({"type": "image", **info})
+                except Exception as e:
+                    await self._error(None, e)
+            if self._request is not None:
+                request, self._request = self._request, None
+                await self._compute(request)
+
+    async def _compute(self, request: dict):
+        if self.image is None:
+            await self._send({"type": "error", "id": request.get("id"), "status": 409,
+                              "detail": "Send an image before any task"})
+            return
+        try:
+            media_type, body = await self.render(self.image, request)
+        except Exception as e:
+            await self._error(request.get("id"), e)
+            return
+        header = {"type": "result", "id": request.get("id"), "task": request.get("task"),
+                  "media_type": media_type, "bytes": len(body)}
+        await self._send(header, body)
+
+    async def _error(self, request_id, e: Exception):
+        await self._send({"type": "error", "id": request_id, "status": getattr(e, "status_code", 500),
+                          "detail": getattr(e, "detail", str(e))})
+
+    async def _send(self, message: dict, body: bytes | None = None):
+        # the reader and the worker both send; a result and its body stay adjacent
+        async with self._sending:
+            await self.websocket.send_text(json.dumps(message))
+            if body is not None:
+                await self.websocket.send_bytes(body)
+
+
+def active() -> int:
+    return _active
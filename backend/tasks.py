@@ -1,304 +1,332 @@
+import json
+
 import cv2
 import numpy as np
-from io import BytesIO
+from io import BufferedReader, BytesIO, RawIOBase
 import zipfile
-
-
-def decode_image(image_bytes: bytes):
-    nparr = np.frombuffer(image_bytes, np.uint8)
-    img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+import compose
+import config
+import metrics
+import ops
+import tiling
+from encoding import EncodeOptions, NpyBuffer
+
+
+# Pillow's own decompression-bomb guard, aligned with ours
+Image.MAX_IMAGE_PIXELS = config.MAX_IMAGE_PIXELS
+
+
+class ImageTooLarge(ValueError):
+    """Raised when an upload's header declares more pixels than allowed."""
+
+
+class _BufferReader(RawIOBase):
+    """Seekable read-only file over a bytes-like object, without copying it."""
+
+    def __init__(self, buffer):
+        self._view = memoryview(buffer).cast("B")
+        self._position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        chunk = self._view[self._position:self._position + len(b)]
+        b[:len(chunk)] = chunk
+        self._position += len(chunk)
+        return len(chunk)
+
+    def seek(self, offset: int, whence: int = 0) -> int:
+        base = (0, self._position, len(self._view))[whence]
+        self._position = max(0, base + offset)
+        return self._position
+
+    def tell(self) -> int:
+        return self._position
+
+
+def check_image_size(image_bytes) -> tuple[int, int] | None:
+    """
+    Reads only the image header and rejects images with more than
+    config.MAX_IMAGE_PIXELS pixels before anything is decoded, returning the
+    (width, height) it declares. Formats Pillow can't identify are left for
+    cv2.imdecode to accept or reject, and give None.
+    """
+    try:
+        with Image.open(BufferedReader(_BufferReader(image_bytes))) as header:
+            width, height = header.size
+    except Image.DecompressionBombError:
+        raise ImageTooLarge(f"Image exceeds the {config.MAX_IMAGE_PIXELS} pixel limit")
+    except Exception:
+        return None
+    if width * height > config.MAX_IMAGE_PIXELS:
+        raise ImageTooLarge(f"Image is {width}x{height}, which exceeds the {config.MAX_IMAGE_PIXELS} pixel limit")
+    return width, height
+
+
+class DecodedImage:
+    """
+    An upload decoded ahead of time (see image_store.py). Task functions
+    accept one in place of the raw image bytes and skip cv2.imdecode.
+    """
+
+    def __init__(self, bgr: np.ndarray | None, gray: np.ndarray | None):
+        # shared between requests, so nothing may write into them
+        for img in (bgr, gray):
+            if img is not None:
+                img.flags.writeable = False
+        self.bgr = bgr
+        self.gray = gray
+
+    @property
+    def nbytes(self) -> int:
+        return sum(img.nbytes for img in (self.bgr, self.gray) if img is not None)
+
+    @classmethod
+    def from_bytes(cls, image_bytes: bytes) -> "DecodedImage":
+        check_image_size(image_bytes)
+        nparr = np.frombuffer(image_bytes, np.uint8)
+        bgr = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+        if bgr is None:
+            raise Exception("Invalid image data")
+        # decoded separately rather than converted so results match the
+        # IMREAD_GRAYSCALE path used for raw uploads exactly
+        return cls(bgr, cv2.imdecode(nparr, cv2.IMREAD_GRAYSCALE))
+
+    @classmethod
+    def decode_for(cls, image_bytes: bytes, name: str) -> "DecodedImage":
+        """Only the colour space the operation reads, for reuse within one request."""
+        img = decode_for(image_bytes, name)
+        return cls(None, img) if name in ops.GRAY_INPUT else cls(img, None)
+
+
+# decode flags -> reduction factor -> the flag that decodes at that fraction
+# of the size; JPEGs are reduced in the DCT domain, without a full decode
+_REDUCED = {
+    cv2.IMREAD_COLOR: {2: cv2.IMREAD_REDUCED_COLOR_2, 4: cv2.IMREAD_REDUCED_COLOR_4, 8: cv2.IMREAD_REDUCED_COLOR_8},
+    cv2.IMREAD_GRAYSCALE: {2: cv2.IMREAD_REDUCED_GRAYSCALE_2, 4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+                           8: cv2.IMREAD_REDUCED_GRAYSCALE_8},
+}
+
+
+class Preview:
+    """
+    An upload or stored image to be processed at reduced resolution, with
+    its longest side scaled down to max_side. Task functions accept one in
+    place of the image bytes; after decoding, factor holds the scale that was
+    applied, for ops.scale_params.
+    """
+
+    def __init__(self, source: bytes | memoryview | DecodedImage, max_side: int):
+        self.source = source
+        self.max_side = max_side
+        self.factor = 1.0
+
+    def __getstate__(self):
+        # memory-mapped uploads can't be pickled across to process workers
+        source = bytes(self.source) if isinstance(self.source, memoryview) else self.source
+        return {"source": source, "max_side": self.max_side, "factor": self.factor}
+
+    def decode(self, flags: int = cv2.IMREAD_COLOR) -> np.ndarray:
+        if isinstance(self.source, DecodedImage):
+            img = decode_image(self.source, flags)
+            return self._shrink(img, max(img.shape[:2]))
+        size = check_image_size(self.source)
+        longest = max(size) if size else 0
+        reduce = next((factor for factor in (8, 4, 2) if longest // factor >= self.max_side), 1)
+        img = cv2.imdecode(np.frombuffer(self.source, np.uint8), _REDUCED[flags][reduce] if reduce > 1 else flags)
+        if img is None:
+            raise Exception("Invalid image data")
+        return self._shrink(img, longest or max(img.shape[:2]))
+
+    def _shrink(self, img: np.ndarray, longest: int) -> np.ndarray:
+        # longest is the full image's; the side lengths come from the decoded
+        # image, which may be EXIF-rotated or already reduced
+        self.factor = min(1.0, self.max_side / longest)
+        height, width = img.shape[:2]
+        scale = longest * self.factor / max(height, width)
+        if scale >= 1:
+            return img
+        return cv2.resize(img, (max(1, round(width * scale)), max(1, round(height * scale))),
+                          interpolation=cv2.INTER_AREA)
+
+
+def decode_image(image_bytes: bytes | DecodedImage | Preview, flags: int = cv2.IMREAD_COLOR):
+    if isinstance(image_bytes, DecodedImage):
+        img = image_bytes.gray if flags == cv2.IMREAD_GRAYSCALE else image_bytes.bgr
+        if img is None:
+            raise ValueError("The image was not decoded in the colour space this task reads")
+        return img
+    if isinstance(image_bytes, Preview):
+        return image_bytes.decode(flags)
+    check_image_size(image_bytes)
+    nparr = np.frombuffer(image_bytes, np.uint8)
+    img = cv2.imdecode(nparr, flags)
     if img is None:
         raise Exception("Invalid image data")
     return img
 
-def encode_image(img) -> BytesIO:
-    success, encoded = cv2.imencode(".png", img)
+def encode_image(img, encoding: EncodeOptions | None = None) -> BytesIO | NpyBuffer:
+    if encoding is not None and encoding.raw:
+        return NpyBuffer(img)
+    if encoding is None:
+        success, encoded = cv2.imencode(".png", img)
+    else:
+        success, encoded = cv2.imencode(encoding.extension, img, encoding.imencode_params())
     if not success:
         raise Exception("Failed to encode image")
     return BytesIO(encoded.tobytes())
 
+def decode_gray(image_bytes: bytes | DecodedImage):
+    return decode_image(image_bytes, cv2.IMREAD_GRAYSCALE)
+
+def decode_for(image_bytes: bytes | DecodedImage, name: str):
+    """Decodes the image in the colour space the operation expects."""
+    return decode_gray(image_bytes) if name in ops.GRAY_INPUT else decode_image(image_bytes)
+
+def apply_operation(img, name: str, params: dict, raw: bool = False):
+    fn = ops.OPERATIONS[name]
+    if raw:
+        # raw output skips the final conversion to 8 bits where there is one
+        fn = ops.RAW_OUTPUTS.get(name, fn)
+    if tiling.should_tile(name, img):
+        return tiling.apply_tiled(fn, img, params, tiling.HALOS[name](**params))
+    return fn(img, **params)
+
+def run_operation(image_bytes: bytes | DecodedImage, name: str, params: dict,
+                  encoding: EncodeOptions | None = None) -> BytesIO:
+    """Decodes the image in the colour space the operation expects, applies it and encodes the result."""
+    with metrics.stage("decode", name):
+        img = decode_for(image_bytes, name)
+    if isinstance(image_bytes, Preview):
+        params = ops.scale_params(name, params, image_bytes.factor)
+    with metrics.stage("compute", name):
+        result = apply_operation(img, name, params, raw=encoding is not None and encoding.raw)
+    with metrics.stage("encode", name):
+        return encode_image(result, encoding)
+
+def run_detection(image_bytes: bytes | DecodedImage, name: str, params: dict,
+                  encoding: EncodeOptions | None = None) -> BytesIO:
+    """Runs the ops.DETECTIONS entry for name and returns its result as JSON, without drawing or encoding an image."""
+    with metrics.stage("decode", name):
+        img = decode_for(image_bytes, name)
+    if isinstance(image_bytes, Preview):
+        params = ops.scale_params(name, params, image_bytes.factor)
+    with metrics.stage("compute", name):
+        result = ops.DETECTIONS[name](img, **params)
+    with metrics.stage("encode", name):
+        return BytesIO(json.dumps(result).encode())
+
 def get_gaussian(image_bytes: bytes, ksize: int, sigmaX: float) -> BytesIO:
-    img = decode_image(image_bytes)
-    blurred = cv2.GaussianBlur(img, (ksize, ksize), sigmaX)
-    return encode_image(blurred)
+    return encode_image(ops.gaussian(decode_image(image_bytes), ksize, sigmaX))
 
 def get_sobel(image_bytes: bytes, dx: int, dy: int, ksize: int) -> BytesIO:
-    img = decode_image(image_bytes)
-    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-    sobel = cv2.Sobel(gray, cv2.CV_64F, dx, dy, ksize=ksize)
-    sobel = cv2.convertScaleAbs(sobel)
-    return encode_image(sobel)
+    return encode_image(ops.sobel(decode_image(image_bytes), dx, dy, ksize))
 
 def get_prewitt(image_bytes: bytes, axis: str) -> BytesIO:
-    img = decode_image(image_bytes)
-    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-
-    kernelx = np.array([[1, 0, -1], [1, 0, -1], [1, 0, -1]])
-    kernely = np.array([[1, 1, 1], [0, 0, 0], [-1, -1, -1]])
-
-    if axis == "x":
-        prewitt = cv2.filter2D(gray, -1, kernelx)
-    elif axis == "y":
-        prewitt = cv2.filter2D(gray, -1, kernely)
-    elif axis == "both":
-        gx = cv2.filter2D(gray, cv2.CV_64F, kernelx)
-        gy = cv2.filter2D(gray, cv2.CV_64F, kernely)
-        # Combine gradients via Euclidean norm
-        prewitt = np.sqrt(gx**2 + gy**2)
-    else:
-        raise ValueError("Invalid axis. Use 'x' or 'y'.")
-    prewitt = np.uint8(np.clip(prewitt, 0, 255))
-    return encode_image(prewitt)
+    return encode_image(ops.prewitt(decode_image(image_bytes), axis))
 
 def get_negative(image_bytes: bytes) -> BytesIO:
-    # Convert bytes to NumPy array
-    nparr = np.frombuffer(image_bytes, np.uint8)
-    img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-
-    # Apply negative transformation
-    negative = cv2.bitwise_not(img)
-
-    # Encode image to PNG in memory
-    success, encoded_image = cv2.imencode(".png", negative)
-    if not success:
-        raise Exception("Failed to encode image")
-
-    # Wrap in BytesIO to return as response
-    return BytesIO(encoded_image.tobytes())
+    return encode_image(ops.negative(decode_image(image_bytes)))
 
 def get_resized(image_bytes: bytes) -> BytesIO:
-    # Convert bytes to NumPy array
-    nparr = np.frombuffer(image_bytes, np.uint8)
-    img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-    
     # Resize the image to 256 x 256 pixels
-    resized = cv2.resize(img, (256, 256))
-    
-    # Encode the resized image to PNG format in memory
-    success, encoded_image = cv2.imencode(".png", resized)
-    if not success:
-        raise Exception("Failed to encode image")
-    
-    # Wrap the encoded image in BytesIO to return as response
-    return BytesIO(encoded_image.tobytes())
+    return encode_image(ops.resize(decode_image(image_bytes), 256, 256))
 
 
 def get_grayscale(image_bytes: bytes) -> BytesIO:
-    # Convert bytes to a NumPy array
-    nparr = np.frombuffer(image_bytes, np.uint8)
-    img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-    
-    # Convert the image to grayscale
-    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-    
-    # Encode the grayscale image to PNG format in memory
-    success, encoded_image = cv2.imencode(".png", gray)
-    if not success:
-        raise Exception("Failed to encode image")
-    
-    # Wrap the encoded image in BytesIO to return as response
-    return BytesIO(encoded_image.tobytes())
+    return encode_image(ops.grayscale(decode_gray(image_bytes)))
 
 
 def get_binary(image_bytes: bytes) -> BytesIO:
-    # Convert bytes to a NumPy array
-    nparr = np.frombuffer(image_bytes, np.uint8)
-    img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-    
-    # Convert the image to grayscale
-    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-    
-    # Convert the grayscale image to a binary image using thresholding
-    _, binary = cv2.threshold(gray, 127, 255, cv2.THRESH_BINARY)
-    
-    # Encode the binary image to PNG format in memory
-    success, encoded_image = cv2.imencode(".png", binary)
-    if not success:
-        raise Exception("Failed to encode image")
-    
-    # Wrap the encoded image in BytesIO to return as response
-    return BytesIO(encoded_image.tobytes())
+    return encode_image(ops.binary(decode_image(image_bytes)))
+
+
+_decode_pool: ThreadPoolExecutor | None = None
+
+
+def decode_images(sources: list) -> list[np.ndarray]:
+    """Decodes several images at once; cv2.imdecode releases the GIL."""
+    global _decode_pool
+    if len(sources) == 1 or config.DECODE_WORKERS <= 1:
+        return [decode_image(source) for source in sources]
+    if _decode_pool is None:
+        _decode_pool = ThreadPoolExecutor(max_workers=config.DECODE_WORKERS, thread_name_prefix="pixels-decode")
+    return list(_decode_pool.map(decode_image, sources))
+
+
+def get_composite(sources: tuple, op: str, alignment: str = "resize-smaller", params: dict | None = None,
+                  encoding: EncodeOptions | None = None) -> BytesIO | NpyBuffer:
+    """Decodes every input, aligns their sizes and combines them with compose.OPERATIONS[op]."""
+    task = f"compose/{op}"
+    with metrics.stage("decode", task):
+        images = decode_images(list(sources))
+    with metrics.stage("compute", task):
+        result = compose.compose(images, op, alignment, **(params or {}))
+    with metrics.stage("encode", task):
+        return encode_image(result, encoding)
 
 
 def get_bitwise_and(image_bytes1: bytes, image_bytes2: bytes) -> BytesIO:
-    # Convert both image bytes to NumPy arrays
-    nparr1 = np.frombuffer(image_bytes1, np.uint8)
-    nparr2 = np.frombuffer(image_bytes2, np.uint8)
-    
-    # Decode the images into color format
-    img1 = cv2.imdecode(nparr1, cv2.IMREAD_COLOR)
-    img2 = cv2.imdecode(nparr2, cv2.IMREAD_COLOR)
-    
-    # Ensure both images have the same dimensions.
-    # Resize both images to the dimensions of the smaller image.
-    rows1, cols1, _ = img1.shape
-    rows2, cols2, _ = img2.shape
-    rows = min(rows1, rows2)
-    cols = min(cols1, cols2)
-    img1 = cv2.resize(img1, (cols, rows))
-    img2 = cv2.resize(img2, (cols, rows))
-    
-    # Apply the bitwise AND operation
-    result = cv2.bitwise_and(img1, img2)
-    
-    # Encode the result to PNG format in memory
-    success, encoded_image = cv2.imencode(".png", result)
-    if not success:
-        raise Exception("Failed to encode image")
-    
-    # Wrap the encoded image in BytesIO to return as response
-    return BytesIO(encoded_image.tobytes())
+    return get_composite((image_bytes1, image_bytes2), "and")
 
 def get_bitwise_or(image_bytes1: bytes, image_bytes2: bytes) -> BytesIO:
-    # Convert bytes to NumPy arrays
-    nparr1 = np.frombuffer(image_bytes1, np.uint8)
-    nparr2 = np.frombuffer(image_bytes2, np.uint8)
-    img1 = cv2.imdecode(nparr1, cv2.IMREAD_COLOR)
-    img2 = cv2.imdecode(nparr2, cv2.IMREAD_COLOR)
-
-    # Resize images to common dimensions
-    rows1, cols1, _ = img1.shape
-    rows2, cols2, _ = img2.shape
-    rows = min(rows1, rows2)
-    cols = min(cols1, cols2)
-    img1 = cv2.resize(img1, (cols, rows))
-    img2 = cv2.resize(img2, (cols, rows))
-
-    # Apply bitwise OR operation
-    result = cv2.bitwise_or(img1, img2)
-
-    # Encode result image to PNG in memory
-    success, encoded_image = cv2.imencode(".png", result)
-    if not success:
-        raise Exception("Failed to encode image")
-    
-    return BytesIO(encoded_image.tobytes())
-
+    return get_composite((image_bytes1, image_bytes2), "or")
 
 def get_bitwise_xor(image_bytes1: bytes, image_bytes2: bytes) -> BytesIO:
-    # Convert bytes to NumPy arrays
-    nparr1 = np.frombuffer(image_bytes1, np.uint8)
-    nparr2 = np.frombuffer(image_bytes2, np.uint8)
-    img1 = cv2.imdecode(nparr1, cv2.IMREAD_COLOR)
-    img2 = cv2.imdecode(nparr2, cv2.IMREAD_COLOR)
-
-    # Resize images to common dimensions
-    rows1, cols1, _ = img1.shape
-    rows2, cols2, _ = img2.shape
-    rows = min(rows1, rows2)
-    cols = min(cols1, cols2)
-    img1 = cv2.resize(img1, (cols, rows))
-    img2 = cv2.resize(img2, (cols, rows))
-
-    # Apply bitwise XOR operation
-    result = cv2.bitwise_xor(img1, img2)
-
-    # Encode result image to PNG in memory
-    success, encoded_image = cv2.imencode(".png", result)
-    if not success:
-        raise Exception("Failed to encode image")
-    
-    return BytesIO(encoded_image.tobytes())
+    return get_composite((image_bytes1, image_bytes2), "xor")
 
 
 def get_log_transformation(image_bytes: bytes) -> BytesIO:
-    # Convert bytes to a NumPy array
-    nparr = np.frombuffer(image_bytes, np.uint8)
-    # Decode the image as grayscale
-    gray = cv2.imdecode(nparr, cv2.IMREAD_GRAYSCALE)
-    
-    # Compute the constant c based on the maximum intensity
-    c = 255 / np.log(1 + 255)  # log(256)
-    # Apply logarithmic transformation
-    log_transformed = np.uint8(c * np.log1p(gray))
-    
-    # Encode the transformed image to PNG format in memory
-    success, encoded_image = cv2.imencode(".png", log_transformed)
-    if not success:
-        raise Exception("Failed to encode image")
-    
-    # Wrap the encoded image in BytesIO to return as response
-    return BytesIO(encoded_image.tobytes())
+    return encode_image(ops.log_transformation(decode_gray(image_bytes)))
 
 
 def get_inverse_log_transformation(image_bytes: bytes) -> BytesIO:
-    # Convert bytes to a NumPy array
-    nparr = np.frombuffer(image_bytes, np.uint8)
-    # Decode the image as grayscale
-    gray = cv2.imdecode(nparr, cv2.IMREAD_GRAYSCALE)
-    
-    # Normalize the image to the range [0, 1]
-    gray_norm = gray / 255.0
-    # Compute the constant c
-    c = 255 / (np.exp(1) - 1)
-    # Apply the inverse log (exponential) transformation
-    exp_transformed = np.uint8(c * np.expm1(gray_norm))
-    
-    # Encode the transformed image to PNG format in memory
-    success, encoded_image = cv2.imencode(".png", exp_transformed)
-    if not success:
-        raise Exception("Failed to encode image")
-    
-    # Wrap the encoded image in BytesIO to return as response
-    return BytesIO(encoded_image.tobytes())
-
+    return encode_image(ops.inverse_log_transformation(decode_gray(image_bytes)))
 
 
 def get_power_law_transformation(image_bytes: bytes, gamma: float = 0.5) -> BytesIO:
-    # Convert bytes to a NumPy array
-    nparr = np.frombuffer(image_bytes, np.uint8)
-    # Decode the image as grayscale
-    gray = cv2.imdecode(nparr, cv2.IMREAD_GRAYSCALE)
-    
-    # Apply power law (gamma) transformation
-    power_law = np.uint8(255 * np.power(gray / 255.0, gamma))
-    
-    # Encode the transformed image to PNG format in memory
-    success, encoded_image = cv2.imencode(".png", power_law)
-    if not success:
-        raise Exception("Failed to encode image")
-    
-    # Wrap the encoded image in BytesIO to return as response
-    return BytesIO(encoded_image.tobytes())
+    return encode_image(ops.power_law(decode_gray(image_bytes), gamma))
 
 
 def rotate_image(image_bytes: bytes, angle: float = 0.0, scale: float = 1.0) -> BytesIO:
-    nparr = np.frombuffer(image_bytes, np.uint8)
-    img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-    (h, w) = img.shape[:2]
-    center = (w / 2, h / 2)
-    rotation_matrix = cv2.getRotationMatrix2D(center, angle, scale)
-    rotated_img = cv2.warpAffine(img, rotation_matrix, (w, h))
-    success, encoded_image = cv2.imencode(".png", rotated_img)
-    if not success:
-        raise Exception("Failed to encode image")
-    return BytesIO(encoded_image.tobytes())
+    return encode_image(ops.rotate(decode_image(image_bytes), angle, scale))
 
 
-def get_rgb_channels(image_bytes: bytes) -> BytesIO:
+def get_rgb_channels(image_bytes: bytes, encoding: EncodeOptions | None = None) -> BytesIO:
+    encoding = encoding or EncodeOptions()
     # Decode the input image
-    nparr = np.frombuffer(image_bytes, np.uint8)
-    img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+    with metrics.stage("decode", "rgb-channels"):
+        img = decode_image(image_bytes)
 
-    # Split channels (OpenCV uses BGR by default)
-    b, g, r = cv2.split(img)
+    with metrics.stage("compute", "rgb-channels"):
+        # Split channels (OpenCV uses BGR by default)
+        b, g, r = cv2.split(img)
 
-    # Create full 3-channel images from each
-    r_img = cv2.merge([np.zeros_like(r), np.zeros_like(r), r])  # Red only
-    g_img = cv2.merge([np.zeros_like(g), g, np.zeros_like(g)])  # Green only
-    b_img = cv2.merge([b, np.zeros_like(b), np.zeros_like(b)])  # Blue only
+        # Create full 3-channel images from each
+        r_img = cv2.merge([np.zeros_like(r), np.zeros_like(r), r])  # Red only
+        g_img = cv2.merge([np.zeros_like(g), g, np.zeros_like(g)])  # Green only
+        b_img = cv2.merge([b, np.zeros_like(b), np.zeros_like(b)])  # Blue only
 
     # Encode each image
-    encoded_r = cv2.imencode(".png", r_img)[1].tobytes()
-    encoded_g = cv2.imencode(".png", g_img)[1].tobytes()
-    encoded_b = cv2.imencode(".png", b_img)[1].tobytes()
+    with metrics.stage("encode", "rgb-channels"):
+        encoded_r = encode_image(r_img, encoding).getvalue()
+        encoded_g = encode_image(g_img, encoding).getvalue()
+        encoded_b = encode_image(b_img, encoding).getvalue()
 
     # Create in-memory ZIP
     zip_buffer = BytesIO()
     with zipfile.ZipFile(zip_buffer, "w") as zip_file:
-        zip_file.writestr("red.png", encoded_r)
-        zip_file.writestr("green.png", encoded_g)
-        zip_file.writestr("blue.png", encoded_b)
+        zip_file.writestr(f"red{encoding.extension}", encoded_r)
+        zip_file.writestr(f"green{encoding.extension}", encoded_g)
+        zip_file.writestr(f"blue{encoding.extension}", encoded_b)
 
     zip_buffer.seek(0)
     return zip_buffer
@@ -306,394 +334,89 @@ def get_rgb_channels(image_bytes: bytes) -> BytesIO:
 
 # laplacian filter:
 def get_laplacian(image_bytes: bytes) -> BytesIO:
-    import cv2
-    import numpy as np
-    from io import BytesIO
-
-    # Convert bytes to a NumPy array
-    nparr = np.frombuffer(image_bytes, np.uint8)
-    img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-    
-    # Convert the image to grayscale
-    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-    
-    # Apply Laplacian filter
-    laplacian = cv2.Laplacian(gray, ddepth=cv2.CV_64F)
-    
-    # Convert the result to 8-bit absolute value
-    laplacian = cv2.convertScaleAbs(laplacian)
-    
-    # Encode the Laplacian image to PNG format in memory
-    success, encoded_image = cv2.imencode(".png", laplacian)
-    if not success:
-        raise Exception("Failed to encode image")
-    
-    # Wrap the encoded image in BytesIO to return as response
-    return BytesIO(encoded_image.tobytes())
+    return encode_image(ops.laplacian(decode_image(image_bytes)))
 
 
 def get_max_filter(image_bytes: bytes,
                    kernel_size: int = 3) -> BytesIO:
-    img = decode_image(image_bytes)
-    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-
-    if kernel_size < 1 or kernel_size % 2 == 0:
-        raise ValueError("kernel_size must be an odd integer >= 3")
-
-    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (kernel_size, kernel_size))
-    maxed = cv2.dilate(gray, kernel)
-    return encode_image(maxed)
+    return encode_image(ops.max_filter(decode_gray(image_bytes), kernel_size))
 
 
 def get_min_filter(image_bytes: bytes,
                    kernel_size: int = 3) -> BytesIO:
-    img = decode_image(image_bytes)
-    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-
-    if kernel_size < 1 or kernel_size % 2 == 0:
-        raise ValueError("kernel_size must be an odd integer >= 3")
-
-    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (kernel_size, kernel_size))
-    mined = cv2.erode(gray, kernel)
-    return encode_image(mined)
+    return encode_image(ops.min_filter(decode_gray(image_bytes), kernel_size))
 
 
 def get_midpoint_filter(image_bytes: bytes,
                         kernel_size: int = 3) -> BytesIO:
-    img = decode_image(image_bytes)
-    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-
-    if kernel_size < 1 or kernel_size % 2 == 0:
-        raise ValueError("kernel_size must be an odd integer >= 3")
-
-    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (kernel_size, kernel_size))
-    maxed = cv2.dilate(gray, kernel).astype(np.float64)
-    mined = cv2.erode(gray, kernel).astype(np.float64)
-
-    midpoint = ((maxed + mined) / 2.0)
-    midpoint = np.uint8(np.clip(midpoint, 0, 255))
-    return encode_image(midpoint)
+    return encode_image(ops.midpoint_filter(decode_gray(image_bytes), kernel_size))
 
 def get_median_filter(image_bytes: bytes,
                       kernel_size: int = 3) -> BytesIO:
-    
-    img = decode_image(image_bytes)
-    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-
-    if kernel_size < 1 or kernel_size % 2 == 0:
-        raise ValueError("kernel_size must be an odd integer >= 3")
-
-    median = cv2.medianBlur(gray, kernel_size)
-    return encode_image(median)
+    return encode_image(ops.median_filter(decode_gray(image_bytes), kernel_size))
 
 def decode_and_apply_power_law(image_bytes: bytes, gamma: float = 1.0):
-    # Decode image from bytes
-    nparr = np.frombuffer(image_bytes, np.uint8)
-    img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-    if img is None:
-        raise Exception("Invalid image data")
-
-    # Normalize the image to range [0, 1]
-    img_normalized = img / 255.0
-
-    # Apply power law transformation
-    img_gamma_corrected = np.power(img_normalized, gamma)
-
-    # Scale back to range [0, 255]
-    img_result = np.uint8(img_gamma_corrected * 255)
-
-    return img_result
+    return ops.power_law(decode_image(image_bytes), gamma)
 
 def get_scaled_image(image_bytes: bytes, fx: float, fy: float):
-    nparr = np.frombuffer(image_bytes, np.uint8)
-    img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-    if img is None:
-        raise Exception("Invalid image data")
-
-    img_scaled = cv2.resize(img, None, fx=fx, fy=fy, interpolation=cv2.INTER_LINEAR)
-
-    _, buffer = cv2.imencode('.png', img_scaled)
-    return BytesIO(buffer.tobytes())
+    return encode_image(ops.scale(decode_image(image_bytes), fx, fy))
 
 def get_rotated_image(image_bytes: bytes, angle: float):
-    nparr = np.frombuffer(image_bytes, np.uint8)
-    img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-    if img is None:
-        raise Exception("Invalid image data")
-
-    (h, w) = img.shape[:2]
-    center = (w // 2, h // 2)
-
-    matrix = cv2.getRotationMatrix2D(center, angle, 1.0)
-    rotated = cv2.warpAffine(img, matrix, (w, h))
-
-    _, buffer = cv2.imencode('.png', rotated)
-    return BytesIO(buffer.tobytes())
+    return encode_image(ops.rotate(decode_image(image_bytes), angle))
 
 def get_translated_image(image_bytes: bytes, tx: int, ty: int):
-    nparr = np.frombuffer(image_bytes, np.uint8)
-    img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-    if img is None:
-        raise Exception("Invalid image data")
-
-    rows, cols = img.shape[:2]
-    matrix = np.float32([[1, 0, tx], [0, 1, ty]])
-    translated = cv2.warpAffine(img, matrix, (cols, rows))
-
-    _, buffer = cv2.imencode('.png', translated)
-    return BytesIO(buffer.tobytes())
+    return encode_image(ops.translate(decode_image(image_bytes), tx, ty))
 
 def get_horizontal_sheared_image(image_bytes: bytes, shear_factor: float = 0.5) -> BytesIO:
-    nparr = np.frombuffer(image_bytes, np.uint8)
-    img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-    (h, w) = img.shape[:2]
-    shear_matrix = np.float32([[1, 0, 0], [shear_factor, 1, 0]])
-    new_height = int(h + abs(shear_factor) * w)
-    sheared_img = cv2.warpAffine(img, shear_matrix, (w, new_height))
-    success, encoded_image = cv2.imencode(".png", sheared_img)
-    if not success:
-        raise Exception("Failed to encode image")
-    return BytesIO(encoded_image.tobytes())
+    return encode_image(ops.shear_horizontal(decode_image(image_bytes), shear_factor))
 
 
 def get_vertical_sheared_image(image_bytes: bytes, shear_factor: float = 0.5) -> BytesIO:
-    nparr = np.frombuffer(image_bytes, np.uint8)
-    img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-    (h, w) = img.shape[:2]
-    shear_matrix = np.float32([[1, shear_factor, 0], [0, 1, 0]])
-    new_width = int(w + abs(shear_factor) * h)
-    sheared_img = cv2.warpAffine(img, shear_matrix, (new_width, h))
-    success, encoded_image = cv2.imencode(".png", sheared_img)
-    if not success:
-        raise Exception("Failed to encode image")
-    return BytesIO(encoded_image.tobytes())
+    return encode_image(ops.shear_vertical(decode_image(image_bytes), shear_factor))
 
 def add_gaussian_noise(image_bytes: bytes, mean: float = 0.0, std: float = 1.0):
-    nparr = np.frombuffer(image_bytes, np.uint8)
-    img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-    if img is None:
-        raise Exception("Invalid image data")
-
-    # Generate Gaussian noise
-    noise = np.random.normal(mean, std, img.shape).astype(np.uint8)
-    noisy_img = cv2.add(img, noise)
-
-    _, buffer = cv2.imencode('.png', noisy_img)
-    return BytesIO(buffer.tobytes())
+    return encode_image(ops.gaussian_noise(decode_image(image_bytes), mean, std))
 
 # Rayleigh Noise
 def add_rayleigh_noise(image_bytes: bytes, scale: float = 1.0):
-    nparr = np.frombuffer(image_bytes, np.uint8)
-    img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-    if img is None:
-        raise Exception("Invalid image data")
-
-    # Generate Rayleigh noise
-    noise = np.random.rayleigh(scale, img.shape).astype(np.uint8)
-    noisy_img = cv2.add(img, noise)
-
-    _, buffer = cv2.imencode('.png', noisy_img)
-    return BytesIO(buffer.tobytes())
+    return encode_image(ops.rayleigh_noise(decode_image(image_bytes), scale))
 
 def laplacian_of_gaussian(image_bytes: bytes, kernel_size: int = 5, sigma: float = 1.0):
-    nparr = np.frombuffer(image_bytes, np.uint8)
-    img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-    if img is None:
-        raise Exception("Invalid image data")
-
-    # Apply Gaussian blur and then Laplacian filter
-    blurred = cv2.GaussianBlur(img, (kernel_size, kernel_size), sigma)
-    laplacian = cv2.Laplacian(blurred, cv2.CV_64F)
-
-    # Convert to uint8 (8-bit) image
-    laplacian = cv2.convertScaleAbs(laplacian)
-
-    _, buffer = cv2.imencode('.png', laplacian)
-    return BytesIO(buffer.tobytes())
+    return encode_image(ops.laplacian_of_gaussian(decode_image(image_bytes), kernel_size, sigma))
 
 def high_pass_filter(image_bytes: bytes, kernel_size: int = 5):
-    nparr = np.frombuffer(image_bytes, np.uint8)
-    img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-    if img is None:
-        raise Exception("Invalid image data")
-
-    # Apply a Gaussian blur (low pass) to get the smoothed image
-    blurred = cv2.GaussianBlur(img, (kernel_size, kernel_size), 0)
-    
-    # High pass filter is the original image minus the blurred (low-pass) image
-    high_pass = cv2.subtract(img, blurred)
-
-    _, buffer = cv2.imencode('.png', high_pass)
-    return BytesIO(buffer.tobytes())
+    return encode_image(ops.high_pass(decode_image(image_bytes), kernel_size))
 
 def low_pass_filter(image_bytes: bytes, kernel_size: int = 5):
-    nparr = np.frombuffer(image_bytes, np.uint8)
-    img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-    if img is None:
-        raise Exception("Invalid image data")
-
-    # Apply Gaussian blur (Low pass filter)
-    blurred = cv2.GaussianBlur(img, (kernel_size, kernel_size), 0)
-
-    _, buffer = cv2.imencode('.png', blurred)
-    return BytesIO(buffer.tobytes())
+    return encode_image(ops.low_pass(decode_image(image_bytes), kernel_size))
 
 def high_boost_filter(image_bytes: bytes, boost_factor: float = 2.0, kernel_size: int = 5):
-    nparr = np.frombuffer(image_bytes, np.uint8)
-    img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-    if img is None:
-        raise Exception("Invalid image data")
-
-    # Apply a Gaussian blur (low pass filter) to get the smoothed image
-    blurred = cv2.GaussianBlur(img, (kernel_size, kernel_size), 0)
-    
-    # High pass filter is the original image minus the blurred (low-pass) image
-    high_pass = cv2.subtract(img, blurred)
-    
-    # High Boost Filter: add the boost factor multiplied high-pass component to the original image
-    boosted_image = cv2.addWeighted(img, 1 + boost_factor, high_pass, -boost_factor, 0)
-
-    # Ensure the image is valid by clipping pixel values to stay within valid range [0, 255]
-    boosted_image = np.clip(boosted_image, 0, 255).astype(np.uint8)
-
-    _, buffer = cv2.imencode('.png', boosted_image)
-    return BytesIO(buffer.tobytes())
+    return encode_image(ops.high_boost(decode_image(image_bytes), boost_factor, kernel_size))
 
 def canny_edge_detection(image_bytes: bytes, threshold1: int = 100, threshold2: int = 200):
-    nparr = np.frombuffer(image_bytes, np.uint8)
-    img = cv2.imdecode(nparr, cv2.IMREAD_GRAYSCALE)
-    if img is None:
-        raise Exception("Invalid image data")
-
-    edges = cv2.Canny(img, threshold1, threshold2)
-
-    _, buffer = cv2.imencode('.png', edges)
-    return BytesIO(buffer.tobytes())
+    return encode_image(ops.canny(decode_gray(image_bytes), threshold1, threshold2))
 
 def harris_corner_detection(image_bytes: bytes, block_size: int = 2, ksize: int = 3, k: float = 0.04, threshold: float = 0.01):
-    nparr = np.frombuffer(image_bytes, np.uint8)
-    img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-    if img is None:
-        raise Exception("Invalid image data")
-
-    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-    gray = np.float32(gray)
-
-    dst = cv2.cornerHarris(gray, block_size, ksize, k)
-    dst = cv2.dilate(dst, None)
-
-    img[dst > threshold * dst.max()] = [0, 0, 255]
-
-    _, buffer = cv2.imencode('.png', img)
-    return BytesIO(buffer.tobytes())
+    return encode_image(ops.harris(decode_image(image_bytes), block_size, ksize, k, threshold))
 
 def hough_circle_transform(image_bytes: bytes, dp: float = 1.2, min_dist: int = 100, param1: int = 100, param2: int = 30, min_radius: int = 0, max_radius: int = 0):
-    nparr = np.frombuffer(image_bytes, np.uint8)
-    img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-    if img is None:
-        raise Exception("Invalid image data")
-
-    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-    gray = cv2.medianBlur(gray, 5)
-
-    circles = cv2.HoughCircles(gray, cv2.HOUGH_GRADIENT, dp, minDist=min_dist,
-                               param1=param1, param2=param2,
-                               minRadius=min_radius, maxRadius=max_radius)
-
-    if circles is not None:
-        circles = np.uint16(np.around(circles))
-        for i in circles[0, :]:
-            cv2.circle(img, (i[0], i[1]), i[2], (0, 255, 0), 2)
-            cv2.circle(img, (i[0], i[1]), 2, (0, 0, 255), 3)
-
-    _, buffer = cv2.imencode('.png', img)
-    return BytesIO(buffer.tobytes())
+    img = decode_image(image_bytes)
+    return encode_image(ops.hough_circles(img, dp, min_dist, param1, param2, min_radius, max_radius))
 
 def hough_line_transform(image_bytes: bytes, rho: float = 1, theta: float = np.pi / 180, threshold: int = 100):
-    nparr = np.frombuffer(image_bytes, np.uint8)
-    img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-    if img is None:
-        raise Exception("Invalid image data")
-
-    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-    edges = cv2.Canny(gray, 50, 150)
-
-    lines = cv2.HoughLines(edges, rho, theta, threshold)
-    if lines is not None:
-        for rho, theta in lines[:, 0]:
-            a = np.cos(theta)
-            b = np.sin(theta)
-            x0 = a * rho
-            y0 = b * rho
-            x1 = int(x0 + 1000 * (-b))
-            y1 = int(y0 + 1000 * (a))
-            x2 = int(x0 - 1000 * (-b))
-            y2 = int(y0 - 1000 * (a))
-            cv2.line(img, (x1, y1), (x2, y2), (0, 0, 255), 2)
-
-    _, buffer = cv2.imencode('.png', img)
-    return BytesIO(buffer.tobytes())
+    return encode_image(ops.hough_lines(decode_image(image_bytes), rho, theta, threshold))
 
 def dilation_operation(image_bytes: bytes, kernel_size: int = 5, iterations: int = 1):
-    nparr = np.frombuffer(image_bytes, np.uint8)
-    img = cv2.imdecode(nparr, cv2.IMREAD_GRAYSCALE)
-    if img is None:
-        raise Exception("Invalid image data")
-
-    kernel = np.ones((kernel_size, kernel_size), np.uint8)
-    dilated = cv2.dilate(img, kernel, iterations=iterations)
-
-    _, buffer = cv2.imencode('.png', dilated)
-    return BytesIO(buffer.tobytes())
+    return encode_image(ops.dilation(decode_gray(image_bytes), kernel_size, iterations))
 
 def erosion_operation(image_bytes: bytes, kernel_size: int = 5, iterations: int = 1):
-    nparr = np.frombuffer(image_bytes, np.uint8)
-    img = cv2.imdecode(nparr, cv2.IMREAD_GRAYSCALE)
-    if img is None:
-        raise Exception("Invalid image data")
-
-    kernel = np.ones((kernel_size, kernel_size), np.uint8)
-    eroded = cv2.erode(img, kernel, iterations=iterations)
-
-    _, buffer = cv2.imencode('.png', eroded)
-    return BytesIO(buffer.tobytes())
+    return encode_image(ops.erosion(decode_gray(image_bytes), kernel_size, iterations))
 
 def opening_operation(image_bytes: bytes, kernel_size: int = 5):
-    nparr = np.frombuffer(image_bytes, np.uint8)
-    img = cv2.imdecode(nparr, cv2.IMREAD_GRAYSCALE)
-    if img is None:
-        raise Exception("Invalid image data")
-
-    kernel = np.ones((kernel_size, kernel_size), np.uint8)
-    opened = cv2.morphologyEx(img, cv2.MORPH_OPEN, kernel)
-
-    _, buffer = cv2.imencode('.png', opened)
-    return BytesIO(buffer.tobytes())
+    return encode_image(ops.opening(decode_gray(image_bytes), kernel_size))
 
 def closing_operation(image_bytes: bytes, kernel_size: int = 5):
-    nparr = np.frombuffer(image_bytes, np.uint8)
-    img = cv2.imdecode(nparr, cv2.IMREAD_GRAYSCALE)
-    if img is None:
-        raise Exception("Invalid image data")
-
-    kernel = np.ones((kernel_size, kernel_size), np.uint8)
-    closed = cv2.morphologyEx(img, cv2.MORPH_CLOSE, kernel)
-
-    _, buffer = cv2.imencode('.png', closed)
-    return BytesIO(buffer.tobytes())
+    return encode_image(ops.closing(decode_gray(image_bytes), kernel_size))
 
 def hit_miss_transform(image_bytes: bytes):
-    nparr = np.frombuffer(image_bytes, np.uint8)
-    img = cv2.imdecode(nparr, cv2.IMREAD_GRAYSCALE)
-    if img is None:
-        raise Exception("Invalid image data")
-
-    _, binary = cv2.threshold(img, 127, 255, cv2.THRESH_BINARY)
-    kernel1 = np.array([[0, 1, 0],
-                        [1, -1, 1],
-                        [0, 1, 0]], dtype=np.int8)
-
-    hitmiss = cv2.morphologyEx(binary, cv2.MORPH_HITMISS, kernel1)
-
-    _, buffer = cv2.imencode('.png', hitmiss)
-    return BytesIO(buffer.tobytes())
+    return encode_image(ops.hit_miss(decode_gray(image_bytes)))
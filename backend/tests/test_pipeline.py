@@ -0,0 +1,56 @@
+import json
+import unittest
+
+import cv2
+import numpy as np
+from fastapi.testclient import TestClient
+
+import main
+import ops
+
+# routes whose form defaults differ from the op's own (ksize=0 is rejected,
+# power-law-transformation always uses gamma=0.5); sent to both endpoints
+PARAMS = {
+    "max-filter": {"ksize": 3},
+    "min-filter": {"ksize": 3},
+    "midpoint-filter": {"ksize": 3},
+    "median-filter": {"ksize": 3},
+    "power-law-transformation": {"gamma": 0.5},
+}
+
+
+def _decode(content: bytes) -> np.ndarray:
+    return cv2.imdecode(np.frombuffer(content, np.uint8), cv2.IMREAD_UNCHANGED)
+
+
+class OneStepPipelineTest(unittest.TestCase):
+    """A pipeline of a single step must return exactly what that step's task route does."""
+
+    @classmethod
+    def setUpClass(cls):
+        rng = np.random.default_rng(0)
+        image = cv2.GaussianBlur(rng.integers(0, 256, (96, 128, 3), dtype=np.uint8), (5, 5), 0)
+        cls.files = {
+            # a lossy format, whose gray decode differs most from a converted BGR one
+            "jpeg": ("image.jpg", cv2.imencode(".jpg", image)[1].tobytes(), "image/jpeg"),
+            "png": ("image.png", cv2.imencode(".png", image)[1].tobytes(), "image/png"),
+        }
+        cls.client = TestClient(main.app)
+
+    def test_gray_input_ops_match_their_routes(self):
+        for name in sorted(ops.GRAY_INPUT):
+            for kind, file in self.files.items():
+                with self.subTest(op=name, file=kind):
+                    params = PARAMS.get(name, {})
+                    routed = self.client.post(f"/api/task/{name}", files={"file": file}, data=params)
+                    piped = self.client.post("/api/pipeline", files={"file": file},
+                                             data={"steps": json.dumps([{"op": name, "params": params}])})
+                    self.assertEqual(routed.status_code, 200, routed.text)
+                    self.assertEqual(piped.status_code, 200, piped.text)
+                    expected, actual = _decode(routed.content), _decode(piped.content)
+                    self.assertEqual(expected.shape, actual.shape)
+                    np.testing.assert_array_equal(expected, actual)
+
+
+if __name__ == "__main__":
+    unittest.main()
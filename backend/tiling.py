@@ -0,0 +1,122 @@
+"""
+Strip-tiled execution for local-neighbourhood operations.
+
+An operation whose output pixel depends only on the input pixels within a
+fixed radius (the halo) can be run on horizontal bands of the image, each
+extended by the halo above and below, and the bands stitched back together.
+Rows inside a band see exactly the neighbourhood they would see in the full
+image and rows at the image edges still get the op's own border handling, so
+the result is identical to running the op on the whole image, while the op's
+temporaries (float64 copies, intermediate blurs) only ever exist for one band.
+"""
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import config
+import kernels
+
+# Rough upper bound on the temporaries an op allocates per input sample
+# (e.g. a couple of float64 copies); used to size bands to the memory budget.
+BYTES_PER_SAMPLE = 32
+
+
+def _radius(kernel_size) -> int:
+    return max(int(kernel_size), 1) // 2
+
+
+def _gaussian_radius(ksize, sigma) -> int:
+    if ksize and ksize > 0:
+        return _radius(ksize)
+    # the kernel size OpenCV derives from sigma for 8-bit images
+    return (int(round(sigma * 3 * 2 + 1)) | 1) // 2
+
+
+def _sobel_radius(dx=1, dy=0, ksize=3) -> int:
+    return 1 if ksize in (-1, 1) else _radius(ksize)
+
+
+# op name -> halo in rows for the given op parameters
+HALOS = {
+    "gaussian": lambda ksize=5, sigmaX=0.0: _gaussian_radius(ksize, sigmaX),
+    "lowpass": lambda kernel_size=5: _radius(kernel_size),
+    "highpass": lambda kernel_size=5: _radius(kernel_size),
+    "highboost": lambda boost_factor=2.0, kernel_size=5: _radius(kernel_size),
+    "log": lambda kernel_size=5, sigma=1.0: _gaussian_radius(kernel_size, sigma) + 1,
+    "median-filter": lambda ksize=3: _radius(ksize),
+    "max-filter": lambda ksize=3, shape="rect", kernel="": kernels.radius(shape, ksize, kernel),
+    "min-filter": lambda ksize=3, shape="rect", kernel="": kernels.radius(shape, ksize, kernel),
+    "midpoint-filter": lambda ksize=3, shape="rect", kernel="": kernels.radius(shape, ksize, kernel),
+    "sobel": _sobel_radius,
+    "prewitt": lambda axis="x": 1,
+    "laplacian-filter": lambda: 1,
+    "dilation": lambda kernel_size=5, iterations=1, shape="rect", kernel="":
+        kernels.radius(shape, kernel_size, kernel) * max(iterations, 1),
+    "erosion": lambda kernel_size=5, iterations=1, shape="rect", kernel="":
+        kernels.radius(shape, kernel_size, kernel) * max(iterations, 1),
+    "opening": lambda kernel_size=5, shape="rect", kernel="": 2 * kernels.radius(shape, kernel_size, kernel),
+    "closing": lambda kernel_size=5, shape="rect", kernel="": 2 * kernels.radius(shape, kernel_size, kernel),
+}
+
+_pool: ThreadPoolExecutor | None = None
+
+
+def _get_pool() -> ThreadPoolExecutor:
+    global _pool
+    if _pool is None:
+        _pool = ThreadPoolExecutor(max_workers=config.TILE_WORKERS, thread_name_prefix="pixels-tile")
+    return _pool
+
+
+def should_tile(name: str, img: np.ndarray) -> bool:
+    return name in HALOS and img.shape[0] * img.shape[1] >= config.TILE_MIN_PIXELS
+
+
+def band_rows(img: np.ndarray, halo: int, memory_bytes: int, workers: int) -> int:
+    """Rows per band so that all bands in flight stay within memory_bytes."""
+    width = img.shape[1]
+    channels = img.shape[2] if img.ndim == 3 else 1
+    budget = memory_bytes // max(workers, 1)
+    rows = budget // (width * channels * BYTES_PER_SAMPLE) - 2 * halo
+    # keep the halo a small share of each band even on a tight budget
+    return max(rows, 4 * halo, 16)
+
+
+def apply_tiled(fn, img: np.ndarray, params: dict, halo: int,
+                memory_bytes: int | None = None, workers: int | None = None) -> np.ndarray:
+    memory_bytes = memory_bytes or config.TILE_MEMORY_BYTES
+    workers = workers or config.TILE_WORKERS
+    height = img.shape[0]
+    rows = band_rows(img, halo, memory_bytes, workers)
+    if rows >= height:
+        return fn(img, **params)
+
+    def run_band(y0: int) -> tuple[int, np.ndarray]:
+        y1 = min(y0 + rows, height)
+        top = max(0, y0 - halo)
+        result = fn(img[top:min(height, y1 + halo)], **params)
+        return y0, result[y0 - top:y1 - top]
+
+    starts = list(range(0, height, rows))
+    y0, first = run_band(starts[0])
+    out = np.empty((height,) + first.shape[1:], first.dtype)
+    out[y0:y0 + len(first)] = first
+
+    if workers == 1:
+        for start in starts[1:]:
+            y0, band = run_band(start)
+            out[y0:y0 + len(band)] = band
+        return out
+
+    # keep at most `workers` bands in flight so finished ones don't pile up
+    pending = deque()
+    for start in starts[1:]:
+        pending.append(_get_pool().submit(run_band, start))
+        if len(pending) >= workers:
+            y0, band = pending.popleft().result()
+            out[y0:y0 + len(band)] = band
+    for future in pending:
+        y0, band = future.result()
+        out[y0:y0 + len(band)] = band
+    return out
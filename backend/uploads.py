@@ -0,0 +1,200 @@
+import mmap
+
+from fastapi import File, Form, HTTPException, Request, UploadFile
+from fastapi.responses import JSONResponse
+
+import cache
+import config
+import encoding
+import image_store
+import metrics
+from tasks import DecodedImage, Preview, check_image_size
+
+MIN_PREVIEW_SIDE = 16
+
+
+class Upload:
+    """
+    The image a request operates on, either freshly uploaded bytes or an
+    image previously stored through POST /api/images, how the result should
+    be encoded, and the longest side to scale it down to for a preview (0 for
+    full size).
+    """
+
+    def __init__(self, request: Request, contents: bytes | memoryview | None = None,
+                 image: DecodedImage | None = None, digest: str | None = None,
+                 encoding: encoding.EncodeOptions = encoding.DEFAULT, max_side: int = 0):
+        self.request = request
+        self.contents = contents
+        self.image = image
+        self.encoding = encoding
+        self.max_side = max_side
+        self._digest = digest
+
+    @property
+    def source(self) -> bytes | memoryview | DecodedImage | Preview:
+        """What to hand to a task function."""
+        source = self.image if self.image is not None else self.contents
+        return Preview(source, self.max_side) if self.max_side else source
+
+    @property
+    def digest(self) -> str:
+        if self._digest is None:
+            self._digest = cache.digest(self.contents)
+        return self._digest
+
+    def at_size(self, max_side: int) -> "Upload":
+        """The same image processed with its longest side scaled down to max_side (0 for full size)."""
+        return Upload(self.request, self.contents, self.image, self.digest, self.encoding, max_side)
+
+    def longest_side(self) -> int | None:
+        """The longest side of the full-size image, from its header if it hasn't been decoded."""
+        if self.image is not None:
+            return max(self.image.bgr.shape[:2])
+        size = check_image_size(self.contents)
+        return max(size) if size else None
+
+
+def buffer_upload(file: UploadFile) -> bytes | memoryview:
+    """
+    The contents of an uploaded file without reading it into Python memory.
+
+    Starlette spools uploads larger than 1 MiB to a temporary file; those are
+    memory-mapped, so the pages are backed by the file rather than the heap
+    and the decoder reads them in place. Smaller uploads are simply read.
+    """
+    spooled = file.file
+    if not getattr(spooled, "_rolled", True):
+        spooled.seek(0)
+        return spooled.read()
+    spooled.seek(0, 2)
+    if spooled.tell() == 0:
+        return b""
+    # the mapping stays valid after the form closes the file
+    return memoryview(mmap.mmap(spooled.fileno(), 0, access=mmap.ACCESS_READ))
+
+
+class UploadGroup(Upload):
+    """Several images that one task combines, in the order they were sent."""
+
+    def __init__(self, request: Request, uploads: list[Upload],
+                 encoding: encoding.EncodeOptions = encoding.DEFAULT, max_side: int = 0):
+        super().__init__(request, encoding=encoding, max_side=max_side)
+        self.uploads = uploads
+
+    @property
+    def source(self) -> tuple:
+        return tuple(upload.source for upload in self.uploads)
+
+    @property
+    def digest(self) -> str:
+        if self._digest is None:
+            self._digest = cache.digest("".join(upload.digest for upload in self.uploads).encode())
+        return self._digest
+
+
+def preview_side(preview: bool, max_side: int | None) -> int:
+    """The longest side a preview request asks for, 0 for a full-size one."""
+    if max_side is None:
+        return config.PREVIEW_MAX_SIDE if preview else 0
+    if max_side < MIN_PREVIEW_SIDE:
+        raise HTTPException(status_code=400, detail=f"max_side must be at least {MIN_PREVIEW_SIDE}")
+    return max_side
+
+
+def _negotiate(request: Request, format, quality, png_compression, max_side: int = 0) -> encoding.EncodeOptions:
+    if max_side and png_compression is None:
+        # previews are re-requested often and shown small; favour speed
+        png_compression = config.PREVIEW_PNG_COMPRESSION
+    try:
+        return encoding.negotiate(format, quality, png_compression, request.headers.get("accept"))
+    except encoding.EncodingError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+def _stored(request: Request, image_id: str, options: encoding.EncodeOptions, max_side: int = 0) -> Upload:
+    image = image_store.images.get(image_id)
+    if image is None:
+        raise HTTPException(status_code=404, detail=f"Unknown or expired image_id {image_id}, upload the image again")
+    # image ids are content digests, so cached results are shared with
+    # requests that upload the same file
+    return Upload(request, image=image, digest=image_id, encoding=options, max_side=max_side)
+
+
+async def read_upload(request: Request, file: UploadFile | None = File(None),
+                      image_id: str | None = Form(None), format: str | None = Form(None),
+                      quality: int | None = Form(None), png_compression: int | None = Form(None),
+                      preview: bool = Form(False), max_side: int | None = Form(None)) -> Upload:
+    max_side = preview_side(preview, max_side)
+    options = _negotiate(request, format, quality, png_compression, max_side)
+    if image_id:
+        return _stored(request, image_id, options, max_side)
+    if file is None:
+        raise HTTPException(status_code=422, detail="Send either a file or an image_id")
+    contents = buffer_upload(file)
+    # the multipart body has been received and parsed by now
+    metrics.record_since_start("upload")
+    return Upload(request, contents, encoding=options, max_side=max_side)
+
+
+async def read_uploads(request: Request, file1: UploadFile | None = File(None),
+                       file2: UploadFile | None = File(None), files: list[UploadFile] | None = File(None),
+                       image_ids: str | None = Form(None), format: str | None = Form(None),
+                       quality: int | None = Form(None), png_compression: int | None = Form(None),
+                       preview: bool = Form(False), max_side: int | None = Form(None)) -> UploadGroup:
+    """
+    The inputs of a multi-image task: file1 and file2, then any repeated
+    files fields, then the comma-separated image_ids, in that order.
+    """
+    max_side = preview_side(preview, max_side)
+    options = _negotiate(request, format, quality, png_compression, max_side)
+    uploads = [
+        Upload(request, buffer_upload(f), encoding=options, max_side=max_side)
+        for f in [file1, file2, *(files or [])] if f is not None
+    ]
+    for image_id in (image_ids or "").split(","):
+        if image_id.strip():
+            uploads.append(_stored(request, image_id.strip(), options, max_side))
+    metrics.record_since_start("upload")
+    if len(uploads) < 2:
+        raise HTTPException(status_code=422, detail="Send at least two images as file1/file2, files or image_ids")
+    return UploadGroup(request, uploads, encoding=options, max_side=max_side)
+
+
+class UploadLimitMiddleware:
+    """
+    Rejects request bodies over the configured size with 413: up front from
+    Content-Length, or as soon as a chunked body grows past the limit, before
+    the rest of it is received and spooled.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    @staticmethod
+    def _limit(path: str) -> int:
+        return config.MAX_BATCH_UPLOAD_BYTES if path.startswith("/api/batch/") else config.MAX_UPLOAD_BYTES
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        limit = self._limit(scope["path"])
+        detail = f"Request body exceeds the {limit} byte limit"
+
+        for name, value in scope["headers"]:
+            if name == b"content-length" and value.isdigit() and int(value) > limit:
+                response = JSONResponse({"detail": detail}, status_code=413)
+                return await response(scope, receive, send)
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    raise HTTPException(status_code=413, detail=detail)
+            return message
+
+        await self.app(scope, limited_receive, send)